@@ -4,6 +4,7 @@ import string
 import random
 import re
 
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management.color import no_style
 from django.db import connection, transaction, models
 from django.db.backends.util import truncate_name
@@ -43,12 +44,32 @@ class DatabaseOperations(object):
     delete_unique_sql = "ALTER TABLE %s DROP CONSTRAINT %s"
     delete_foreign_key_sql = 'ALTER TABLE %s DROP CONSTRAINT %s'
     supports_foreign_keys = True
+    supports_create_unique = True
     max_index_name_length = 63
     drop_index_string = 'DROP INDEX %(index_name)s'
     delete_column_string = 'ALTER TABLE %s DROP COLUMN %s CASCADE;'
     create_primary_key_string = "ALTER TABLE %(table)s ADD CONSTRAINT %(constraint)s PRIMARY KEY (%(columns)s)"
     drop_primary_key_string = "ALTER TABLE %(table)s DROP CONSTRAINT %(constraint)s"
     backend_name = None
+    backfill_batch_size = 10000
+
+    # Maps the type names Django generates onto the ones the catalog reports,
+    # so alter_column can tell when a column already has the right type.
+    column_type_aliases = {
+        'varchar': 'character varying',
+        'char': 'character',
+        'serial': 'integer',
+        'bigserial': 'bigint',
+        'int': 'integer',
+        'int2': 'smallint',
+        'int4': 'integer',
+        'int8': 'bigint',
+        'bool': 'boolean',
+        'decimal': 'numeric',
+        'float8': 'double precision',
+        'timestamp': 'timestamp without time zone',
+        'time': 'time without time zone',
+    }
 
     def __init__(self):
         self.debug = False
@@ -56,6 +77,14 @@ class DatabaseOperations(object):
         self.dry_run = False
         self.pending_transactions = 0
         self.pending_create_signals = []
+        # If set, index and foreign key creation waits for the end of the
+        # whole migration plan; see add_deferred_index_sql.
+        self.defer_indexes = False
+        self.plan_deferred_sql = []
+        # Set while start_plan_transaction has the whole plan in one transaction.
+        self.plan_transaction = False
+        # Apps whose initial data waits for that transaction to be committed.
+        self.plan_initial_data = []
     
 
     def connection_init(self):
@@ -118,6 +147,61 @@ class DatabaseOperations(object):
         self.deferred_sql = []
 
 
+    def add_deferred_index_sql(self, tables, sql, columns=()):
+        """
+        Adds an index or foreign key creation statement for the given tables.
+        Normally this is just deferred SQL, but if defer_indexes is set it's
+        kept (once) until execute_plan_deferred_sql is run at the end of the
+        whole migration plan, so data loaded in between doesn't pay for
+        index maintenance. 'columns' lists the (table, column) pairs the
+        statement refers to, so it can be thrown away if they're dropped.
+        """
+        if self.defer_indexes and not self.dry_run:
+            entry = (tuple(tables), tuple(columns), sql)
+            if entry not in self.plan_deferred_sql:
+                self.plan_deferred_sql.append(entry)
+        else:
+            self.add_deferred_sql(sql)
+
+
+    def execute_plan_deferred_sql(self, table_name=None):
+        """
+        Executes the index and foreign key SQL held back by defer_indexes.
+        If table_name is given, only runs the statements involving that
+        table; schema changes call this before they touch a table, so the
+        held-back SQL never refers to something that's been renamed.
+        """
+        pending = [
+            entry for entry in self.plan_deferred_sql
+            if table_name is None or table_name in entry[0]
+        ]
+        for entry in pending:
+            self.execute(entry[-1])
+            self.plan_deferred_sql.remove(entry)
+
+
+    def discard_plan_deferred_sql(self, table_name, column=None):
+        """
+        Drops any index and foreign key SQL held back by defer_indexes that
+        refers to the table (or, if given, just the column) about to be
+        deleted; there's no point creating them only to drop them again.
+        """
+        self.plan_deferred_sql = [
+            (tables, columns, sql) for tables, columns, sql in self.plan_deferred_sql
+            if not (column is None and table_name in tables)
+            and (table_name, column) not in columns
+        ]
+
+
+    def apply_pending_alterations(self):
+        """
+        Backends that batch up table alterations rather than running them
+        straight away (e.g. SQLite's table rebuilds) apply them here. Called
+        before anything needs to see the current schema, like the ORM.
+        """
+        pass
+
+
     def clear_deferred_sql(self):
         """
         Resets the deferred_sql list to empty.
@@ -170,6 +254,7 @@ class DatabaseOperations(object):
         if old_table_name == table_name:
             # No Operation
             return
+        self.execute_plan_deferred_sql(old_table_name)
         qn = connection.ops.quote_name
         params = (qn(old_table_name), qn(table_name))
         self.execute('ALTER TABLE %s RENAME TO %s;' % params)
@@ -179,6 +264,7 @@ class DatabaseOperations(object):
         """
         Deletes the table 'table_name'.
         """
+        self.discard_plan_deferred_sql(table_name)
         qn = connection.ops.quote_name
         params = (qn(table_name), )
         if cascade:
@@ -199,16 +285,24 @@ class DatabaseOperations(object):
 
     
 
-    def add_column(self, table_name, name, field, keep_default=True):
+    def add_column(self, table_name, name, field, keep_default=True, staged=False):
         """
         Adds the column 'name' to the table 'table_name'.
         Uses the 'field' paramater, a django.db.models.fields.Field instance,
         to generate the necessary sql
 
+        If staged is True and the field is NOT NULL with a default, the
+        column is added in stages (see _add_column_staged) rather than
+        with one table-rewriting ADD COLUMN ... NOT NULL DEFAULT.
+
         @param table_name: The name of the table to add the column to
         @param name: The name of the column to add
         @param field: The field to use
+        @param staged: Whether to use the staged strategy for NOT NULL columns
         """
+        if staged and self._can_stage_column(field):
+            return self._add_column_staged(table_name, name, field, keep_default)
+        
         qn = connection.ops.quote_name
         sql = self.column_sql(table_name, name, field)
         if sql:
@@ -224,6 +318,107 @@ class DatabaseOperations(object):
                 field.default = NOT_PROVIDED
                 self.alter_column(table_name, name, field, explicit_name=False)
     
+    
+    def _can_stage_column(self, field):
+        "Returns True if the field can be added with _add_column_staged."
+        return not field.null and field.has_default() and field.get_default() is not None
+    
+    
+    def _add_column_staged(self, table_name, name, field, keep_default=True):
+        """
+        Adds a NOT NULL column with a default without rewriting the table
+        in one go: the column is added as nullable, the default is set (which
+        only affects new rows), existing rows are backfilled in primary key
+        batches outside the migration transaction, and only then is the
+        column made NOT NULL.
+        """
+        qn = connection.ops.quote_name
+        # Add it as a plain nullable column, with no default
+        field.null = True
+        try:
+            self.add_column(table_name, name, field)
+        finally:
+            field.null = False
+        column = field.column
+        default = field.get_default()
+        # New rows get the default from now on
+        self.execute(
+            "ALTER TABLE %s ALTER COLUMN %s SET DEFAULT %%s;" % (qn(table_name), qn(column)),
+            [default],
+        )
+        # Fill in the old ones
+        self._backfill_column(table_name, column, default)
+        # Finally, make it NOT NULL (and drop the default if asked)
+        if not keep_default:
+            field.default = NOT_PROVIDED
+        self._set_column_not_null(table_name, name, field)
+    
+    
+    def _backfill_column(self, table_name, column, value):
+        """
+        Sets 'column' to 'value' in every row where it's NULL, committing
+        after every backfill_batch_size primary keys so we never hold a
+        lock on the whole table.
+        """
+        qn = connection.ops.quote_name
+        sql = "UPDATE %s SET %s = %%s WHERE %s IS NULL" % (qn(table_name), qn(column), qn(column))
+        # Get out of the DDL transaction
+        self.commit_transaction()
+        self.start_transaction()
+        pk_column = self._get_primary_key_column(table_name)
+        bounds = pk_column and self.execute("SELECT MIN(%s), MAX(%s) FROM %s" % (
+            qn(pk_column), qn(pk_column), qn(table_name),
+        ))
+        if not bounds or not isinstance(bounds[0][0], (int, long)):
+            # No usable integer primary key; do it in one go.
+            self.execute(sql, [value])
+            return
+        low, high = bounds[0]
+        sql += " AND %s >= %%s AND %s < %%s" % (qn(pk_column), qn(pk_column))
+        while low <= high:
+            self.execute(sql, [value, low, low + self.backfill_batch_size])
+            self.commit_transaction()
+            self.start_transaction()
+            low += self.backfill_batch_size
+    
+    
+    def _set_column_not_null(self, table_name, name, field):
+        """
+        Makes a freshly backfilled column NOT NULL, setting or dropping
+        its default as the field says. Backends with a cheaper way of
+        doing this override it.
+        """
+        self.alter_column(table_name, name, field, explicit_name=False)
+    
+    
+    def _get_schema_name(self):
+        "Returns the schema to look in when querying information_schema."
+        return 'public'
+    
+    
+    def _get_primary_key_column(self, table_name):
+        """
+        Returns the name of the table's primary key column, or None if it
+        doesn't have a single-column one.
+        """
+        if self.dry_run:
+            return None
+        rows = self.execute("""
+            SELECT kc.column_name
+            FROM information_schema.key_column_usage AS kc
+            JOIN information_schema.table_constraints AS c ON
+                kc.table_schema = c.table_schema AND
+                kc.table_name = c.table_name AND
+                kc.constraint_name = c.constraint_name
+            WHERE
+                kc.table_schema = %s AND
+                kc.table_name = %s AND
+                c.constraint_type = 'PRIMARY KEY'
+        """, [self._get_schema_name(), table_name])
+        if len(rows) != 1:
+            return None
+        return rows[0][0]
+    
 
     def _db_type_for_alter_column(self, field):
         """
@@ -241,6 +436,10 @@ class DatabaseOperations(object):
         Will not automatically add _id by default; to have this behavour, pass
         explicit_name=False.
 
+        Only the parts of the column definition that differ from what is
+        currently in the database are altered; if nothing differs, no
+        SQL is run at all.
+
         @param table_name: The name of the table to add the column to
         @param name: The name of the column to alter
         @param field: The new field definition to use
@@ -257,41 +456,58 @@ class DatabaseOperations(object):
         if not explicit_name:
             name = field.column
         
-        # Drop all check constraints. TODO: Add the right ones back.
+        # See what the column looks like now (None means we can't tell)
+        state = self._get_column_state(table_name, name)
+        db_type = self._db_type_for_alter_column(field)
+        type_changed = state is None or not self._column_types_match(state['type'], db_type)
+        
+        # Drop all check constraints, unless the type is unchanged and
+        # brings its own (e.g. PositiveIntegerField). TODO: Add the right ones back.
         if self.has_check_constraints:
-            check_constraints = self._constraints_affecting_columns(table_name, [name], "CHECK")
-            for constraint in check_constraints:
-                self.execute(self.delete_check_sql % {'table':table_name, 'constraint': constraint})
+            keeps_checks = not type_changed and "CHECK" in (field.db_type() or "").upper()
+            if not keeps_checks:
+                check_constraints = self._constraints_affecting_columns(table_name, [name], "CHECK")
+                for constraint in check_constraints:
+                    self.execute(self.delete_check_sql % {'table':table_name, 'constraint': constraint})
+
+        # SQLs is a list of (SQL, values) pairs.
+        sqls = []
 
         # First, change the type
         params = {
             "column": qn(name),
-            "type": self._db_type_for_alter_column(field)            
+            "type": db_type,
         }
-
-        # SQLs is a list of (SQL, values) pairs.
-        sqls = [(self.alter_string_set_type % params, [])]
+        if type_changed and self.alter_string_set_type:
+            sqls.append((self.alter_string_set_type % params, []))
 
         # Next, set any default
         if not field.null and field.has_default():
             default = field.get_default()
-            sqls.append(('ALTER COLUMN %s SET DEFAULT %%s ' % (qn(name),), [default]))
-        else:
+            if state is None or not self._column_default_matches(state['default'], default):
+                sqls.append(('ALTER COLUMN %s SET DEFAULT %%s ' % (qn(name),), [default]))
+        elif state is None or state['default'] is not None:
             sqls.append(('ALTER COLUMN %s DROP DEFAULT' % (qn(name),), []))
 
-
-        # Next, nullity
+        # Next, nullity (some databases, like MySQL, change the type here too)
         params = {
             "column": qn(name),
             "type": field.db_type(),
         }
-        if field.null:
-            sqls.append((self.alter_string_set_null % params, []))
-        else:
-            sqls.append((self.alter_string_drop_null % params, []))
+        if state is None or state['null'] != field.null or \
+           (type_changed and not self.alter_string_set_type):
+            if field.null:
+                sqls.append((self.alter_string_set_null % params, []))
+            else:
+                sqls.append((self.alter_string_drop_null % params, []))
         
         # TODO: Unique
 
+        if not sqls:
+            if self.debug:
+                print "   ~ Column %s.%s already matches (skipping)" % (table_name, name)
+            return
+
         if self.allows_combined_alters:
             sqls, values = zip(*sqls)
             self.execute(
@@ -304,6 +520,73 @@ class DatabaseOperations(object):
                 self.execute("ALTER TABLE %s %s;" % (qn(table_name), sql), values)
     
     
+    def _get_column_state(self, table_name, name):
+        """
+        Returns a dict of the current 'type', 'null' and 'default' of the
+        column, as reported by the database, or None if it can't be found
+        (or we're in a dry run, and so can't look).
+        """
+        if self.dry_run:
+            return None
+        rows = self.execute("""
+            SELECT data_type, character_maximum_length, numeric_precision,
+                   numeric_scale, is_nullable, column_default
+            FROM information_schema.columns
+            WHERE
+                table_schema = %s AND
+                table_name = %s AND
+                column_name = %s
+        """, [self._get_schema_name(), table_name, name])
+        if not rows:
+            return None
+        data_type, max_length, precision, scale, nullable, default = rows[0]
+        if max_length is not None:
+            data_type = "%s(%s)" % (data_type, max_length)
+        elif data_type == "numeric" and precision is not None:
+            data_type = "%s(%s,%s)" % (data_type, precision, scale or 0)
+        return {
+            "type": data_type,
+            "null": nullable == "YES",
+            "default": default,
+        }
+    
+    
+    def _normalise_column_type(self, db_type):
+        """
+        Lowercases a column type, tidies its whitespace and resolves any
+        aliases, so two spellings of the same type compare equal.
+        """
+        db_type = " ".join(db_type.lower().replace(", ", ",").split())
+        if db_type in self.column_type_aliases:
+            return self.column_type_aliases[db_type]
+        base, paren, rest = db_type.partition("(")
+        base = base.strip()
+        return self.column_type_aliases.get(base, base) + paren + rest
+    
+    
+    def _column_types_match(self, current, wanted):
+        "Returns True if the two column types are definitely the same."
+        if not current or not wanted:
+            return False
+        return self._normalise_column_type(current) == self._normalise_column_type(wanted)
+    
+    
+    def _column_default_matches(self, current, default):
+        """
+        Returns True if the column default reported by the database is
+        definitely the same as the given default value.
+        """
+        if current is None or default is None:
+            return current is None and default is None
+        # Strip off any casts (e.g. 'foo'::character varying) and quotes
+        current = re.sub(r"::[\w ]+(\([\d,]+\))?$", "", current.strip())
+        if len(current) > 1 and current[0] == current[-1] == "'":
+            current = current[1:-1].replace("''", "'")
+        if isinstance(default, bool):
+            return current.lower() in (default and ("true", "1") or ("false", "0"))
+        return current == unicode(default)
+    
+    
     def _constraints_affecting_columns(self, table_name, columns, type="UNIQUE"):
         """
         Gets the names of the constraints affecting the given columns.
@@ -331,7 +614,7 @@ class DatabaseOperations(object):
                 kc.table_schema = %%s AND
                 kc.table_name = %%s AND
                 c.constraint_type = %%s
-        """ % ifsc_table, ['public', table_name, type])
+        """ % ifsc_table, [self._get_schema_name(), table_name, type])
         # Load into a dict
         mapping = {}
         for constraint, column in rows:
@@ -431,17 +714,20 @@ class DatabaseOperations(object):
                     sqlparams = (default)
 
             if field.rel and self.supports_foreign_keys:
-                self.add_deferred_sql(
-                    self.foreign_key_sql(
-                        table_name,
-                        field.column,
-                        field.rel.to._meta.db_table,
-                        field.rel.to._meta.get_field(field.rel.field_name).column
-                    )
+                to_table = field.rel.to._meta.db_table
+                to_column = field.rel.to._meta.get_field(field.rel.field_name).column
+                self.add_deferred_index_sql(
+                    (table_name, to_table),
+                    self.foreign_key_sql(table_name, field.column, to_table, to_column),
+                    ((table_name, field.column), (to_table, to_column)),
                 )
 
             if field.db_index and not field.unique:
-                self.add_deferred_sql(self.create_index_sql(table_name, [field.column]))
+                self.add_deferred_index_sql(
+                    (table_name,),
+                    self.create_index_sql(table_name, [field.column]),
+                    ((table_name, field.column),),
+                )
 
         if hasattr(field, 'post_create_sql'):
             style = no_style()
@@ -462,15 +748,23 @@ class DatabaseOperations(object):
         return field
     
 
+    def foreign_key_name(self, from_table_name, from_column_name, to_table_name, to_column_name):
+        """
+        Generates the name of a foreign key constraint
+        """
+        constraint_name = '%s_refs_%s_%x' % (from_column_name, to_column_name, abs(hash((from_table_name, to_table_name))))
+        return truncate_name(constraint_name, connection.ops.max_name_length())
+
+
     def foreign_key_sql(self, from_table_name, from_column_name, to_table_name, to_column_name):
         """
         Generates a full SQL statement to add a foreign key constraint
         """
         qn = connection.ops.quote_name
-        constraint_name = '%s_refs_%s_%x' % (from_column_name, to_column_name, abs(hash((from_table_name, to_table_name))))
+        constraint_name = self.foreign_key_name(from_table_name, from_column_name, to_table_name, to_column_name)
         return 'ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (%s)%s;' % (
             qn(from_table_name),
-            qn(truncate_name(constraint_name, connection.ops.max_name_length())),
+            qn(constraint_name),
             qn(from_column_name),
             qn(to_table_name),
             qn(to_column_name),
@@ -482,6 +776,7 @@ class DatabaseOperations(object):
         "Drop a foreign key constraint"
         if self.dry_run:
             return # We can't look at the DB to get the constraints
+        self.execute_plan_deferred_sql(table_name)
         constraints = list(self._constraints_affecting_columns(table_name, [column], "FOREIGN KEY"))
         if not constraints:
             raise ValueError("Cannot find a FOREIGN KEY constraint on table %s, column %s" % (table_name, column))
@@ -540,18 +835,31 @@ class DatabaseOperations(object):
         """
         if isinstance(column_names, (str, unicode)):
             column_names = [column_names]
+        self.execute_plan_deferred_sql(table_name)
         name = self.create_index_name(table_name, column_names)
         qn = connection.ops.quote_name
         sql = self.drop_index_string % {"index_name": qn(name), "table_name": qn(table_name)}
         self.execute(sql)
 
     drop_index = alias('delete_index')
+
+
+    def validate_constraints(self):
+        """
+        Validates any constraints that were added without checking existing
+        rows (e.g. Postgres' NOT VALID foreign keys), returning a list of
+        (table, constraint) pairs it validated.
+        Databases that always check constraints as they add them have
+        nothing to do here.
+        """
+        return []
     
 
     def delete_column(self, table_name, name):
         """
         Deletes the column 'column_name' from the table 'table_name'.
         """
+        self.discard_plan_deferred_sql(table_name, name)
         qn = connection.ops.quote_name
         params = (qn(table_name), qn(name))
         self.execute(self.delete_column_string % params, [])
@@ -598,6 +906,8 @@ class DatabaseOperations(object):
         Makes sure the following commands are inside a transaction.
         Must be followed by a (commit|rollback)_transaction call.
         """
+        if self.plan_transaction:
+            return
         if self.dry_run:
             self.pending_transactions += 1
         transaction.commit_unless_managed()
@@ -610,7 +920,7 @@ class DatabaseOperations(object):
         Commits the current transaction.
         Must be preceded by a start_transaction call.
         """
-        if self.dry_run:
+        if self.dry_run or self.plan_transaction:
             return
         transaction.commit()
         transaction.leave_transaction_management()
@@ -621,6 +931,8 @@ class DatabaseOperations(object):
         Rolls back the current transaction.
         Must be preceded by a start_transaction call.
         """
+        if self.plan_transaction:
+            return
         if self.dry_run:
             self.pending_transactions -= 1
         transaction.rollback()
@@ -630,7 +942,7 @@ class DatabaseOperations(object):
         """
         Rolls back all pending_transactions during this dry run.
         """
-        if not self.dry_run:
+        if not self.dry_run or self.plan_transaction:
             return
         while self.pending_transactions > 0:
             self.rollback_transaction()
@@ -640,6 +952,44 @@ class DatabaseOperations(object):
             transaction.leave_transaction_management()
 
 
+    def start_plan_transaction(self):
+        """
+        Runs everything up to finish_plan_transaction - every migration and
+        every history record - in a single transaction, so a failure anywhere
+        leaves the database as it was. The per-migration transaction calls
+        do nothing in the meantime.
+        Only some databases can do this; the others raise ValueError.
+        """
+        raise ValueError("This database can't run a whole migration plan in one transaction.")
+
+
+    def finish_plan_transaction(self, success=True):
+        """
+        Commits (or, if success is False, rolls back) the transaction
+        started by start_plan_transaction.
+        """
+        raise ValueError("This database can't run a whole migration plan in one transaction.")
+
+
+    def save_test_template(self, fingerprint):
+        """
+        Keeps a copy of the freshly-migrated test database, so later test
+        runs with the same migration fingerprint can load_test_template
+        rather than migrating from scratch. Returns False if this database
+        can't.
+        """
+        return False
+
+
+    def load_test_template(self, fingerprint):
+        """
+        Replaces the empty test database with the copy save_test_template
+        made for this fingerprint and returns True, or returns False if
+        there isn't one.
+        """
+        return False
+
+
     def send_create_signal(self, app_label, model_names):
         self.pending_create_signals.append((app_label, model_names))
 
@@ -672,8 +1022,9 @@ class DatabaseOperations(object):
         """
         if self.debug:
             print " - Sending post_syncdb signal for %s: %s" % (app_label, model_names)
-        app = models.Migrations.from_name(app_label)
-        if not app:
+        try:
+            app = models.get_app(app_label)
+        except ImproperlyConfigured:
             return
 
         created_models = []
@@ -19,6 +19,17 @@ class DatabaseOperations(generic.DatabaseOperations):
     has_ddl_transactions = False
     has_check_constraints = False
     delete_unique_sql = "ALTER TABLE %s DROP INDEX %s"
+    column_type_aliases = {
+        'integer': 'int(11)',
+        'integer auto_increment': 'int(11)',
+        'integer unsigned': 'int(10) unsigned',
+        'smallint': 'smallint(6)',
+        'smallint unsigned': 'smallint(5) unsigned',
+        'bigint': 'bigint(20)',
+        'bool': 'tinyint(1)',
+        'numeric': 'decimal',
+        'double precision': 'double',
+    }
     
     
     def connection_init(self):
@@ -36,6 +47,7 @@ class DatabaseOperations(generic.DatabaseOperations):
         if old == new or self.dry_run:
             return []
         
+        self.execute_plan_deferred_sql(table_name)
         qn = connection.ops.quote_name
         
         rows = [x for x in self.execute('DESCRIBE %s' % (qn(table_name),)) if x[0] == old]
@@ -62,7 +74,40 @@ class DatabaseOperations(generic.DatabaseOperations):
             self.execute(sql)
     
     
+    def _get_schema_name(self):
+        return settings.DATABASE_NAME
+    
+    
+    def _can_stage_column(self, field):
+        """
+        Making the column NOT NULL at the end takes an ALTER ... MODIFY,
+        which rewrites the whole table anyway, so staging would just add a
+        backfill on top; MySQL always adds the column in one go.
+        """
+        return False
+    
+    
+    def _get_column_state(self, table_name, name):
+        """
+        Uses DESCRIBE to find the current type, nullity and default of the column.
+        """
+        if self.dry_run:
+            return None
+        qn = connection.ops.quote_name
+        rows = [x for x in self.execute('DESCRIBE %s' % (qn(table_name),)) if x[0] == name]
+        if not rows:
+            return None
+        return {
+            "type": rows[0][1],
+            "null": rows[0][2] == "YES",
+            "default": rows[0][4],
+        }
+    
+    
     def delete_column(self, table_name, name):
+        # Held-back index/FK SQL for this column would only get in the way
+        # of dropping it, so it goes before we look for foreign keys.
+        self.discard_plan_deferred_sql(table_name, name)
         qn = connection.ops.quote_name
         db_name = settings.DATABASE_NAME
         
@@ -98,6 +143,7 @@ class DatabaseOperations(generic.DatabaseOperations):
         if old_table_name == table_name:
             # No Operation
             return
+        self.execute_plan_deferred_sql(old_table_name)
         qn = connection.ops.quote_name
         params = (qn(old_table_name), qn(table_name))
         self.execute('RENAME TABLE %s TO %s;' % params)
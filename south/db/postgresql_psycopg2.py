@@ -1,5 +1,7 @@
 
-from django.db import connection, models
+from django.db import connection, models, DatabaseError
+from django.conf import settings
+from django.db.backends.util import truncate_name
 from south.db import generic
 
 class DatabaseOperations(generic.DatabaseOperations):
@@ -10,9 +12,134 @@ class DatabaseOperations(generic.DatabaseOperations):
     
     backend_name = "postgres"
 
+    # Foreign keys added as NOT VALID get this on the front of their names,
+    # so validate_constraints can find them again, even once their tables
+    # or columns have been renamed.
+    not_valid_prefix = "south_nv_"
+
+    def __init__(self):
+        super(DatabaseOperations, self).__init__()
+        # Add foreign keys as NOT VALID, leaving validate_constraints to
+        # check the existing rows later without blocking writes.
+        self.not_valid_foreign_keys = getattr(settings, "SOUTH_NOT_VALID_FOREIGN_KEYS", False)
+
+    def foreign_key_name(self, from_table_name, from_column_name, to_table_name, to_column_name):
+        name = super(DatabaseOperations, self).foreign_key_name(from_table_name, from_column_name, to_table_name, to_column_name)
+        if self.not_valid_foreign_keys:
+            name = truncate_name(self.not_valid_prefix + name, connection.ops.max_name_length())
+        return name
+
+    def foreign_key_sql(self, from_table_name, from_column_name, to_table_name, to_column_name):
+        sql = super(DatabaseOperations, self).foreign_key_sql(from_table_name, from_column_name, to_table_name, to_column_name)
+        if self.not_valid_foreign_keys:
+            sql = sql.rstrip(";") + " NOT VALID;"
+        return sql
+
+    def validate_constraints(self):
+        """
+        Runs VALIDATE CONSTRAINT on the NOT VALID foreign keys South added
+        (recognised by their names' prefix, so they're found from any run),
+        each in its own transaction. Anyone else's NOT VALID constraints
+        are left alone. Validation only takes a SHARE UPDATE EXCLUSIVE
+        lock, so it doesn't block writes.
+        """
+        if self.dry_run:
+            return []
+        qn = connection.ops.quote_name
+        constraints = [
+            (table_name, constraint)
+            for table_name, constraint in self.execute("""
+                SELECT cl.relname, co.conname
+                FROM pg_catalog.pg_constraint AS co
+                JOIN pg_catalog.pg_class AS cl ON cl.oid = co.conrelid
+                JOIN pg_catalog.pg_namespace AS ns ON ns.oid = cl.relnamespace
+                WHERE
+                    NOT co.convalidated AND
+                    co.contype = 'f' AND
+                    ns.nspname = %s
+            """, [self._get_schema_name()])
+            if constraint.startswith(self.not_valid_prefix)
+        ]
+        for table_name, constraint in constraints:
+            self.start_transaction()
+            try:
+                self.execute("ALTER TABLE %s VALIDATE CONSTRAINT %s;" % (qn(table_name), qn(constraint)))
+            except:
+                self.rollback_transaction()
+                raise
+            else:
+                self.commit_transaction()
+        return constraints
+
+    def _test_template_name(self, fingerprint):
+        return truncate_name("%s_south_%s" % (settings.DATABASE_NAME, fingerprint), 63)
+
+    def _outside_database(self, function):
+        """
+        Calls function with an autocommitting cursor on the 'postgres'
+        database, as CREATE DATABASE can't be run in a transaction, nor copy
+        a database anyone is connected to. Test runs in parallel take turns,
+        holding an advisory lock, so none of them copies or drops a template
+        while another is using it.
+        """
+        database_name = connection.settings_dict["DATABASE_NAME"]
+        connection.close()
+        connection.settings_dict["DATABASE_NAME"] = "postgres"
+        try:
+            cursor = connection.cursor()
+            connection.creation.set_autocommit()
+            cursor.execute("SELECT pg_advisory_lock(hashtext('south_test_templates'))")
+            return function(cursor)
+        finally:
+            # Closing the connection releases the lock
+            connection.close()
+            connection.settings_dict["DATABASE_NAME"] = database_name
+
+    def _template_exists(self, cursor, template_name):
+        cursor.execute("SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s", [template_name])
+        return bool(cursor.fetchall())
+
+    def save_test_template(self, fingerprint):
+        """
+        Saves the migrated test database as a template database, unless
+        another run already has, and drops any kept for other fingerprints
+        that nobody is using.
+        """
+        qn = connection.ops.quote_name
+        template_name = self._test_template_name(fingerprint)
+        def save(cursor):
+            cursor.execute("SELECT datname FROM pg_catalog.pg_database WHERE datname LIKE %s", [settings.DATABASE_NAME + "%"])
+            for (name,) in cursor.fetchall():
+                if name.startswith(settings.DATABASE_NAME + "_south_") and name != template_name:
+                    try:
+                        cursor.execute("DROP DATABASE %s" % qn(name))
+                    except DatabaseError:
+                        # Someone's still connected to it; it can go next time
+                        pass
+            if not self._template_exists(cursor, template_name):
+                cursor.execute("CREATE DATABASE %s TEMPLATE %s" % (qn(template_name), qn(settings.DATABASE_NAME)))
+            return True
+        return self._outside_database(save)
+
+    def load_test_template(self, fingerprint):
+        """
+        Recreates the test database from the template database saved for
+        this fingerprint, if there is one.
+        """
+        qn = connection.ops.quote_name
+        template_name = self._test_template_name(fingerprint)
+        def load(cursor):
+            if not self._template_exists(cursor, template_name):
+                return False
+            cursor.execute("DROP DATABASE %s" % qn(settings.DATABASE_NAME))
+            cursor.execute("CREATE DATABASE %s TEMPLATE %s" % (qn(settings.DATABASE_NAME), qn(template_name)))
+            return True
+        return self._outside_database(load)
+
     def rename_column(self, table_name, old, new):
         if old == new:
             return []
+        self.execute_plan_deferred_sql(table_name)
         qn = connection.ops.quote_name
         params = (qn(table_name), qn(old), qn(new))
         self.execute('ALTER TABLE %s RENAME COLUMN %s TO %s;' % params)
@@ -49,6 +176,32 @@ class DatabaseOperations(generic.DatabaseOperations):
         self.start_transaction()
 
 
+    def _set_column_not_null(self, table_name, name, field):
+        """
+        Rather than letting SET NOT NULL scan the table under an ACCESS
+        EXCLUSIVE lock, adds an IS NOT NULL check as NOT VALID, validates it
+        in its own transaction (which doesn't block writes), and then sets
+        NOT NULL, which newer Postgres versions prove using the check.
+        """
+        qn = connection.ops.quote_name
+        column = field.column
+        constraint = truncate_name("%s_%s_notnull" % (table_name, column), connection.ops.max_name_length())
+        self.execute("ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) NOT VALID;" % (
+            qn(table_name), qn(constraint), qn(column),
+        ))
+        self.commit_transaction()
+        self.start_transaction()
+        self.execute("ALTER TABLE %s VALIDATE CONSTRAINT %s;" % (qn(table_name), qn(constraint)))
+        self.commit_transaction()
+        self.start_transaction()
+        if field.has_default():
+            self.execute("ALTER TABLE %s ALTER COLUMN %s SET NOT NULL;" % (qn(table_name), qn(column)))
+        else:
+            self.execute("ALTER TABLE %s ALTER COLUMN %s SET NOT NULL, ALTER COLUMN %s DROP DEFAULT;" % (
+                qn(table_name), qn(column), qn(column),
+            ))
+        self.execute(self.delete_check_sql % {'table': qn(table_name), 'constraint': qn(constraint)})
+
     def rename_index(self, old_index_name, index_name):
         "Rename an index individually"
         generic.DatabaseOperations.rename_table(self, old_index_name, index_name)
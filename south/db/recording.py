@@ -0,0 +1,378 @@
+"""
+A database backend that never touches a database.
+
+It keeps an in-memory model of the schema (tables, columns, indexes, unique,
+primary and foreign key constraints), applies every operation to that, and
+records the SQL the generic backend would have run. Point
+SOUTH_DATABASE_ADAPTER at 'south.db.recording' to run migrations against it;
+DATABASE_ENGINE still needs setting, as Django uses it to work out column
+types and quoting, but no connection is ever opened.
+
+Operations on tables or columns that don't exist (or already do) raise
+ValueError, just as the real database would have complained.
+"""
+
+from copy import deepcopy
+
+from django.db import connection
+from django.utils.datastructures import SortedDict
+
+from south.db import generic
+
+
+class DatabaseOperations(generic.DatabaseOperations):
+
+    """
+    In-memory, SQL-recording implementation of database operations.
+    """
+
+    backend_name = "recording"
+    # We don't model CHECK constraints.
+    has_check_constraints = False
+
+    def __init__(self):
+        super(DatabaseOperations, self).__init__()
+        self.tables = SortedDict()
+        self.recorded_sql = []
+        # Schema changes to make when a (possibly deferred) statement runs
+        self._sql_effects = {}
+        self._snapshots = []
+
+    def connection_init(self):
+        pass
+
+    def execute(self, sql, params=[]):
+        """
+        Records the statement (and applies its effect to the schema, if
+        it has one) rather than running it.
+        """
+        if self.debug:
+            print "   = %s" % sql, params
+        if self.dry_run:
+            return []
+        self.recorded_sql.append((sql, list(params)))
+        if sql in self._sql_effects:
+            self._sql_effects[sql]()
+        return []
+
+    def clear_recorded_sql(self):
+        "Forgets all the SQL recorded so far."
+        self.recorded_sql = []
+
+    def get_schema(self):
+        """
+        Returns a copy of the schema model, as a dict of
+        {table_name: {'columns', 'primary_key', 'indexes', 'uniques', 'foreign_keys'}}.
+        """
+        return deepcopy(dict(self.tables))
+
+    ## Schema model helpers
+
+    def _get_table(self, table_name):
+        try:
+            return self.tables[table_name]
+        except KeyError:
+            raise ValueError("No table '%s'." % table_name)
+
+    def _get_column(self, table_name, name):
+        table = self._get_table(table_name)
+        try:
+            return table['columns'][name]
+        except KeyError:
+            raise ValueError("No column '%s' in '%s'." % (name, table_name))
+
+    def _column_state_for_field(self, field):
+        default = None
+        if not field.null and field.has_default() and field.get_default() is not None:
+            default = unicode(field.get_default())
+        return {
+            "type": field.db_type(),
+            "null": field.null,
+            "default": default,
+        }
+
+    def _add_column_state(self, table_name, field):
+        table = self._get_table(table_name)
+        if field.column in table['columns']:
+            raise ValueError("Column '%s' already exists in '%s'." % (field.column, table_name))
+        table['columns'][field.column] = self._column_state_for_field(field)
+        if field.primary_key:
+            table['primary_key'] = [field.column]
+        elif field.unique:
+            table['uniques']["%s_%s_key" % (table_name, field.column)] = [field.column]
+
+    def _rename_in(self, names, old, new):
+        return [name == old and new or name for name in names]
+
+    ## Introspection, answered from the model
+
+    def _get_column_state(self, table_name, name):
+        if self.dry_run:
+            return None
+        try:
+            return dict(self._get_column(table_name, name))
+        except ValueError:
+            return None
+
+    def _get_primary_key_column(self, table_name):
+        if self.dry_run or table_name not in self.tables:
+            return None
+        primary_key = self.tables[table_name]['primary_key']
+        if len(primary_key) != 1:
+            return None
+        return primary_key[0]
+
+    def _constraints_affecting_columns(self, table_name, columns, type="UNIQUE"):
+        if self.dry_run:
+            raise ValueError("Cannot get constraints for columns during a dry run.")
+        table = self._get_table(table_name)
+        columns = set(columns)
+        if type == "UNIQUE":
+            for constraint, itscols in table['uniques'].items():
+                if set(itscols) == columns:
+                    yield constraint
+        elif type == "FOREIGN KEY":
+            for constraint, (column, to_table, to_column) in table['foreign_keys'].items():
+                if set([column]) == columns:
+                    yield constraint
+
+    ## Tables
+
+    def create_table(self, table_name, fields):
+        if self.dry_run:
+            return super(DatabaseOperations, self).create_table(table_name, fields)
+        if table_name in self.tables:
+            raise ValueError("Table '%s' already exists." % table_name)
+        super(DatabaseOperations, self).create_table(table_name, fields)
+        self.tables[table_name] = {
+            'columns': SortedDict(),
+            'primary_key': [],
+            'indexes': {},
+            'uniques': {},
+            'foreign_keys': {},
+        }
+        for field_name, field in fields:
+            if field.db_type():
+                self._add_column_state(table_name, field)
+
+    add_table = generic.alias('create_table')
+
+    def rename_table(self, old_table_name, table_name):
+        if self.dry_run or old_table_name == table_name:
+            return super(DatabaseOperations, self).rename_table(old_table_name, table_name)
+        self._get_table(old_table_name)
+        if table_name in self.tables:
+            raise ValueError("Table '%s' already exists." % table_name)
+        super(DatabaseOperations, self).rename_table(old_table_name, table_name)
+        self.tables[table_name] = self.tables.pop(old_table_name)
+        for table in self.tables.values():
+            for constraint, (column, to_table, to_column) in table['foreign_keys'].items():
+                if to_table == old_table_name:
+                    table['foreign_keys'][constraint] = (column, table_name, to_column)
+
+    def delete_table(self, table_name, cascade=True):
+        if self.dry_run:
+            return super(DatabaseOperations, self).delete_table(table_name, cascade)
+        self._get_table(table_name)
+        super(DatabaseOperations, self).delete_table(table_name, cascade)
+        del self.tables[table_name]
+        # Foreign keys pointing at it go with it
+        for table in self.tables.values():
+            for constraint, (column, to_table, to_column) in table['foreign_keys'].items():
+                if to_table == table_name:
+                    del table['foreign_keys'][constraint]
+
+    drop_table = generic.alias('delete_table')
+
+    ## Columns
+
+    def add_column(self, table_name, name, field, keep_default=True, staged=False):
+        # Staging adds it as a plain nullable column and then alters it,
+        # which comes back through here and alter_column.
+        if self.dry_run or (staged and self._can_stage_column(field)):
+            return super(DatabaseOperations, self).add_column(table_name, name, field, keep_default, staged)
+        field.set_attributes_from_name(name)
+        if field.db_type():
+            self._add_column_state(table_name, field)
+        super(DatabaseOperations, self).add_column(table_name, name, field, keep_default)
+
+    def alter_column(self, table_name, name, field, explicit_name=True):
+        if self.dry_run:
+            return super(DatabaseOperations, self).alter_column(table_name, name, field, explicit_name)
+        field.set_attributes_from_name(name)
+        column = explicit_name and name or field.column
+        self._get_column(table_name, column)
+        super(DatabaseOperations, self).alter_column(table_name, name, field, explicit_name)
+        self.tables[table_name]['columns'][column] = self._column_state_for_field(field)
+
+    def delete_column(self, table_name, name):
+        if self.dry_run:
+            return super(DatabaseOperations, self).delete_column(table_name, name)
+        self._get_column(table_name, name)
+        super(DatabaseOperations, self).delete_column(table_name, name)
+        table = self.tables[table_name]
+        del table['columns'][name]
+        for kind in ('indexes', 'uniques'):
+            for constraint, itscols in table[kind].items():
+                if name in itscols:
+                    del table[kind][constraint]
+        for constraint, (column, to_table, to_column) in table['foreign_keys'].items():
+            if column == name:
+                del table['foreign_keys'][constraint]
+        if name in table['primary_key']:
+            table['primary_key'] = []
+
+    drop_column = generic.alias('delete_column')
+
+    def rename_column(self, table_name, old, new):
+        if old == new:
+            return
+        if not self.dry_run:
+            self._get_column(table_name, old)
+        self.execute_plan_deferred_sql(table_name)
+        qn = connection.ops.quote_name
+        self.execute('ALTER TABLE %s RENAME COLUMN %s TO %s;' % (qn(table_name), qn(old), qn(new)))
+        if self.dry_run:
+            return
+        table = self.tables[table_name]
+        columns = SortedDict()
+        for name, state in table['columns'].items():
+            columns[name == old and new or name] = state
+        table['columns'] = columns
+        for kind in ('indexes', 'uniques'):
+            for constraint, itscols in table[kind].items():
+                table[kind][constraint] = self._rename_in(itscols, old, new)
+        table['primary_key'] = self._rename_in(table['primary_key'], old, new)
+        for constraint, (column, to_table, to_column) in table['foreign_keys'].items():
+            table['foreign_keys'][constraint] = (column == old and new or column, to_table, to_column)
+        for other in self.tables.values():
+            for constraint, (column, to_table, to_column) in other['foreign_keys'].items():
+                if to_table == table_name and to_column == old:
+                    other['foreign_keys'][constraint] = (column, to_table, new)
+
+    ## Constraints and indexes
+
+    def create_unique(self, table_name, columns):
+        if not isinstance(columns, (list, tuple)):
+            columns = [columns]
+        if not self.dry_run:
+            for column in columns:
+                self._get_column(table_name, column)
+        name = super(DatabaseOperations, self).create_unique(table_name, columns)
+        if not self.dry_run:
+            self.tables[table_name]['uniques'][name] = list(columns)
+        return name
+
+    def delete_unique(self, table_name, columns):
+        if not isinstance(columns, (list, tuple)):
+            columns = [columns]
+        if self.dry_run:
+            return
+        constraints = list(self._constraints_affecting_columns(table_name, columns))
+        super(DatabaseOperations, self).delete_unique(table_name, columns)
+        for constraint in constraints:
+            del self.tables[table_name]['uniques'][constraint]
+
+    def create_index_sql(self, table_name, column_names, unique=False, db_tablespace=''):
+        sql = super(DatabaseOperations, self).create_index_sql(table_name, column_names, unique, db_tablespace)
+        name = self.create_index_name(table_name, column_names)
+        def effect():
+            for column in column_names:
+                self._get_column(table_name, column)
+            if unique:
+                self.tables[table_name]['uniques'][name] = list(column_names)
+            else:
+                self.tables[table_name]['indexes'][name] = list(column_names)
+        self._sql_effects[sql] = effect
+        return sql
+
+    def delete_index(self, table_name, column_names, db_tablespace=''):
+        if isinstance(column_names, (str, unicode)):
+            column_names = [column_names]
+        if self.dry_run:
+            return super(DatabaseOperations, self).delete_index(table_name, column_names, db_tablespace)
+        table = self._get_table(table_name)
+        # Run any held-back index creation first, so we can see it
+        self.execute_plan_deferred_sql(table_name)
+        name = self.create_index_name(table_name, column_names)
+        if name not in table['indexes'] and name not in table['uniques']:
+            raise ValueError("No index '%s' on '%s'." % (name, table_name))
+        super(DatabaseOperations, self).delete_index(table_name, column_names, db_tablespace)
+        table['indexes'].pop(name, None)
+        table['uniques'].pop(name, None)
+
+    drop_index = generic.alias('delete_index')
+
+    def foreign_key_sql(self, from_table_name, from_column_name, to_table_name, to_column_name):
+        sql = super(DatabaseOperations, self).foreign_key_sql(from_table_name, from_column_name, to_table_name, to_column_name)
+        name = self.foreign_key_name(from_table_name, from_column_name, to_table_name, to_column_name)
+        def effect():
+            # The target may well belong to an app we're not migrating
+            # (e.g. auth), so only the local end is checked.
+            self._get_column(from_table_name, from_column_name)
+            self.tables[from_table_name]['foreign_keys'][name] = (
+                from_column_name, to_table_name, to_column_name,
+            )
+        self._sql_effects[sql] = effect
+        return sql
+
+    def delete_foreign_key(self, table_name, column):
+        if self.dry_run:
+            return
+        self.execute_plan_deferred_sql(table_name)
+        constraints = list(self._constraints_affecting_columns(table_name, [column], "FOREIGN KEY"))
+        super(DatabaseOperations, self).delete_foreign_key(table_name, column)
+        for constraint in constraints:
+            del self.tables[table_name]['foreign_keys'][constraint]
+
+    drop_foreign_key = generic.alias('delete_foreign_key')
+
+    def create_primary_key(self, table_name, columns):
+        if not isinstance(columns, (list, tuple)):
+            columns = [columns]
+        if not self.dry_run:
+            for column in columns:
+                self._get_column(table_name, column)
+        super(DatabaseOperations, self).create_primary_key(table_name, columns)
+        if not self.dry_run:
+            self.tables[table_name]['primary_key'] = list(columns)
+
+    def drop_primary_key(self, table_name):
+        if not self.dry_run:
+            self._get_table(table_name)
+        super(DatabaseOperations, self).drop_primary_key(table_name)
+        if not self.dry_run:
+            self.tables[table_name]['primary_key'] = []
+
+    delete_primary_key = generic.alias('drop_primary_key')
+
+    ## Transactions just snapshot the model
+
+    def start_transaction(self):
+        if self.dry_run:
+            self.pending_transactions += 1
+        self._snapshots.append(deepcopy(self.tables))
+
+    def commit_transaction(self):
+        if self.dry_run:
+            return
+        if self._snapshots:
+            self._snapshots.pop()
+
+    def rollback_transaction(self):
+        if self.dry_run:
+            self.pending_transactions -= 1
+        if self._snapshots:
+            self.tables = self._snapshots.pop()
+
+    def rollback_transactions_dry_run(self):
+        if not self.dry_run:
+            return
+        while self.pending_transactions > 0:
+            self.rollback_transaction()
+
+    ## There's nobody to tell about new models
+
+    def really_send_create_signal(self, app_label, model_names):
+        if self.debug:
+            print " - Not sending post_syncdb signal for %s: %s" % (app_label, model_names)
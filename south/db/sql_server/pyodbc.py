@@ -18,6 +18,7 @@ class DatabaseOperations(generic.DatabaseOperations):
 
 
     def delete_column(self, table_name, name):
+        self.discard_plan_deferred_sql(table_name, name)
         qn = connection.ops.quote_name
         q_table_name, q_name = (qn(table_name), qn(name))
 
@@ -108,9 +109,9 @@ class DatabaseOperations(generic.DatabaseOperations):
             if field.default == False:
                 field.default = 0
 
-    def add_column(self, table_name, name, field, keep_default=True):
+    def add_column(self, table_name, name, field, keep_default=True, staged=False):
         self._fix_field_definition(field)
-        generic.DatabaseOperations.add_column(self, table_name, name, field, keep_default)
+        generic.DatabaseOperations.add_column(self, table_name, name, field, keep_default, staged)
 
     def create_table(self, table_name, fields):
         # Tweak stuff as needed
@@ -128,6 +129,7 @@ class DatabaseOperations(generic.DatabaseOperations):
         if old == new:
             # No Operation
             return
+        self.execute_plan_deferred_sql(table_name)
         # Examples on the MS site show the table name not being quoted...
         qn = connection.ops.quote_name
         params = (table_name,qn(old), qn(new))
@@ -141,6 +143,7 @@ class DatabaseOperations(generic.DatabaseOperations):
         if old_table_name == table_name:
             # No Operation
             return
+        self.execute_plan_deferred_sql(old_table_name)
         qn = connection.ops.quote_name
         params = (qn(old_table_name), qn(table_name))
         self.execute('EXEC sp_rename %s, %s' % params)
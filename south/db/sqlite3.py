@@ -1,16 +1,46 @@
-import inspect
-from django.db import connection
+import os
+import shutil
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.backends.sqlite3.base import Database
+from django.utils.datastructures import SortedDict
 from south.db import generic
+from south.utils import is_private, open_private, private_directory
 
 class DatabaseOperations(generic.DatabaseOperations):
 
     """
     SQLite3 implementation of database operations.
     """
+    
+    backend_name = "sqlite3"
 
     # SQLite ignores foreign key constraints. I wish I could.
     supports_foreign_keys = False
     
+    # Nor can it add unique constraints to an existing table (see create_unique),
+    # though a unique index does the same job.
+    supports_create_unique = False
+    
+    # Newer SQLites can do some column changes without a table rebuild.
+    supports_rename_column = Database.sqlite_version_info >= (3, 25, 0)
+    supports_drop_column = Database.sqlite_version_info >= (3, 35, 0)
+    
+    # Settings used while a whole plan runs in one transaction; the
+    # originals are put back afterwards. Foreign keys have to be off while
+    # tables are rebuilt, and get checked at the end instead. Like turning
+    # synchronous off, keeping the journal in memory trades crash safety
+    # for speed; a WAL database just stays in WAL mode.
+    plan_pragmas = [
+        ("foreign_keys", "OFF"),
+        ("journal_mode", "MEMORY"),
+        ("synchronous", "OFF"),
+        ("cache_size", "-65536"),
+        ("mmap_size", "268435456"),
+        ("temp_store", "MEMORY"),
+    ]
+    
     # You can't add UNIQUE columns with an ALTER TABLE.
     def add_column(self, table_name, name, field, *args, **kwds):
         # Run ALTER TABLE with no unique column
@@ -23,32 +53,344 @@ class DatabaseOperations(generic.DatabaseOperations):
         if unique:
             self.create_index(table_name, [field.column], unique=True)
     
-    def _alter_sqlite_table(self, table_name, field_renames={}):
+    def _can_stage_column(self, field):
         """
-        Not supported under SQLite.
+        Adding a column with a default doesn't touch the existing rows in
+        SQLite (and it can't change a column's default afterwards), so
+        there's nothing to be gained from staging it.
+        """
+        return False
+    
+    def _get_primary_key_column(self, table_name):
+        if self.dry_run:
+            return None
+        qn = connection.ops.quote_name
+        primary_key = [row[1] for row in self.execute("PRAGMA table_info(%s)" % qn(table_name)) if row[5]]
+        if len(primary_key) != 1:
+            return None
+        return primary_key[0]
+    
+    def __init__(self):
+        super(DatabaseOperations, self).__init__()
+        # Table alterations SQLite can't do natively, as
+        # {table_name: [('rename', old, new) | ('delete', name) | ('alter', name, field)]}
+        self._pending_alterations = SortedDict()
+    
+    def _queue_alteration(self, table_name, alteration):
+        """
+        SQLite can't alter columns (nor, before 3.25/3.35, rename or drop
+        them), so we may have to rebuild the whole table. Rather than doing
+        that for every change, queue them up and rebuild each table at most
+        once, just before anything else runs: the next db.execute, deferred
+        SQL or commit. Anything else (the ORM, a raw cursor) needs to call
+        apply_pending_alterations first.
+        If nothing's queued and SQLite can do this one itself, it's done
+        straight away.
         """
-        model_name = table_name.replace('_', '.', 1)
-        model = self.current_orm[model_name]
-        if getattr(model, '_already_run_alter_schema_trick', False):
+        if self.dry_run:
             return
+        # Held-back indexes refer to the columns as they are now, and a
+        # rebuild only keeps the indexes that are there already.
+        self.execute_plan_deferred_sql(table_name)
+        if not self._pending_alterations and self._can_alter_natively(table_name, [alteration]):
+            self._alter_natively(table_name, [alteration])
+            return
+        self._pending_alterations.setdefault(table_name, []).append(alteration)
+    
+    def _clear_pending_alterations(self):
+        "Forgets any queued alterations."
+        self._pending_alterations = SortedDict()
+    
+    def apply_pending_alterations(self):
+        pending = self._pending_alterations
+        self._clear_pending_alterations()
+        for table_name, alterations in pending.items():
+            if self._can_alter_natively(table_name, alterations):
+                self._alter_natively(table_name, alterations)
+            else:
+                self._rebuild_table(table_name, alterations)
+    
+    def execute(self, sql, params=[]):
+        # Anything else that runs needs to see the altered tables
+        self.apply_pending_alterations()
+        return generic.DatabaseOperations.execute(self, sql, params)
+    
+    def execute_deferred_sql(self):
+        self.apply_pending_alterations()
+        generic.DatabaseOperations.execute_deferred_sql(self)
+    
+    def clear_run_data(self, pending_creates=None):
+        generic.DatabaseOperations.clear_run_data(self, pending_creates)
+        self._clear_pending_alterations()
+    
+    def commit_transaction(self):
+        if not self.dry_run:
+            self.apply_pending_alterations()
+        generic.DatabaseOperations.commit_transaction(self)
+    
+    def rollback_transaction(self):
+        # Anything queued goes the way of the rest of the transaction
+        self._clear_pending_alterations()
+        generic.DatabaseOperations.rollback_transaction(self)
+    
+    def start_plan_transaction(self):
+        """
+        Runs the whole plan in one transaction, with SQLite tuned for bulk
+        schema changes. pysqlite normally commits before every DDL
+        statement, so we take over and BEGIN/COMMIT ourselves.
+        """
+        if self.dry_run:
+            return
+        transaction.commit_unless_managed()
+        cursor = connection.cursor()
+        self._plan_settings = []
+        for name, value in self.plan_pragmas:
+            cursor.execute("PRAGMA %s" % name)
+            row = cursor.fetchone()
+            # Some don't apply (e.g. mmap_size on in-memory databases)
+            if row is not None:
+                self._plan_settings.append((name, row[0]))
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+        self._plan_isolation_level = connection.connection.isolation_level
+        connection.connection.isolation_level = None
+        cursor.execute("BEGIN")
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        self.plan_transaction = True
+    
+    def finish_plan_transaction(self, success=True):
+        if not self.plan_transaction:
+            return
+        self.plan_transaction = False
+        try:
+            if success:
+                self.apply_pending_alterations()
+                if dict(self._plan_settings).get("foreign_keys"):
+                    self._check_foreign_keys()
+                transaction.commit()
+            else:
+                self._clear_pending_alterations()
+                transaction.rollback()
+        except:
+            self._clear_pending_alterations()
+            transaction.rollback()
+            raise
+        finally:
+            transaction.leave_transaction_management()
+            connection.connection.isolation_level = self._plan_isolation_level
+            cursor = connection.cursor()
+            for name, value in self._plan_settings:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+    
+    def _check_foreign_keys(self):
+        """
+        Foreign keys were off while the plan ran; make sure nothing it did
+        broke them.
+        """
+        problems = self.execute("PRAGMA foreign_key_check")
+        if problems:
+            raise ValueError("The migrations left rows with broken foreign keys: %s" % ", ".join([
+                "%s row %s -> %s" % (table, rowid, parent) for table, rowid, parent, fkid in problems
+            ]))
+    
+    def _test_template_path(self, fingerprint):
+        """
+        In-memory test databases are kept as an SQL dump, on-disk ones as
+        a copy of the file. Either gets run, so they're kept somewhere only
+        we can write to; if there's no such place, returns None.
+        """
+        if settings.DATABASE_NAME == ":memory:":
+            extension = "sql"
+        else:
+            extension = "db"
+        dirname = private_directory("south-tests", getattr(settings, "SOUTH_TESTS_TEMPLATE_DIR", None))
+        if dirname is None:
+            return None
+        return os.path.join(dirname, "south_test_%s.%s" % (fingerprint, extension))
+    
+    def save_test_template(self, fingerprint):
+        path = self._test_template_path(fingerprint)
+        if path is None:
+            return False
+        # Write it under another name first, so nobody loads half of it
+        temp_path = "%s.%s" % (path, os.getpid())
+        dump = open_private(temp_path)
+        try:
+            if settings.DATABASE_NAME == ":memory:":
+                connection.cursor()
+                for line in connection.connection.iterdump():
+                    dump.write(line.encode("utf8") + "\n")
+            else:
+                connection.close()
+                shutil.copyfileobj(open(settings.DATABASE_NAME, "rb"), dump)
+        finally:
+            dump.close()
+        os.rename(temp_path, path)
+        return True
+    
+    def load_test_template(self, fingerprint):
+        path = self._test_template_path(fingerprint)
+        if path is None or not is_private(path):
+            return False
+        if settings.DATABASE_NAME == ":memory:":
+            connection.cursor()
+            connection.connection.executescript(open(path, "rb").read().decode("utf8"))
+        else:
+            connection.close()
+            shutil.copyfile(path, settings.DATABASE_NAME)
+        return True
+    
+    def _can_alter_natively(self, table_name, alterations):
+        """
+        Returns True if this SQLite can do all the alterations with
+        ALTER TABLE ... RENAME COLUMN/DROP COLUMN. Changing a column's
+        definition, or dropping a primary key or UNIQUE column, still needs
+        a rebuild.
+        """
+        qn = connection.ops.quote_name
+        primary_key = [row[1] for row in self.execute("PRAGMA table_info(%s)" % qn(table_name)) if row[5]]
+        unique = []
+        for index in self.execute("PRAGMA index_list(%s)" % qn(table_name)):
+            if index[2]:
+                unique.extend([row[2] for row in self.execute("PRAGMA index_info(%s)" % qn(index[1]))])
+        for alteration in alterations:
+            if alteration[0] == "rename":
+                if not self.supports_rename_column:
+                    return False
+                old, new = alteration[1:]
+                primary_key = [c == old and new or c for c in primary_key]
+                unique = [c == old and new or c for c in unique]
+            elif alteration[0] == "delete":
+                if not self.supports_drop_column:
+                    return False
+                if alteration[1] in primary_key or alteration[1] in unique:
+                    return False
+            else:
+                return False
+        return True
+    
+    def _alter_natively(self, table_name, alterations):
+        qn = connection.ops.quote_name
+        for alteration in alterations:
+            if alteration[0] == "rename":
+                old, new = alteration[1:]
+                self.execute("ALTER TABLE %s RENAME COLUMN %s TO %s;" % (qn(table_name), qn(old), qn(new)))
+            else:
+                name = alteration[1]
+                # SQLite won't drop an indexed column, so drop its indexes first
+                for index in self.execute("PRAGMA index_list(%s)" % qn(table_name)):
+                    if name in [row[2] for row in self.execute("PRAGMA index_info(%s)" % qn(index[1]))]:
+                        self.execute("DROP INDEX %s;" % qn(index[1]))
+                self.execute("ALTER TABLE %s DROP COLUMN %s;" % (qn(table_name), qn(name)))
+    
+    def _rebuild_table(self, table_name, alterations):
+        """
+        Rebuilds the table with all the given alterations applied in one go,
+        keeping its indexes and unique constraints.
+        """
+        qn = connection.ops.quote_name
+        # Any indexes still held back need to be there for us to keep
+        self.execute_plan_deferred_sql(table_name)
+        # What's there now?
+        columns = SortedDict()
+        sources = {}
+        primary_key = []
+        for cid, name, type, notnull, default, pk in [row[:6] for row in self.execute("PRAGMA table_info(%s)" % qn(table_name))]:
+            definition = "%s %s %sNULL" % (qn(name), type, notnull and "NOT " or "")
+            if default is not None:
+                definition += " DEFAULT %s" % default
+            columns[name] = definition
+            sources[name] = name
+            if pk:
+                primary_key.append(name)
+        indexes = []
+        for index in self.execute("PRAGMA index_list(%s)" % qn(table_name)):
+            index_name, unique = index[1], index[2]
+            index_columns = [row[2] for row in self.execute("PRAGMA index_info(%s)" % qn(index_name))]
+            indexes.append((index_name, bool(unique), index_columns))
+        # Apply the alterations, in order
+        altered = {}
+        for alteration in alterations:
+            if alteration[0] == "rename":
+                old, new = alteration[1:]
+                if old not in columns:
+                    raise ValueError("No column '%s' in '%s'." % (old, table_name))
+                columns.insert(columns.keyOrder.index(old), new, columns.pop(old))
+                columns[new] = columns[new].replace(qn(old), qn(new), 1)
+                sources[new] = sources.pop(old)
+                primary_key = [c == old and new or c for c in primary_key]
+                if old in altered:
+                    altered[new] = altered.pop(old)
+                indexes = [(i, u, [c == old and new or c for c in cols]) for i, u, cols in indexes]
+            elif alteration[0] == "delete":
+                name = alteration[1]
+                if name not in columns:
+                    raise ValueError("No column '%s' in '%s'." % (name, table_name))
+                del columns[name]
+                del sources[name]
+                altered.pop(name, None)
+                primary_key = [c for c in primary_key if c != name]
+                indexes = [(i, u, cols) for i, u, cols in indexes if name not in cols]
+            else:
+                name, field = alteration[1:]
+                if name not in columns:
+                    raise ValueError("No column '%s' in '%s'." % (name, table_name))
+                altered[name] = field
+        # Altered columns get their new definitions; they bring their own
+        # PRIMARY KEY, UNIQUE and index, so forget the old ones.
+        for name, field in altered.items():
+            columns[name] = self.column_sql(table_name, name, field)
+            if not columns[name]:
+                # It's not a real column any more (e.g. an M2M)
+                del columns[name]
+                del sources[name]
+            primary_key = [c for c in primary_key if c != name]
+            own_index = self.create_index_name(table_name, [name])
+            indexes = [
+                (i, u, cols) for i, u, cols in indexes
+                if not (cols == [name] and (i == own_index or i.startswith("sqlite_autoindex_")))
+            ]
+        if len(primary_key) == 1:
+            columns[primary_key[0]] += " PRIMARY KEY"
+        definitions = columns.values()
+        if len(primary_key) > 1:
+            definitions.append("PRIMARY KEY (%s)" % ", ".join(map(qn, primary_key)))
+        # Now do the table dance
         temp_name = table_name + "_temporary_for_schema_change"
         self.rename_table(table_name, temp_name)
-        fields = [(fld.name, fld) for fld in model._meta.fields]
-        self.create_table(table_name, fields)
-        columns = [fld.column for name, fld in fields]
-        self.copy_data(temp_name, table_name, columns, field_renames)
+        self.execute("CREATE TABLE %s (%s);" % (qn(table_name), ", ".join(definitions)))
+        self.copy_data(temp_name, table_name, columns.keys(), dict([
+            (source, name) for name, source in sources.items() if source != name
+        ]))
         self.delete_table(temp_name, cascade=False)
-        model._already_run_alter_schema_trick = True
+        # And put the indexes back (the primary key's is made for us)
+        for index_name, unique, index_columns in indexes:
+            if index_name.startswith("sqlite_autoindex_"):
+                if index_columns == primary_key:
+                    continue
+                index_name = self.create_index_name(table_name, index_columns)
+            self.execute("CREATE %sINDEX %s ON %s (%s);" % (
+                unique and "UNIQUE " or "",
+                qn(index_name),
+                qn(table_name),
+                ", ".join(map(qn, index_columns)),
+            ))
     
     def alter_column(self, table_name, name, field, explicit_name=True):
-        self._alter_sqlite_table(table_name)
+        field.set_attributes_from_name(name)
+        if not explicit_name:
+            name = field.column
+        self._queue_alteration(table_name, ("alter", name, field))
 
     def delete_column(self, table_name, column_name):
-        self._alter_sqlite_table(table_name)
+        self.discard_plan_deferred_sql(table_name, column_name)
+        self._queue_alteration(table_name, ("delete", column_name))
     
     # Nor RENAME COLUMN
     def rename_column(self, table_name, old, new):
-        self._alter_sqlite_table(table_name, {old:new})
+        if old == new:
+            return
+        self._queue_alteration(table_name, ("rename", old, new))
     
     # Nor unique creation
     def create_unique(self, table_name, columns):
@@ -72,6 +414,6 @@ class DatabaseOperations(generic.DatabaseOperations):
         qn = connection.ops.quote_name
         q_fields = [qn(field) for field in fields]
         for key, value in field_renames.items():
-            q_fields[q_fields.index(value)] = "%s AS %s" % (qn(key), qn(value))
+            q_fields[q_fields.index(qn(value))] = "%s AS %s" % (qn(key), qn(value))
         sql = "INSERT INTO %s SELECT %s FROM %s;" % (qn(dst), ', '.join(q_fields), qn(src))
         self.execute(sql)
\ No newline at end of file
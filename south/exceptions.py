@@ -100,6 +100,35 @@ class DependsOnUnmigratedApplication(SouthError):
         return "Migration '%(migration)s' depends on unmigrated application '%(application)s'." % self.__dict__
 
 
+class DatabaseNotEmpty(SouthError):
+    def __init__(self, application, reason):
+        self.application = application
+        self.reason = reason
+
+    def __str__(self):
+        return "Can't bootstrap '%(application)s' on a database that already has %(reason)s." % self.__dict__
+
+
+class PartiallyAppliedSquash(SouthError):
+    def __init__(self, migration, applied):
+        self.migration = migration
+        self.applied = applied
+
+    def __str__(self):
+        return ("Only some of the migrations squashed into '%s' have been applied (%s).\n"
+                "Migrate this database past them with the original migrations first.") % (
+                    self.migration, ", ".join(sorted(self.applied)))
+
+
+class CannotSquash(SouthError):
+    def __init__(self, migration, reason):
+        self.migration = migration
+        self.reason = reason
+
+    def __str__(self):
+        return "Can't squash '%(migration)s': %(reason)s." % self.__dict__
+
+
 class FailedDryRun(SouthError):
     def __init__(self, migration, exc_info):
         self.migration = migration
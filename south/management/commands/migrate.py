@@ -11,6 +11,7 @@ from django.conf import settings
 from django.db import models
 
 from south import migration
+from south.db import db
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -28,6 +29,14 @@ class Command(BaseCommand):
             help="Pretends to do the migrations, but doesn't actually execute them."),
         make_option('--db-dry-run', action='store_true', dest='db_dry_run', default=False,
             help="Doesn't execute the SQL generated by the db methods, and doesn't store a record that the migration(s) occurred. Useful to test migrations before applying them."),
+        make_option('--defer-indexes', action='store_true', dest='defer_indexes', default=False,
+            help='Creates indexes and foreign keys once, after all the migrations have run, rather than after each one.'),
+        make_option('--validate-constraints', action='store_true', dest='validate_constraints', default=False,
+            help='Validates the foreign keys added as NOT VALID once the migrations have run (see SOUTH_NOT_VALID_FOREIGN_KEYS); SOUTH_VALIDATE_CONSTRAINTS = True does this every time.'),
+        make_option('--bootstrap', action='store_true', dest='bootstrap', default=False,
+            help="Creates an empty database's tables straight from the latest migrations' frozen models and marks them all as applied, only running migrations with bootstrap = True."),
+        make_option('--single-transaction', action='store_true', dest='single_transaction', default=False,
+            help='Runs all the migrations in one transaction, with the database tuned for bulk changes (SQLite only).'),
     )
     if '--verbosity' not in [opt.get_opt_string() for opt in BaseCommand.option_list]:
         option_list += (
@@ -36,7 +45,7 @@ class Command(BaseCommand):
             help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'),
         )
     help = "Runs migrations for all apps."
-    args = "[appname] [migrationname|zero] [--all] [--list] [--skip] [--merge] [--no-initial-data] [--fake] [--db-dry-run]"
+    args = "[appname] [migrationname|zero] [--all] [--list] [--skip] [--merge] [--no-initial-data] [--fake] [--db-dry-run] [--defer-indexes] [--validate-constraints] [--bootstrap] [--single-transaction]"
 
     def handle(self, app=None, target=None, skip=False, merge=False, backwards=False, fake=False, db_dry_run=False, list=False, **options):
 
@@ -76,20 +85,49 @@ class Command(BaseCommand):
         if list and apps:
             list_migrations(apps)
         
+        if options.get('bootstrap', False) and not list:
+            if target:
+                print "You can't bootstrap to a particular migration; it always goes to the latest one."
+                return
+            migration.bootstrap(apps, verbosity=int(options.get('verbosity', 0)))
+            return
+        
         if not list:
-            for app in apps:
-                result = migration.migrate_app(
-                    app,
-                    resolve_mode = resolve_mode,
-                    target_name = target,
-                    fake = fake,
-                    db_dry_run = db_dry_run,
-                    verbosity = int(options.get('verbosity', 0)),
-                    load_initial_data = not options.get('no_initial_data', False),
-                    skip = skip,
-                )
-                if result is False:
-                    return
+            db.defer_indexes = options.get('defer_indexes', False)
+            if options.get('single_transaction', False) and not db_dry_run:
+                db.start_plan_transaction()
+            success = False
+            try:
+                for app in apps:
+                    result = migration.migrate_app(
+                        app,
+                        resolve_mode = resolve_mode,
+                        target_name = target,
+                        fake = fake,
+                        db_dry_run = db_dry_run,
+                        verbosity = int(options.get('verbosity', 0)),
+                        load_initial_data = not options.get('no_initial_data', False),
+                        skip = skip,
+                    )
+                    if result is False:
+                        return
+                migration.execute_plan_deferred_sql(verbosity=int(options.get('verbosity', 0)))
+                success = True
+            finally:
+                db.defer_indexes = False
+                plan_initial_data, db.plan_initial_data = db.plan_initial_data, []
+                if not success:
+                    migration.abandon_plan_deferred_sql()
+                if db.plan_transaction:
+                    db.finish_plan_transaction(success)
+            
+            # Initial data held back by --single-transaction goes in now
+            for app_name in plan_initial_data:
+                migration.load_initial_data(app_name, verbosity=int(options.get('verbosity', 0)))
+            
+            validate = options.get('validate_constraints', False) or getattr(settings, "SOUTH_VALIDATE_CONSTRAINTS", False)
+            if validate and not db_dry_run:
+                migration.validate_constraints(verbosity=int(options.get('verbosity', 0)))
 
 
 def list_migrations(apps):
@@ -0,0 +1,172 @@
+"""
+Squashmigrations command; folds a run of an app's migrations into one.
+"""
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.db.models.base import ModelBase
+
+from south import exceptions, modelsinspector
+from south.migration.base import Migrations
+from south.migration.squash import squash
+from south.orm import FakeORM
+from south.management.commands.startmigration import (
+    FIELD_NEEDS_DEF_SNIPPET, MIGRATION_SNIPPET,
+    make_field_constructor, pprint_frozen_models, remove_useless_attributes,
+)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--stdout', action='store_true', dest='stdout', default=False,
+            help='Print the migration to stdout instead of writing it to a file.'),
+    )
+    help = "Squashes a run of an app's migrations into a single migration."
+    usage_str = "Usage: ./manage.py squashmigrations appname start_migration end_migration [--stdout]"
+
+    def handle(self, app=None, start=None, end=None, stdout=False, **options):
+
+        if not (app and start and end):
+            print self.usage_str
+            return
+
+        # Find the migrations to squash
+        app = app.split(".")[-1]
+        try:
+            migrations = Migrations(app)
+        except exceptions.NoMigrations:
+            print "The app '%s' does not appear to use migrations." % app
+            return
+        start, end = migrations.guess_migration(start), migrations.guess_migration(end)
+        to_squash = migrations[migrations.index(start):migrations.index(end) + 1]
+        if len(to_squash) < 2:
+            print "There's nothing to squash between %s and %s." % (start.name(), end.name())
+            return
+
+        try:
+            forwards, backwards = squash(to_squash)
+        except exceptions.CannotSquash, e:
+            print e
+            return
+
+        # The squash takes over the history of everything it replaces
+        replaces = []
+        depends_on = []
+        for migration in to_squash:
+            replaces.extend(migration.replaces() or [migration.name()])
+            for dependency in getattr(migration.migration_class(), "depends_on", []):
+                if dependency[0] != app and tuple(dependency) not in depends_on:
+                    depends_on.append(tuple(dependency))
+        extras = ["replaces = %r" % replaces]
+        if depends_on:
+            extras.append("depends_on = %r" % (tuple(depends_on),))
+        end_class = end.migration_class()
+        if getattr(end_class, "complete_apps", None):
+            extras.append("complete_apps = %r" % (list(end_class.complete_apps),))
+        if getattr(end_class, "schema_fingerprint", None):
+            extras.append("schema_fingerprint = %r" % end_class.schema_fingerprint)
+
+        renderer = OperationRenderer(app, FakeORM(end_class, app))
+        forwards, backwards = renderer.render(forwards), renderer.render(backwards)
+        file_contents = MIGRATION_SNIPPET % (
+            "".join(["import %s\n" % module for module in sorted(renderer.imports)]),
+            migrations.full_name().rsplit(".", 1)[0],
+            forwards,
+            backwards,
+            pprint_frozen_models(getattr(end_class, "models", {})),
+            "\n    ".join(extras),
+        )
+
+        if stdout:
+            print file_contents
+            return
+        new_filename = "%s%s%s.py" % (start.name().split("_")[0], migrations.SQUASHED_NAME, end.name())
+        fp = open(os.path.join(migrations.dirname(), new_filename), "w")
+        fp.write(file_contents)
+        fp.close()
+        print "Created %s, replacing %s migrations." % (new_filename, len(replaces))
+        print "The originals are ignored from now on; delete them once no database is part way through them."
+
+
+class OperationRenderer(object):
+    """
+    Turns Operations back into migration code. Fields that are still in the
+    final frozen models refer to them through the ORM; others get written out
+    in full, noting down anything that needs importing.
+    """
+
+    def __init__(self, app, orm):
+        self.app = app
+        self.imports = set()
+        # db_table -> (model key, model) for the final frozen models
+        self.tables = dict([
+            (model._meta.db_table, (key, model))
+            for key, model in orm.models.items()
+        ])
+
+    def render_field(self, table_name, name, field):
+        "Returns the code that makes the given field."
+        triple = modelsinspector.get_field_triple(field)
+        if triple is None:
+            print "WARNING: Cannot get definition for the field '%s'. Please edit the migration manually to define it, or add the south_field_triple method to it." % field.name
+            return FIELD_NEEDS_DEF_SNIPPET
+        triple = remove_useless_attributes(triple)
+        # Is it just what's frozen?
+        if table_name in self.tables:
+            key, model = self.tables[table_name]
+            for frozen_field in model._meta.local_fields:
+                if frozen_field.name == name and \
+                   remove_useless_attributes(modelsinspector.get_field_triple(frozen_field)) == triple:
+                    return "orm[%r]" % ("%s:%s" % (key, name))
+        # Write it out, then
+        module, class_name = triple[0].rsplit(".", 1)
+        if module.startswith("django.db.models"):
+            class_path = "models." + class_name
+        else:
+            self.imports.add(module)
+            class_path = triple[0]
+        args, kwargs = list(triple[1]), dict(triple[2])
+        rel_to = getattr(getattr(field, "rel", None), "to", None)
+        if rel_to is not None and not isinstance(rel_to, ModelBase):
+            # It points at a db.mock_model, so make another just like it
+            pk = rel_to._meta.pk
+            mock = "db.mock_model(model_name=%r, db_table=%r, db_tablespace=%r, pk_field_name=%r, pk_field_type=models.%s)" % (
+                rel_to._meta.object_name,
+                rel_to._meta.db_table,
+                rel_to._meta.db_tablespace,
+                pk.name,
+                pk.__class__.__name__,
+            )
+            if "to" in kwargs:
+                kwargs["to"] = mock
+            else:
+                args[0] = mock
+            field = None
+        return make_field_constructor(self.app, field, (class_path, args, kwargs))
+
+    def render(self, operations):
+        "Returns the code for a migration direction that runs the operations."
+        if not operations:
+            return "pass"
+        lines = []
+        for operation in operations:
+            args, kwargs = operation.arguments()
+            if operation.name == "create_table":
+                lines.append("db.create_table(%r, (\n%s\n        ))" % (args[0], "\n".join([
+                    "            (%r, %s)," % (name, self.render_field(args[0], name, field))
+                    for name, field in args[1]
+                ])))
+                continue
+            arguments = []
+            for arg in args:
+                if isinstance(arg, models.Field):
+                    arguments.append(self.render_field(args[0], args[1], arg))
+                else:
+                    arguments.append(repr(arg))
+            for name, value in sorted(kwargs.items()):
+                arguments.append("%s=%r" % (name, value))
+            lines.append("db.%s(%s)" % (operation.name, ", ".join(arguments)))
+        return "\n        ".join(lines)
@@ -5,11 +5,16 @@ Startmigration command, version 2.
 import sys
 import os
 import re
+import ast
 import string
 import random
 import inspect
 import parser
 from optparse import make_option
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
 
 from django.core.management.base import BaseCommand
 from django.core.management.color import no_style
@@ -17,6 +22,7 @@ from django.db import models
 from django.db.models.fields.related import RECURSIVE_RELATIONSHIP_CONSTANT
 from django.contrib.contenttypes.generic import GenericRelation
 from django.db.models.fields import FieldDoesNotExist
+from django.utils.datastructures import SortedDict
 from django.conf import settings
 
 try:
@@ -24,7 +30,8 @@ try:
 except NameError:
     from sets import Set as set
 
-from south import migration, modelsinspector
+from south import exceptions, modelsinspector
+from south.migration.base import Migrations
 
 
 class Command(BaseCommand):
@@ -41,18 +48,44 @@ class Command(BaseCommand):
             help='Freeze the specified model(s). Pass in either an app name (to freeze the whole app) or a single model, as appname.modelname.'),
         make_option('--stdout', action='store_true', dest='stdout', default=False,
             help='Print the migration to stdout instead of writing it to a file.'),
+        make_option('--all', action='store_true', dest='all_apps', default=False,
+            help='With --auto, make a migration for every migrated app that has changed.'),
+        make_option('--check', action='store_true', dest='check', default=False,
+            help='Exit with an error if any (or the given) app has changed since its last migration, without writing anything.'),
     )
     help = "Creates a new template migration for the given app"
-    usage_str = "Usage: ./manage.py startmigration appname migrationname [--initial] [--auto] [--model ModelName] [--add-field ModelName.field_name] [--freeze] [--stdout]"
+    usage_str = "Usage: ./manage.py startmigration appname migrationname [--initial] [--auto] [--model ModelName] [--add-field ModelName.field_name] [--freeze] [--stdout]\n       ./manage.py startmigration --all migrationname --auto [--freeze] [--stdout]\n       ./manage.py startmigration [appname] --check"
     
-    def handle(self, app=None, name="", added_model_list=None, added_field_list=None, initial=False, freeze_list=None, auto=False, stdout=False, **options):
+    def handle(self, app=None, name="", added_model_list=None, added_field_list=None, initial=False, freeze_list=None, auto=False, stdout=False, all_apps=False, check=False, **options):
         
         # Any supposed lists that are None become empty lists
         added_model_list = added_model_list or []
         added_field_list = added_field_list or []
         
-        # --stdout means name = -
-        if stdout:
+        # Everything frozen this run gets remembered, so it's only done once
+        self.freezer = FreezeContext()
+        
+        if check:
+            if name or added_model_list or added_field_list or initial or auto or all_apps or stdout:
+                print "You cannot use --check and other options together"
+                print self.usage_str
+                return
+            return self.check_apps(app and [app.split(".")[-1]] or None)
+        
+        if all_apps:
+            # There's no app, so the only argument is the name
+            if app and name:
+                print "You cannot name an app and use --all together"
+                print self.usage_str
+                return
+            name, app = name or app, None
+            if not auto:
+                print "You can only use --all with --auto"
+                print self.usage_str
+                return
+        
+        # --stdout means name = - (though --all needs the name for depends_on)
+        if stdout and not all_apps:
             name = "-"
         
         # Make sure options are compatable
@@ -76,11 +109,82 @@ class Command(BaseCommand):
             print self.usage_str
             return
         
+        if all_apps:
+            return self.make_all_migrations(name, freeze_list, stdout)
+        
         if not app:
             print "Please provide an app in which to create the migration."
             print self.usage_str
             return
         
+        return self.make_migration(app, name, added_model_list, added_field_list, initial, freeze_list, auto)
+    
+    def check_apps(self, apps=None):
+        """
+        Makes sure the apps (or every migrated app) have no changes their
+        migrations are missing, exiting with an error if they do.
+        """
+        if apps is None:
+            apps = migrated_apps()
+        unmigrated = []
+        for app in apps:
+            changes = auto_changes(app, self.freezer)
+            if changes is None or filter(None, changes):
+                unmigrated.append(app)
+        if unmigrated:
+            print "These apps have changes their migrations are missing: %s" % ", ".join(unmigrated)
+            sys.exit(1)
+        print "Nothing seems to have changed."
+    
+    def make_all_migrations(self, name, freeze_list=None, stdout=False):
+        """
+        Detects the changes to every migrated app in one go, then writes a
+        migration for each app that changed, depending on the new (or
+        latest) migrations of the other apps whose models it refers to.
+        """
+        apps = migrated_apps()
+        
+        # What's changed where
+        changes = {}
+        for app in apps:
+            app_changes = auto_changes(app, self.freezer)
+            if app_changes and filter(None, app_changes):
+                changes[app] = app_changes
+        if not changes:
+            print "Nothing seems to have changed."
+            return
+        
+        # Which migration each app will depend on in the others
+        latest = {}
+        existing = {}
+        for app in apps:
+            if Migrations(app):
+                existing[app] = latest[app] = Migrations(app)[-1].name()
+            if app in changes:
+                latest[app] = next_filename(Migrations(app).dirname(), name)[:-3]
+        order, depends_on, unordered = plan_dependencies(
+            dict([(app, changes_references(app, changes[app], self.freezer)) for app in changes]),
+            dict([(app, changes[app][0]) for app in changes]),
+            latest,
+            existing,
+        )
+        for app, other in unordered:
+            print " ! The new migrations for '%s' and '%s' refer to each other's new models; '%s' won't depend on '%s', so check they run in the right order." % (app, other, app, other)
+        
+        for app in order:
+            print "Migrating '%s':" % app
+            self.make_migration(app, stdout and "-" or name, freeze_list=freeze_list, auto=True,
+                                changes=changes[app], depends_on=depends_on[app])
+    
+    def make_migration(self, app, name, added_model_list=None, added_field_list=None, initial=False, freeze_list=None, auto=False, changes=None, depends_on=()):
+        """
+        Writes a migration for the app; 'changes' can hold what auto_changes
+        has already found, and 'depends_on' migrations in other apps.
+        """
+        added_model_list = added_model_list or []
+        added_field_list = added_field_list or []
+        freeze_list = list(freeze_list or [])
+        
         # Make sure the app is short form
         app = app.split(".")[-1]
         
@@ -122,22 +226,8 @@ class Command(BaseCommand):
             print "Creating __init__.py in '%s'..." % migrations_dir
             open(init_path, "w").close()
         
-        # See what filename is next in line. We assume they use numbers.
-        migrations = migration.get_migration_names(migration.get_app(app))
-        highest_number = 0
-        for migration_name in migrations:
-            try:
-                number = int(migration_name.split("_")[0])
-                highest_number = max(highest_number, number)
-            except ValueError:
-                pass
-        
-        # Make the new filename
-        new_filename = "%04i%s_%s.py" % (
-            highest_number + 1,
-            "".join([random.choice(string.letters.lower()) for i in range(0)]), # Possible random stuff insertion
-            name,
-        )
+        # See what filename is next in line.
+        new_filename = next_filename(migrations_dir, name)
         
         # Find the source file encoding, using PEP 0263's method
         encoding = None
@@ -200,89 +290,30 @@ class Command(BaseCommand):
                     complete_apps.add(item.split(".")[-1])
             # For every model in the freeze list, add in frozen dependencies
             for model in list(frozen_models):
-                frozen_models.update(model_dependencies(model))
+                frozen_models.update(self.freezer.model_dependencies(model))
         
         
         ### Automatic Detection ###
         if auto:
-            # Get the last migration for this app
-            last_models = None
-            app_module = migration.Migrations.from_name(app)
-            if app_module is None:
-                print "You cannot use automatic detection on the first migration of an app. Try --initial instead."
-            else:
-                migrations = list(migration.get_migration_classes(app_module))
-                if not migrations:
-                    print "You cannot use automatic detection on the first migration of an app. Try --initial instead."
-                else:
-                    if hasattr(migrations[-1], "complete_apps") and \
-                       app in migrations[-1].complete_apps:
-                        last_models = migrations[-1].models
-                        last_orm = migrations[-1].orm
-                    else:
-                        print "You cannot use automatic detection, since the previous migration does not have this whole app frozen.\nEither make migrations using '--freeze %s' or set 'SOUTH_AUTO_FREEZE_APP = True' in your settings.py." % app
-            
+            if changes is None:
+                changes = auto_changes(app, self.freezer)
             # Right, did we manage to get the last set of models?
-            if last_models is None:
+            if changes is None:
                 print self.usage_str
                 return
-            
-            # Good! Get new things.
-            new = dict([
-                (model_key(model), prep_for_freeze(model))
-                for model in models.get_models(app_models_module)
-            ])
-            # And filter other apps out of the old
-            old = dict([
-                (key, fields)
-                for key, fields in last_models.items()
-                if key.split(".", 1)[0] == app
-            ])
-            am, dm, cm, af, df, cf, afu, dfu = models_diff(old, new)
-            
-            # For models that were there before and after, do a meta diff
-            was_meta_change = False
-            for mkey in cm:
-                au, du = meta_diff(old[mkey].get("Meta", {}), new[mkey].get("Meta", {}))
-                for entry in au:
-                    added_uniques.add((mkey, entry))
-                    was_meta_change = True
-                for entry in du:
-                    deleted_uniques.add((mkey, entry, last_orm[mkey]))
-                    was_meta_change = True
-            
-            if not (am or dm or af or df or cf or afu or dfu or was_meta_change):
+            if not filter(None, changes):
                 print "Nothing seems to have changed."
                 return
             
             # Add items to the todo lists
+            am, dm, af, df, cf, au, du = changes
             added_models.update(am)
+            deleted_models.extend(dm)
             added_fields.update(af)
+            deleted_fields.extend(df)
             changed_fields.extend(cf)
-            
-            # Deleted models are from the past, and so we use instances instead.
-            for mkey in dm:
-                model = last_orm[mkey]
-                fields = last_models[mkey]
-                if "Meta" in fields:
-                    del fields['Meta']
-                deleted_models.append((model, fields, last_models))
-            
-            # For deleted fields, we tag the instance on the end too
-            for mkey, fname in df:
-                deleted_fields.append((
-                    mkey,
-                    fname,
-                    last_orm[mkey]._meta.get_field_by_name(fname)[0],
-                    last_models[mkey][fname],
-                    last_models,
-                ))
-            
-            # Uniques need merging
-            added_uniques = added_uniques.union(afu)
-            
-            for mkey, entry in dfu:
-                deleted_uniques.add((mkey, entry, last_orm[mkey]))
+            added_uniques.update(au)
+            deleted_uniques.update(du)
         
         
         ### Added model ###
@@ -293,9 +324,9 @@ class Command(BaseCommand):
             model = model_unkey(mkey)
             
             # Add the model's dependencies to the frozens
-            frozen_models.update(model_dependencies(model))
+            frozen_models.update(self.freezer.model_dependencies(model))
             # Get the field definitions
-            fields = modelsinspector.get_model_fields(model)
+            fields = self.freezer.model_fields(model)
             # Turn the (class, args, kwargs) format into a string
             fields = triples_to_defs(app, model, fields)
             # Make the code
@@ -366,7 +397,7 @@ class Command(BaseCommand):
             
             # Work out the definition
             triple = remove_useless_attributes(
-                modelsinspector.get_model_fields(model)[field_name])
+                self.freezer.model_fields(model)[field_name])
             
             field_definition = make_field_constructor(app, field, triple)
             
@@ -448,7 +479,7 @@ class Command(BaseCommand):
             print " - Deleted model '%s.%s'" % (model._meta.app_label,model._meta.object_name)
             
             # Add the model's dependencies to the frozens
-            deps = model_dependencies(model, last_models)
+            deps = self.freezer.model_dependencies(model, last_models)
             deps.update(frozen_models)
             frozen_models = deps
             
@@ -571,7 +602,15 @@ class Command(BaseCommand):
         
         # Fill out frozen model definitions
         for model, last_models in frozen_models.items():
-            all_models[model_key(model)] = prep_for_freeze(model, last_models)
+            all_models[model_key(model)] = self.freezer.prep_for_freeze(model, last_models)
+        
+        # Note down what the app's models look like, for quick checks next time
+        if app in complete_apps:
+            fingerprint = schema_fingerprint(dict([
+                (key, fields)
+                for key, fields in all_models.items()
+                if key.split(".", 1)[0] == app
+            ]))
         
         # Do some model cleanup, and warnings
         for modelname, model in all_models.items():
@@ -587,13 +626,22 @@ class Command(BaseCommand):
                     )
                     model[fieldname] = FIELD_NEEDS_DEF_SNIPPET
         
+        # Other apps' migrations this one needs first
+        extras = []
+        if depends_on:
+            extras.append("depends_on = %r" % (tuple(map(tuple, depends_on)),))
+        if complete_apps:
+            extras.append("complete_apps = [%s]" % (", ".join(map(repr, complete_apps))))
+        if app in complete_apps:
+            extras.append("schema_fingerprint = %r" % fingerprint)
+        
         # So, what's in this file, then?
         file_contents = MIGRATION_SNIPPET % (
             encoding or "", '.'.join(app_module_path), 
             forwards, 
             backwards, 
             pprint_frozen_models(all_models),
-            complete_apps and "complete_apps = [%s]" % (", ".join(map(repr, complete_apps))) or ""
+            "\n    ".join(extras)
         )
         # - is a special name which means 'print to stdout'
         if name == "-":
@@ -606,6 +654,193 @@ class Command(BaseCommand):
             print "Created %s." % new_filename
 
 
+### Automatic detection
+
+def migrated_apps():
+    "Returns the labels of all the apps with migrations."
+    apps = []
+    for app_models_module in models.get_apps():
+        app = app_models_module.__name__.split(".")[-2]
+        try:
+            Migrations(app)
+        except exceptions.NoMigrations:
+            continue
+        apps.append(app)
+    return apps
+
+
+def auto_changes(app, freezer):
+    """
+    Works out what's changed in the app's models since its last migration.
+    Returns (added_models, deleted_models, added_fields, deleted_fields,
+    changed_fields, added_uniques, deleted_uniques), or None (having said
+    why) if there's no last migration to compare against.
+    """
+    # Get the last migration for this app
+    try:
+        migrations = Migrations(app)
+    except exceptions.NoMigrations:
+        migrations = []
+    if not migrations:
+        print "You cannot use automatic detection on the first migration of an app. Try --initial instead."
+        return None
+    last_migration = migrations[-1]
+    if app not in getattr(last_migration.migration_class(), "complete_apps", []):
+        print "You cannot use automatic detection, since the previous migration does not have this whole app frozen.\nEither make migrations using '--freeze %s' or set 'SOUTH_AUTO_FREEZE_APP = True' in your settings.py." % app
+        return None
+    
+    # Good! Get new things.
+    new = dict([
+        (model_key(model), freezer.prep_for_freeze(model))
+        for model in models.get_models(models.get_app(app))
+    ])
+    
+    # If they look just like they did last time, there's no need to diff
+    last_fingerprint = getattr(last_migration.migration_class(), "schema_fingerprint", None)
+    if last_fingerprint is not None and last_fingerprint == schema_fingerprint(new):
+        return (set(), [], set(), [], [], set(), set())
+    
+    last_models = last_migration.migration_class().models
+    last_orm = last_migration.orm()
+    # And filter other apps out of the old
+    old = dict([
+        (key, fields)
+        for key, fields in last_models.items()
+        if key.split(".", 1)[0] == app
+    ])
+    am, dm, cm, af, df, cf, afu, dfu = models_diff(old, new)
+    
+    added_uniques = set(afu)
+    deleted_uniques = set([(mkey, entry, last_orm[mkey]) for mkey, entry in dfu])
+    
+    # For models that were there before and after, do a meta diff
+    for mkey in cm:
+        au, du = meta_diff(old[mkey].get("Meta", {}), new[mkey].get("Meta", {}))
+        for entry in au:
+            added_uniques.add((mkey, entry))
+        for entry in du:
+            deleted_uniques.add((mkey, entry, last_orm[mkey]))
+    
+    # Deleted models are from the past, and so we use instances instead.
+    deleted_models = []
+    for mkey in dm:
+        model = last_orm[mkey]
+        fields = dict(last_models[mkey])
+        if "Meta" in fields:
+            del fields['Meta']
+        deleted_models.append((model, fields, last_models))
+    
+    # For deleted fields, we tag the instance on the end too
+    deleted_fields = []
+    for mkey, fname in df:
+        deleted_fields.append((
+            mkey,
+            fname,
+            last_orm[mkey]._meta.get_field_by_name(fname)[0],
+            last_models[mkey][fname],
+            last_models,
+        ))
+    
+    return (set(am), deleted_models, set(af), deleted_fields, list(cf), added_uniques, deleted_uniques)
+
+
+def changes_references(app, changes, freezer):
+    """
+    Returns the keys of the models in other apps that the changes (as from
+    auto_changes) add references to.
+    """
+    added_models, deleted_models, added_fields, deleted_fields, changed_fields = changes[:5]
+    depends = set()
+    for mkey in added_models:
+        depends.update(freezer.field_dependencies(model_unkey(mkey)))
+    for mkey, field_name in added_fields:
+        depends.update(field_dependencies(model_unkey(mkey)._meta.get_field_by_name(field_name)[0]))
+    for mkey, field_name, old_triple, new_triple in changed_fields:
+        depends.update(field_dependencies(model_unkey(mkey)._meta.get_field_by_name(field_name)[0]))
+    return set([model_key(model) for model in depends if model._meta.app_label != app])
+
+
+def plan_dependencies(references, added_models, latest, existing):
+    """
+    Works out which other apps' migrations each app's new migration should
+    depend on. 'references' is {app: keys of the models in other apps its
+    changes refer to}, 'added_models' {app: keys of the models its new
+    migration adds}, 'latest' {app: the migration it'll be at} and
+    'existing' {app: its last migration already written}.
+    Returns the order to write the migrations in, {app: [(other app,
+    migration)]}, and the (app, other) pairs left unordered because each
+    refers to models the other's new migration adds.
+    """
+    needs = dict([
+        (app, sorted(set([key.split(".")[0] for key in keys]) & set(latest)))
+        for app, keys in references.items()
+    ])
+    order, dropped = dependency_order(needs)
+    depends_on = dict([
+        (app, dict([(other, latest[other]) for other in others]))
+        for app, others in needs.items()
+    ])
+    unordered = []
+    for app, other in dropped:
+        new_models = [
+            key for key in references[app]
+            if key.split(".")[0] == other and key in added_models.get(other, ())
+        ]
+        if other in existing and not new_models:
+            # What it refers to is there already, before other's new migration
+            depends_on[app][other] = existing[other]
+        else:
+            del depends_on[app][other]
+            unordered.append((app, other))
+    return order, dict([(app, sorted(others.items())) for app, others in depends_on.items()]), unordered
+
+
+def dependency_order(needs):
+    """
+    Given a dict of app: [apps it needs first], returns the apps in an
+    order that satisfies it, and a list of the (app, needed) pairs that had
+    to be ignored to break loops.
+    """
+    order = []
+    dropped = []
+    visiting = []
+    def visit(app):
+        if app in order:
+            return
+        visiting.append(app)
+        for other in needs[app]:
+            if other not in needs:
+                continue
+            if other in visiting:
+                dropped.append((app, other))
+            else:
+                visit(other)
+        visiting.pop()
+        order.append(app)
+    for app in sorted(needs):
+        visit(app)
+    return order, dropped
+
+
+def next_filename(migrations_dir, name):
+    "Returns the filename the next migration in the directory should have."
+    # We assume they use numbers.
+    highest_number = 0
+    for filename in os.listdir(migrations_dir):
+        if not filename.endswith(".py"):
+            continue
+        try:
+            number = int(filename.split("_")[0])
+            highest_number = max(highest_number, number)
+        except ValueError:
+            pass
+    return "%04i%s_%s.py" % (
+        highest_number + 1,
+        "".join([random.choice(string.letters.lower()) for i in range(0)]), # Possible random stuff insertion
+        name,
+    )
+
+
 ### Cleaning functions for freezing
 
 
@@ -628,28 +863,121 @@ def ormise_triple(field, triple):
 
 
 def prep_for_freeze(model, last_models=None):
-    # If we have a set of models to use, use them.
-    if last_models:
-        fields = last_models[model_key(model)]
-    else:
-        fields = modelsinspector.get_model_fields(model, m2m=True)
-    # Remove _stub if it stuck in
-    if "_stub" in fields:
-        del fields["_stub"]
-    # Remove useless attributes (like 'choices')
-    for name, field in fields.items():
-        if name == "Meta":
+    "Returns the model's frozen definition; see FreezeContext.prep_for_freeze."
+    return FreezeContext().prep_for_freeze(model, last_models)
+
+
+def copy_fields(fields, exclude=()):
+    """
+    Copies a dict of frozen fields (and maybe a Meta) deeply enough that
+    cleaning up the copy leaves the original alone.
+    """
+    result = SortedDict()
+    for name, value in fields.items():
+        if name in exclude:
             continue
-        real_field = model._meta.get_field_by_name(name)[0]
-        fields[name] = ormise_triple(real_field, remove_useless_attributes(field))
-    # See if there's a Meta
-    if last_models:
-        meta = last_models[model_key(model)].get("Meta", {})
-    else:
-        meta = modelsinspector.get_model_meta(model)
-    if meta:
-        fields['Meta'] = remove_useless_meta(meta)
-    return fields
+        if name == "Meta":
+            result[name] = dict(value)
+        elif is_triple(value):
+            result[name] = type(value)((value[0], list(value[1]), dict(value[2])))
+        else:
+            result[name] = value
+    return result
+
+
+class FreezeContext(object):
+    """
+    Remembers, for one run of the command, each model's introspected
+    fields, its frozen definition and the models it depends on, so each is
+    only worked out once however often it's needed. Fields and definitions
+    are handed out as copies, so they can be cleaned up as callers like.
+    """
+    
+    def __init__(self):
+        self.fields = {} # model -> introspected fields, M2Ms included
+        self.frozen = {} # model -> frozen definition
+        self.direct_dependencies = {} # model -> models its fields refer to
+        self.dependencies = {} # model -> every model it needs, transitively
+    
+    def model_fields(self, model, m2m=False):
+        "Returns the model's {field_name: field_triple} defs."
+        if model not in self.fields:
+            self.fields[model] = modelsinspector.get_model_fields(model, m2m=True)
+        if m2m:
+            return copy_fields(self.fields[model])
+        return copy_fields(self.fields[model], [field.name for field in model._meta.local_many_to_many])
+    
+    def prep_for_freeze(self, model, last_models=None):
+        """
+        Returns the model's definition cleaned up for freezing; from
+        last_models if they're given, otherwise from the model as it is now.
+        """
+        # If we have a set of models to use, use them.
+        if last_models:
+            return self.clean(model, copy_fields(last_models[model_key(model)]))
+        if model not in self.frozen:
+            fields = self.model_fields(model, m2m=True)
+            meta = modelsinspector.get_model_meta(model)
+            if meta:
+                fields['Meta'] = meta
+            self.frozen[model] = self.clean(model, fields)
+        return copy_fields(self.frozen[model])
+    
+    def clean(self, model, fields):
+        "Removes anything useless from the fields and Meta, in place."
+        # Remove _stub if it stuck in
+        if "_stub" in fields:
+            del fields["_stub"]
+        # Remove useless attributes (like 'choices')
+        for name, field in fields.items():
+            if name == "Meta":
+                continue
+            real_field = model._meta.get_field_by_name(name)[0]
+            fields[name] = ormise_triple(real_field, remove_useless_attributes(field))
+        if fields.get("Meta"):
+            fields['Meta'] = remove_useless_meta(fields['Meta'])
+        return fields
+    
+    def model_dependencies(self, model, last_models=None):
+        """
+        Returns a {model: last_models} dict of the models this one depends
+        on to be defined; things like OneToOneFields as ID, ForeignKeys
+        everywhere, etc., followed all the way through.
+        """
+        return dict([
+            (dependency, last_models)
+            for dependency in self.dependency_closure(model)
+        ])
+    
+    def dependency_closure(self, model):
+        "Returns the set of models reachable through the model's relations."
+        if model not in self.dependencies:
+            closure = set()
+            checked = set()
+            to_check = [model]
+            while to_check:
+                checked_model = to_check.pop()
+                if checked_model in checked:
+                    continue
+                checked.add(checked_model)
+                # If we've been all the way through it before, that'll do
+                if checked_model is not model and checked_model in self.dependencies:
+                    closure.update(self.dependencies[checked_model])
+                    continue
+                for dependency in self.field_dependencies(checked_model):
+                    closure.add(dependency)
+                    to_check.append(dependency)
+            self.dependencies[model] = closure
+        return self.dependencies[model]
+    
+    def field_dependencies(self, model):
+        "Returns the set of models the model's own fields refer to."
+        if model not in self.direct_dependencies:
+            depends = set()
+            for field in model._meta.fields + model._meta.many_to_many:
+                depends.update(field_dependencies(field))
+            self.direct_dependencies[model] = depends
+        return self.direct_dependencies[model]
 
 
 ### Module handling functions
@@ -669,31 +997,9 @@ def model_unkey(key):
 
 ### Dependency resolvers
 
-def model_dependencies(model, last_models=None, checked_models=None):
-    """
-    Returns a set of models this one depends on to be defined; things like
-    OneToOneFields as ID, ForeignKeys everywhere, etc.
-    """
-    depends = {}
-    checked_models = checked_models or set()
-    # Get deps for each field
-    for field in model._meta.fields + model._meta.many_to_many:
-        depends.update(field_dependencies(field, last_models))
-    # Now recurse
-    new_to_check = set(depends.keys()) - checked_models
-    while new_to_check:
-        checked_model = new_to_check.pop()
-        if checked_model == model or checked_model in checked_models:
-            continue
-        checked_models.add(checked_model)
-        deps = model_dependencies(checked_model, last_models, checked_models)
-        # Loop through dependencies...
-        for dep, value in deps.items():
-            # If the new dep is not already checked, add to the queue
-            if (dep not in depends) and (dep not in new_to_check) and (dep not in checked_models):
-                new_to_check.add(dep)
-            depends[dep] = value
-    return depends
+def model_dependencies(model, last_models=None):
+    "Returns the models this one depends on; see FreezeContext.model_dependencies."
+    return FreezeContext().model_dependencies(model, last_models)
 
 
 def field_dependencies(field, last_models=None, checked_models=None):
@@ -809,6 +1115,88 @@ def poss_ormise(default_app, rel_to, arg):
 
 ### Diffing functions between sets of models
 
+### Normalised, hashable forms of frozen definitions, for quick diffing
+
+ORM_REFERENCE = re.compile(r"""^orm\[(['"])([\w.]+)\1\]$""")
+
+def freeze_literal(value):
+    "Turns a literal value into a hashable form that keeps its type."
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(map(freeze_literal, value)))
+    if isinstance(value, dict):
+        return ("dict", tuple(sorted([(freeze_literal(k), freeze_literal(v)) for k, v in value.items()])))
+    return (type(value).__name__, value)
+
+def normalise_code(code):
+    """
+    Returns a hashable form of a frozen code string: model references and
+    literals are parsed, so orm["app.Model"] and orm['app.model'], or
+    "x" and 'x', come out the same.
+    """
+    if not isinstance(code, basestring):
+        return ("raw", code)
+    code = code.strip()
+    match = ORM_REFERENCE.match(code)
+    if match:
+        return ("orm", match.group(2).lower())
+    try:
+        return ("literal", freeze_literal(parse_literal(code)))
+    except (ValueError, SyntaxError, TypeError):
+        return ("code", code)
+
+def field_signature(triple):
+    """
+    Returns a hashable form of a field's frozen definition, with the class
+    path made canonical; equal signatures mean nothing needs migrating.
+    """
+    if not is_triple(triple):
+        return ("raw", triple)
+    field_class, args, kwargs = triple
+    # models.CharField is django.db.models.fields.CharField
+    if field_class.startswith("models.") or field_class.startswith("django.db.models") \
+       or field_class.startswith("django.contrib.gis"):
+        field_class = "models." + field_class.split(".")[-1]
+    return (
+        field_class,
+        tuple(map(normalise_code, args)),
+        tuple(sorted([
+            (name, normalise_code(value))
+            for name, value in kwargs.items()
+            if name not in USELESS_DB_KEYWORDS
+        ])),
+    )
+
+def model_signature(fields):
+    "Returns a hashable form of all a model's frozen fields (not its Meta)."
+    return tuple(sorted([
+        (name, field_signature(triple))
+        for name, triple in fields.items()
+        if name != "Meta"
+    ]))
+
+def meta_signature(meta):
+    "Returns a hashable form of the parts of a model's Meta that matter to the db."
+    return tuple(sorted(set(map(tuple, parse_literal(meta.get('unique_together', "[]"))))))
+
+def schema_fingerprint(frozen_models):
+    """
+    Returns a hash of the signatures of a frozen models dict; if two dicts
+    have the same fingerprint, models_diff won't find anything between them.
+    """
+    return md5(repr(sorted([
+        (key, model_signature(fields), meta_signature(fields.get("Meta", {})))
+        for key, fields in frozen_models.items()
+    ]))).hexdigest()
+
+_literal_cache = {}
+
+def parse_literal(code):
+    "Parses (and memoises) a string of Python that's just a literal."
+    if code not in _literal_cache:
+        _literal_cache[code] = ast.literal_eval(code)
+    return _literal_cache[code]
+
+
 def models_diff(old, new):
     """
     Returns the difference between the old and new sets of models as a 5-tuple:
@@ -842,6 +1230,9 @@ def models_diff(old, new):
     for key in old:
         if key not in deleted_models and key not in ignored_models:
             continued_models.add(key)
+            # Most models won't have changed at all
+            if model_signature(old[key]) == model_signature(new[key]):
+                continue
             still_there = set()
             # Find fields that have vanished.
             for fieldname in old[key]:
@@ -855,7 +1246,8 @@ def models_diff(old, new):
                     added_fields.add((key, fieldname))
             # For the ones that exist in both models, see if they were changed
             for fieldname in still_there:
-                if fieldname != "Meta":
+                if fieldname != "Meta" and \
+                   field_signature(old[key][fieldname]) != field_signature(new[key][fieldname]):
                     if different_attributes(
                      remove_useless_attributes(old[key][fieldname], True),
                      remove_useless_attributes(new[key][fieldname], True)):
@@ -948,22 +1340,13 @@ def meta_diff(old, new):
     Diffs the two provided Meta definitions (dicts).
     """
     
-    # First, diff unique_together
-    old_unique_together = eval(old.get('unique_together', "[]"))
-    new_unique_together = eval(new.get('unique_together', "[]"))
-    
-    added_uniques = set()
-    removed_uniques = set()
-    
-    for entry in old_unique_together:
-        if entry not in new_unique_together:
-            removed_uniques.add(tuple(entry))
-    
-    for entry in new_unique_together:
-        if entry not in old_unique_together:
-            added_uniques.add(tuple(entry))
+    # First, diff unique_together (if it's changed at all)
+    if old.get('unique_together', "[]") == new.get('unique_together', "[]"):
+        return set(), set()
+    old_unique_together = set(map(tuple, parse_literal(old.get('unique_together', "[]"))))
+    new_unique_together = set(map(tuple, parse_literal(new.get('unique_together', "[]"))))
     
-    return added_uniques, removed_uniques
+    return new_unique_together - old_unique_together, old_unique_together - new_unique_together
 
 
 ### Used to work out what columns any fields affect ###
@@ -3,6 +3,9 @@ from django.core.management.commands import test
 from django.core.management.commands import syncdb
 from django.conf import settings
 
+from south.db import db
+from south.migration.base import fingerprint
+
 from syncdb import Command as SyncDbCommand
 
 
@@ -13,6 +16,19 @@ class MigrateAndSyncCommand(SyncDbCommand):
             opt.default = True
             break
 
+    def handle_noargs(self, **options):
+        if not getattr(settings, "SOUTH_TESTS_TEMPLATE_CACHE", False):
+            return super(MigrateAndSyncCommand, self).handle_noargs(**options)
+        # Reuse the database from the last run that had the same models
+        # and migrations, if we kept it.
+        key = fingerprint()
+        if db.load_test_template(key):
+            if int(options.get('verbosity', 0)):
+                print "Using the migrated test database saved for %s." % key
+            return
+        super(MigrateAndSyncCommand, self).handle_noargs(**options)
+        db.save_test_template(key)
+
 
 class Command(test.Command):
     
@@ -2,16 +2,21 @@
 Main migration logic.
 """
 
+import datetime
 import sys
 
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, models
+from django.utils.datastructures import SortedDict
 
 from south import exceptions
 from south.models import MigrationHistory
 from south.db import db
+from south.orm import FakeORM
 from south.migration.migrators import (Backwards, Forwards,
                                        DryRunMigrator, FakeMigrator,
-                                       LoadInitialDataMigrator)
+                                       LoadInitialDataMigrator,
+                                       load_initial_data)
 from south.migration.utils import SortedSet
 from south.signals import pre_migrate, post_migrate
 
@@ -59,8 +64,14 @@ def backwards_problems(pending, done, verbosity):
 def check_migration_histories(histories):
     exists = SortedSet()
     ghosts = []
+    squashed = SortedDict()
     migrations = (h.get_migration() for h in histories)
     for m in migrations:
+        # Migrations that have been squashed count towards their squash
+        replaced_by = getattr(m.migrations, 'replaced_by', {}).get(m.name())
+        if replaced_by is not None:
+            squashed.setdefault(replaced_by, set()).add(m.name())
+            continue
         try:
             m.migration()
         except exceptions.UnknownMigration:
@@ -70,6 +81,10 @@ def check_migration_histories(histories):
         exists.add(m)
     if ghosts:
         raise exceptions.GhostMigrations(ghosts)
+    for migration, applied in squashed.items():
+        if applied != set(migration.replaces()):
+            raise exceptions.PartiallyAppliedSquash(migration, applied)
+        exists.add(migration)
     return exists
 
 def get_dependencies(target, migrations):
@@ -161,3 +176,174 @@ def migrate_app(migrations, target_name=None, merge=False, fake=False, db_dry_ru
             post_migrate.send(None, app=app_name)
     elif verbosity:
         print '- Nothing to migrate.'
+
+def bootstrap_models(migrations):
+    """
+    Returns the models frozen into the app's latest migration that belong
+    to the app itself (not the stubs of other apps' models it refers to).
+    """
+    latest = migrations[-1]
+    orm = FakeORM(latest.migration_class(), migrations.app_name())
+    result = []
+    for name, data in getattr(orm, "models_source", {}).items():
+        if "." in name and name.split(".")[0] != migrations.app_name():
+            continue
+        if data.get("_stub", False):
+            continue
+        if "." not in name:
+            name = "%s.%s" % (migrations.app_name(), name)
+        model = orm.models[name.lower()]
+        if getattr(model._meta, "proxy", False) or not getattr(model._meta, "managed", True):
+            continue
+        result.append(model)
+    return result
+
+def bootstrap_create_tables(model):
+    """
+    Creates the table for the (frozen) model, along with its unique
+    constraints and the tables for its ManyToManyFields.
+    """
+    table_name = model._meta.db_table
+    db.create_table(table_name, [(f.name, f) for f in model._meta.local_fields])
+    for columns in model._meta.unique_together:
+        bootstrap_create_unique(table_name, [model._meta.get_field(name).column for name in columns])
+    for field in model._meta.local_many_to_many:
+        if getattr(field.rel, "through", None):
+            # The intermediary model makes its own table
+            continue
+        m2m_table_name = field.m2m_db_table()
+        from_field = models.ForeignKey(model)
+        to_field = models.ForeignKey(field.rel.to)
+        db.create_table(m2m_table_name, [
+            ('id', models.AutoField(verbose_name='ID', primary_key=True, auto_created=True)),
+            (field.m2m_column_name()[:-3], from_field),
+            (field.m2m_reverse_name()[:-3], to_field),
+        ])
+        bootstrap_create_unique(m2m_table_name, [field.m2m_column_name(), field.m2m_reverse_name()])
+
+def bootstrap_create_unique(table_name, columns):
+    """
+    Makes the columns unique together; databases that can't add a unique
+    constraint to an existing table (SQLite) get a unique index instead.
+    """
+    if db.supports_create_unique:
+        db.create_unique(table_name, columns)
+    else:
+        db.create_index(table_name, columns, unique=True)
+
+def bootstrap(apps, verbosity=0):
+    """
+    Builds an empty database's schema straight from the models frozen into
+    each app's latest migration, rather than replaying every migration,
+    and records them all as applied. Only migrations with 'bootstrap = True'
+    on them (e.g. ones loading data the app can't do without) are actually
+    run, once the tables are there.
+    """
+    verbosity = int(verbosity)
+    apps = [migrations for migrations in apps if migrations]
+    # Make sure there's nothing for us to trample on
+    existing_tables = set(connection.introspection.table_names())
+    app_models = []
+    for migrations in apps:
+        app_name = migrations.app_name()
+        if MigrationHistory.objects.filter(app_name=app_name).count():
+            raise exceptions.DatabaseNotEmpty(app_name, "migrations applied")
+        models_list = bootstrap_models(migrations)
+        for model in models_list:
+            if model._meta.db_table in existing_tables:
+                raise exceptions.DatabaseNotEmpty(app_name, "a table '%s'" % model._meta.db_table)
+        app_models.append((migrations, models_list))
+    # Create every table before any foreign keys, which may go across apps
+    db.start_transaction()
+    try:
+        for migrations, models_list in app_models:
+            if verbosity:
+                print " - Creating %s tables for %s." % (len(models_list), migrations.app_name())
+            for model in models_list:
+                bootstrap_create_tables(model)
+            db.send_create_signal(migrations.app_name(), [model._meta.object_name for model in models_list])
+        db.execute_deferred_sql()
+        # Everything's applied, bar the migrations still to run
+        to_run = []
+        for migrations, models_list in app_models:
+            for migration in migrations[-1].forwards_plan():
+                if migration.migrations not in apps or migration in to_run:
+                    continue
+                if getattr(migration.migration_class(), "bootstrap", False):
+                    to_run.append(migration)
+        applied = datetime.datetime.utcnow()
+        history = [
+            (migration.app_name(), migration.name(), applied)
+            for migrations, models_list in app_models
+            for migration in migrations
+            if migration not in to_run
+        ]
+        qn = connection.ops.quote_name
+        connection.cursor().executemany("INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)" % (
+            qn(MigrationHistory._meta.db_table), qn("app_name"), qn("migration"), qn("applied"),
+        ), [(app_name, name, connection.ops.value_to_db_datetime(applied)) for app_name, name, applied in history])
+    except:
+        db.rollback_transaction()
+        raise
+    else:
+        db.commit_transaction()
+    if verbosity:
+        print " - Marked %s migrations as applied." % len(history)
+    # Now run the ones that asked to be
+    migrator = Forwards(verbosity=verbosity)
+    try:
+        for migration in to_run:
+            migrator.migrate(migration)
+    finally:
+        db.send_pending_create_signals()
+
+def validate_constraints(verbosity=0):
+    """
+    Validates any constraints the migrations added without checking the
+    existing rows (see SOUTH_NOT_VALID_FOREIGN_KEYS).
+    """
+    verbosity = int(verbosity)
+    if verbosity:
+        print "Validating constraints:"
+    validated = db.validate_constraints()
+    if verbosity:
+        for table_name, constraint in validated:
+            print " - Validated %s on %s." % (constraint, table_name)
+        if not validated:
+            print "- Nothing to validate."
+    return validated
+
+def execute_plan_deferred_sql(verbosity=0):
+    """
+    Creates the indexes and foreign keys held back until the end of the
+    migration plan by --defer-indexes. If that fails, they're left in
+    place for abandon_plan_deferred_sql to report.
+    """
+    if not db.plan_deferred_sql:
+        return
+    verbosity = int(verbosity)
+    if verbosity:
+        print " - Creating %s deferred indexes and foreign keys." % len(db.plan_deferred_sql)
+    pending = list(db.plan_deferred_sql)
+    db.start_transaction()
+    try:
+        db.execute_plan_deferred_sql()
+    except:
+        db.rollback_transaction()
+        db.plan_deferred_sql = pending
+        raise
+    else:
+        db.commit_transaction()
+
+def abandon_plan_deferred_sql():
+    """
+    Throws away the indexes and foreign keys held back by --defer-indexes
+    after the plan has failed. Unless the whole plan was in one transaction,
+    the migrations that did get committed still need them, so the
+    statements are printed for finishing off by hand.
+    """
+    pending, db.plan_deferred_sql = db.plan_deferred_sql, []
+    if pending and not db.plan_transaction:
+        print " ! Deferred indexes and foreign keys were not created; these still need running:"
+        for tables, columns, sql in pending:
+            print "   %s" % sql
@@ -1,9 +1,14 @@
 from collections import deque
 import datetime
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
 import os
 import re
 import sys
 
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 
@@ -25,6 +30,29 @@ def all_migrations(applications=None):
         except exceptions.NoMigrations:
             pass
 
+def fingerprint(applications=None):
+    """
+    Returns a hash of the models and migrations of all `applications`, which
+    changes whenever the schema migrating them produces might.
+    """
+    if applications is None:
+        applications = models.get_apps()
+    digest = md5(settings.DATABASE_ENGINE)
+    for app in applications:
+        filenames = [app.__file__]
+        try:
+            migrations = Migrations(app)
+        except exceptions.NoMigrations:
+            pass
+        else:
+            filenames.extend([os.path.join(migrations.dirname(), m.filename + ".py") for m in migrations])
+        for filename in filenames:
+            filename = os.path.splitext(filename)[0] + ".py"
+            digest.update(filename)
+            if os.path.exists(filename):
+                digest.update(open(filename, "rb").read())
+    return digest.hexdigest()
+
 def Migrations(application):
     if isinstance(application, basestring):
         app_name = application
@@ -43,6 +71,8 @@ class _Migrations(list):
     MIGRATION_FILENAME = re.compile(r'(?!__init__)' # Don't match __init__.py
                                     r'[^.]*'        # Don't match dotfiles
                                     r'\.py$')       # Match only .py files
+    # Only migrations with this in their names get checked for 'replaces'
+    SQUASHED_NAME = '_squashed_'
 
     def __new__(cls, application):
         if isinstance(application, basestring):
@@ -57,7 +87,8 @@ class _Migrations(list):
     @classmethod
     def from_name(cls, app_name):
         app = models.get_app(app_name)
-        module_name = get_app_name(app)
+        # The app's package, which isn't always importable by its label
+        module_name = app.__name__.rsplit('.', 1)[0]
         try:
             module = sys.modules[module_name]
         except KeyError:
@@ -84,12 +115,29 @@ class _Migrations(list):
     def _load_migrations_module(self, module):
         self._migrations = module
         filenames = []
-        dirname = os.path.dirname(self._migrations.__file__)
+        dirname = self.dirname()
         for f in os.listdir(dirname):
             if self.MIGRATION_FILENAME.match(os.path.basename(f)):
                 filenames.append(f)
         filenames.sort()
         self.extend(self.migration(f) for f in filenames)
+        self._replace_squashed()
+
+    def _replace_squashed(self):
+        """
+        Squashed migrations stand in for the ones they replace, which drop
+        out of the list. They can still be looked up by name, so histories
+        that mention them make sense.
+        """
+        self.replaced_by = {}
+        for migration in self:
+            if self.SQUASHED_NAME in migration.name():
+                for name in migration.replaces():
+                    self.replaced_by[name] = migration
+        self[:] = [m for m in self if m.name() not in self.replaced_by]
+
+    def dirname(self):
+        return os.path.dirname(self._migrations.__file__)
 
     def migration(self, filename):
         name = Migration.strip_filename(filename)
@@ -211,6 +259,8 @@ class Migration(object):
             except ImproperlyConfigured:
                 raise exceptions.DependsOnUnmigratedApplication(self, app)
             migration = migrations.migration(name)
+            # Depending on a squashed migration means depending on its squash
+            migration = getattr(migrations, 'replaced_by', {}).get(migration.name(), migration)
             try:
                 migration.migration()
             except exceptions.UnknownMigration:
@@ -275,11 +325,34 @@ class Migration(object):
             # First migration? The 'previous ORM' is empty.
             return FakeORM(None, self.app_name())
         return previous.orm()
-    prev_orm = memoize(prev_orm)
 
     def orm(self):
-        return LazyFakeORM(self.migration().Migration, self.app_name())
-    orm = memoize(orm)
+        """
+        Returns the FakeORM for this migration's frozen models, building it
+        (from its neighbours' where it can) if it isn't cached.
+        """
+        return self.lazy_orm().__get__(None)
+
+    def lazy_orm(self):
+        return LazyFakeORM(self.migration().Migration, self.app_name(), self.neighbour_orms)
+    lazy_orm = memoize(lazy_orm)
+
+    def neighbour_orms(self):
+        """
+        Returns the ORMs already built for the migrations either side of
+        this one, which its own ORM can be built from.
+        """
+        orms = []
+        for migration in (self.previous(), self.next()):
+            if migration is not None and migration.lazy_orm().built() is not None:
+                orms.append(migration.lazy_orm().built())
+        return orms
+
+    def replaces(self):
+        """
+        Returns the names of the migrations this one was squashed from.
+        """
+        return list(getattr(self.migration_class(), 'replaces', []))
 
     def no_dry_run(self):
         migration_class = self.migration_class()
@@ -70,12 +70,16 @@ class Migrator(object):
 
     def run_migration(self, migration):
         migration_function = self.direction(migration)
+        # Index SQL held back for the end of the plan; if this migration
+        # fails, whatever it added to that goes away with it.
+        plan_deferred_sql = list(db.plan_deferred_sql)
         db.start_transaction()
         try:
             migration_function()
             db.execute_deferred_sql()
         except:
             db.rollback_transaction()
+            db.plan_deferred_sql = plan_deferred_sql
             if not db.has_ddl_transactions:
                 print self.run_migration_error(migration)
             raise
@@ -185,21 +189,34 @@ class FakeMigrator(MigratorWrapper):
         pass
 
 
+def load_initial_data(app_name, verbosity=0):
+    """
+    Loads the initial_data fixtures for the given app, and only that app.
+    """
+    if verbosity:
+        print " - Loading initial data for %s." % app_name
+    # Override Django's get_apps call temporarily to only load from the
+    # current app
+    old_get_apps = models.get_apps
+    models.get_apps = lambda: [models.get_app(app_name)]
+    try:
+        call_command('loaddata', 'initial_data', verbosity=verbosity)
+    finally:
+        models.get_apps = old_get_apps
+
+
 class LoadInitialDataMigrator(MigratorWrapper):
     def load_initial_data(self, target):
         if target != target.migrations[-1]:
             return
         # Load initial data, if we ended up at target
-        if self.verbosity:
-            print " - Loading initial data for %s." % target.app_name()
-        # Override Django's get_apps call temporarily to only load from the
-        # current app
-        old_get_apps = models.get_apps
-        models.get_apps = lambda: [models.get_app(target.app_name())]
-        try:
-            call_command('loaddata', 'initial_data', verbosity=self.verbosity)
-        finally:
-            models.get_apps = old_get_apps
+        if db.plan_transaction:
+            # loaddata commits once it's done, which would end the plan's
+            # transaction early, so it waits until the plan's committed.
+            if target.app_name() not in db.plan_initial_data:
+                db.plan_initial_data.append(target.app_name())
+            return
+        load_initial_data(target.app_name(), self.verbosity)
 
     def migrate_many(self, target, migrations):
         migrator = self._migrator
@@ -299,6 +316,11 @@ class Backwards(Migrator):
         record = MigrationHistory.for_migration(migration)
         if record.id is not None:
             record.delete()
+        # A squashed migration was done if the ones it replaces were
+        replaces = migration.replaces()
+        if replaces:
+            MigrationHistory.objects.filter(app_name=migration.app_name(),
+                                            migration__in=replaces).delete()
 
     def migrate_many(self, target, migrations):
         for migration in migrations:
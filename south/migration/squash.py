@@ -0,0 +1,404 @@
+"""
+Squashing; works out what a run of migrations does to the schema, and the
+fewest db calls that do the same.
+"""
+
+import copy
+import inspect
+
+from south import exceptions
+from south.db import db, generic
+from south.migration.migrators import Migrator
+from south.orm import FakeORM
+
+
+class Operation(object):
+    """
+    One call a migration made to a db method, with its arguments by name.
+    """
+
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+
+    def __repr__(self):
+        return "<Operation: %s %r>" % (self.name, self.params)
+
+    def __getitem__(self, key):
+        return self.params[key]
+
+    def __setitem__(self, key, value):
+        self.params[key] = value
+
+    def arguments(self):
+        """
+        Returns the (args, kwargs) to call the db method with; arguments
+        that are just the method's defaults are left out.
+        """
+        names, varargs, varkw, defaults = inspect.getargspec(getattr(generic.DatabaseOperations, self.name))
+        names = names[1:]
+        defaults = defaults or ()
+        required = names[:len(names) - len(defaults)]
+        args = [self.params[name] for name in required]
+        kwargs = {}
+        for name, default in zip(names[len(required):], defaults):
+            if name in self.params and self.params[name] != default:
+                kwargs[name] = self.params[name]
+        return args, kwargs
+
+
+class OperationRecorder(generic.DatabaseOperations):
+    """
+    Stands in for south.db.db while a migration runs, noting down the schema
+    changes it asks for rather than making them. Anything it doesn't know
+    about that would run SQL gets noted down as that SQL.
+    """
+
+    def __init__(self, migration):
+        generic.DatabaseOperations.__init__(self)
+        self.migration = migration
+        self.operations = []
+
+    def _get_dry_run(self):
+        raise exceptions.CannotSquash(self.migration, "it checks db.dry_run, so it probably changes data")
+
+    def _set_dry_run(self, value):
+        pass
+
+    dry_run = property(_get_dry_run, _set_dry_run)
+
+    def _record(self, name, params):
+        params = dict(params)
+        del params['self']
+        self.operations.append(Operation(name, params))
+
+    def execute(self, sql, params=[]):
+        self._record("execute", locals())
+        return []
+
+    def create_table(self, table_name, fields):
+        fields = list(fields)
+        self._record("create_table", locals())
+
+    def rename_table(self, old_table_name, table_name):
+        self._record("rename_table", locals())
+
+    def delete_table(self, table_name, cascade=True):
+        self._record("delete_table", locals())
+
+    def clear_table(self, table_name):
+        self._record("clear_table", locals())
+
+    def add_column(self, table_name, name, field, keep_default=True, staged=False):
+        self._record("add_column", locals())
+
+    def alter_column(self, table_name, name, field, explicit_name=True):
+        self._record("alter_column", locals())
+
+    def delete_column(self, table_name, name):
+        self._record("delete_column", locals())
+
+    def rename_column(self, table_name, old, new):
+        self._record("rename_column", locals())
+
+    def create_unique(self, table_name, columns):
+        columns = list(columns)
+        self._record("create_unique", locals())
+
+    def delete_unique(self, table_name, columns):
+        columns = list(columns)
+        self._record("delete_unique", locals())
+
+    def create_index(self, table_name, column_names, unique=False, db_tablespace=''):
+        column_names = list(column_names)
+        self._record("create_index", locals())
+
+    def delete_index(self, table_name, column_names, db_tablespace=''):
+        column_names = list(column_names)
+        self._record("delete_index", locals())
+
+    def delete_foreign_key(self, table_name, column):
+        self._record("delete_foreign_key", locals())
+
+    def create_primary_key(self, table_name, columns):
+        self._record("create_primary_key", locals())
+
+    def drop_primary_key(self, table_name):
+        self._record("drop_primary_key", locals())
+
+    def send_create_signal(self, app_label, model_names):
+        model_names = list(model_names)
+        self._record("send_create_signal", locals())
+
+    # The rest happens whenever the squashed migration runs anyway.
+
+    def execute_deferred_sql(self):
+        pass
+
+    def send_pending_create_signals(self):
+        pass
+
+    def start_transaction(self):
+        pass
+
+    def commit_transaction(self):
+        pass
+
+    def rollback_transaction(self):
+        pass
+
+
+def record_operations(migration, direction):
+    """
+    Runs the migration's forwards or backwards against an OperationRecorder,
+    and returns the Operations it asked for.
+    """
+    migration_class = migration.migration_class()
+    if getattr(migration_class, "no_dry_run", False):
+        raise exceptions.CannotSquash(migration, "it's marked no_dry_run, so it changes data")
+    app_name = migration.app_name()
+    if direction == "forwards":
+        orm = FakeORM(migration_class, app_name)
+    else:
+        previous = migration.previous()
+        orm = FakeORM(previous and previous.migration_class() or None, app_name)
+    function = Migrator._wrap_direction(getattr(migration.migration_instance(), direction), orm)
+    recorder = OperationRecorder(migration)
+    module = migration.migration()
+    old_db, module.db = getattr(module, "db", None), recorder
+    # Make sure anything that gets at the ORM fails, rather than changing data
+    old_dry_run, db.dry_run = db.dry_run, True
+    try:
+        function()
+    except exceptions.CannotSquash:
+        raise
+    except Exception, e:
+        raise exceptions.CannotSquash(migration, "running its %s failed (%s); it might use the ORM" % (direction, e))
+    finally:
+        module.db = old_db
+        db.dry_run = old_dry_run
+    return recorder.operations
+
+
+def squash(migrations):
+    """
+    Returns the folded forwards and backwards Operations for the run of
+    migrations, as a pair of lists.
+    """
+    forwards = []
+    for migration in migrations:
+        forwards.extend(record_operations(migration, "forwards"))
+    backwards = []
+    for migration in reversed(migrations):
+        backwards.extend(record_operations(migration, "backwards"))
+    return fold(forwards), fold(backwards)
+
+
+### Folding
+
+# The operations we know well enough to see past when folding.
+FOLDABLE = ["create_table", "add_column", "alter_column", "delete_column",
+            "create_unique", "delete_unique", "create_index", "delete_index"]
+
+def column_name(name, field):
+    "Returns the column a field added as 'name' ends up in."
+    field = copy.copy(field)
+    field.set_attributes_from_name(name)
+    return field.column
+
+def operation_column(operation):
+    "Returns the column a column-level operation is on."
+    if operation.name == "add_column":
+        return column_name(operation["name"], operation["field"])
+    if operation.name == "alter_column" and not operation.params.get("explicit_name", True):
+        return column_name(operation["name"], operation["field"])
+    return operation["name"]
+
+def operation_columns(operation):
+    "Returns the columns an index or unique operation covers."
+    return list(operation.params.get("columns", operation.params.get("column_names", [])))
+
+def visible(operations, table_name):
+    """
+    Returns (index, operation) pairs for the operations on the table, latest
+    first, as far back as nothing gets in the way (raw SQL, renames, or
+    operations we don't understand).
+    """
+    result = []
+    for index in range(len(operations) - 1, -1, -1):
+        operation = operations[index]
+        if operation.name == "execute":
+            break
+        if operation.name == "rename_table" and table_name in (operation["old_table_name"], operation["table_name"]):
+            break
+        if operation.params.get("table_name") != table_name:
+            continue
+        if operation.name not in FOLDABLE:
+            break
+        result.append((index, operation))
+    return result
+
+def find_origin(operations, table_name, column):
+    """
+    Looks for where the column came into being among the visible operations;
+    returns (index, operation) for its add_column or create_table, or None.
+    """
+    for index, operation in visible(operations, table_name):
+        if operation.name == "create_table":
+            for name, field in operation["fields"]:
+                if column_name(name, field) == column:
+                    return index, operation
+            return None
+        if operation.name == "add_column" and operation_column(operation) == column:
+            return index, operation
+    return None
+
+def fold_delete_table(operations, operation):
+    # Everything that happened to the table since it was made can go too
+    created = False
+    for index, earlier in visible(operations, operation["table_name"]):
+        del operations[index]
+        if earlier.name == "create_table":
+            created = True
+    return created
+
+def fold_rename_table(operations, operation):
+    earlier = visible(operations, operation["old_table_name"])
+    if not earlier or earlier[-1][1].name != "create_table":
+        return False
+    for index, earlier_operation in earlier:
+        earlier_operation["table_name"] = operation["table_name"]
+    return True
+
+def fold_add_column(operations, operation):
+    field = operation["field"]
+    if not operation.params.get("keep_default", True) and field.has_default():
+        # create_table would keep the default it's meant to lose
+        return False
+    earlier = visible(operations, operation["table_name"])
+    if not earlier or earlier[-1][1].name != "create_table":
+        return False
+    earlier[-1][1]["fields"].append((operation["name"], field))
+    return True
+
+def origin_field(origin, column):
+    "Returns the field the column was created with by its origin operation."
+    index, operation = origin
+    if operation.name == "create_table":
+        for name, field in operation["fields"]:
+            if column_name(name, field) == column:
+                return field
+    return operation["field"]
+
+def same_indexes(field, other):
+    """
+    Returns True if the fields agree on db_index and unique; alter_column
+    leaves those alone, whereas create_table and add_column honour them.
+    """
+    return field.db_index == other.db_index and field.unique == other.unique
+
+def fold_alter_column(operations, operation):
+    table_name = operation["table_name"]
+    column = operation_column(operation)
+    origin = find_origin(operations, table_name, column)
+    if origin is not None and same_indexes(origin_field(origin, column), operation["field"]):
+        index, earlier = origin
+        if earlier.name == "create_table":
+            earlier["fields"] = [
+                (name, column_name(name, field) == column and operation["field"] or field)
+                for name, field in earlier["fields"]
+            ]
+        else:
+            earlier["field"] = operation["field"]
+        return True
+    # Only the last alteration matters
+    for index, earlier in visible(operations, table_name):
+        if earlier.name == "alter_column" and operation_column(earlier) == column:
+            del operations[index]
+    return False
+
+def fold_delete_column(operations, operation):
+    table_name = operation["table_name"]
+    column = operation["name"]
+    origin = find_origin(operations, table_name, column)
+    for index, earlier in visible(operations, table_name):
+        if origin is not None and index < origin[0]:
+            break
+        if earlier.name == "alter_column" and operation_column(earlier) == column:
+            del operations[index]
+        elif origin is not None and column in operation_columns(earlier):
+            # Indexes and uniques made since the column was
+            del operations[index]
+    if origin is None:
+        return False
+    index, earlier = find_origin(operations, table_name, column)
+    if earlier.name == "create_table":
+        earlier["fields"] = [
+            (name, field) for name, field in earlier["fields"]
+            if column_name(name, field) != column
+        ]
+    else:
+        del operations[index]
+    return True
+
+def cancel(operations, operation, opposite):
+    """
+    Removes the last visible 'opposite' operation on the same columns, if
+    nothing happened to those columns in between, returning True if it did.
+    """
+    columns = operation_columns(operation)
+    for index, earlier in visible(operations, operation["table_name"]):
+        if earlier.name == opposite and operation_columns(earlier) == columns:
+            del operations[index]
+            return True
+        if earlier.name in ("add_column", "alter_column", "delete_column") and operation_column(earlier) in columns:
+            return False
+    return False
+
+def fold_create_unique(operations, operation):
+    return cancel(operations, operation, "delete_unique")
+
+def fold_delete_unique(operations, operation):
+    return cancel(operations, operation, "create_unique")
+
+def fold_delete_index(operations, operation):
+    return cancel(operations, operation, "create_index")
+
+def fold_send_create_signal(operations, operation):
+    # One signal per app will do
+    for earlier in operations:
+        if earlier.name == "send_create_signal" and earlier["app_label"] == operation["app_label"]:
+            for model_name in operation["model_names"]:
+                if model_name not in earlier["model_names"]:
+                    earlier["model_names"].append(model_name)
+            return True
+    return False
+
+FOLDERS = {
+    "delete_table": fold_delete_table,
+    "rename_table": fold_rename_table,
+    "add_column": fold_add_column,
+    "alter_column": fold_alter_column,
+    "delete_column": fold_delete_column,
+    "create_unique": fold_create_unique,
+    "delete_unique": fold_delete_unique,
+    "delete_index": fold_delete_index,
+    "send_create_signal": fold_send_create_signal,
+}
+
+def fold(operations):
+    """
+    Folds a list of Operations into the fewest that do the same thing;
+    successive alterations merge, columns and tables made and later dropped
+    vanish, and so on.
+    """
+    result = []
+    for operation in operations:
+        operation = Operation(operation.name, dict([
+            (key, isinstance(value, list) and list(value) or value)
+            for key, value in operation.params.items()
+        ]))
+        folder = FOLDERS.get(operation.name)
+        if folder is None or not folder(result, operation):
+            result.append(operation)
+    return result
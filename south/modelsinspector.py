@@ -4,9 +4,9 @@ rather than direct inspection of models.py.
 """
 
 import datetime
+import re
 
 import modelsparser
-from south.utils import get_attribute
 
 from django.db import models
 from django.contrib.localflavor import us
@@ -16,12 +16,14 @@ from django.conf import settings
 from django.utils.functional import Promise
 from django.contrib.contenttypes import generic
 from django.utils.datastructures import SortedDict
+from django.utils import simplejson
 
 NOISY = True
 
 # Gives information about how to introspect certain fields.
 # This is a list of triples; the first item is a list of fields it applies to,
-# (note that isinstance is used, so superclasses are perfectly valid here)
+# (note that isinstance is used, so superclasses are perfectly valid here;
+# fields can also be given as their full 'module.ClassName' path)
 # the second is a list of positional argument descriptors, and the third
 # is a list of keyword argument descriptors.
 # Descriptors are of the form:
@@ -113,18 +115,102 @@ meta_details = {
 any = lambda x: reduce(lambda y, z: y or z, x, False)
 
 
+# Regexes for the full class paths of fields we're allowed to introspect.
+allowed_fields = [
+    r"^django\.db",
+    r"^django\.contrib\.gis",
+    r"^django\.contrib\.localflavor",
+    r"^django\.contrib\.contenttypes\.generic",
+]
+
+
+def add_introspection_rules(patterns=[], rules=[]):
+    """
+    Lets fields from outside Django be introspected. 'patterns' are regexes
+    for the full class paths ('module.ClassName') of the fields that may be,
+    and 'rules' are extra introspection_details entries for them (or their
+    bases); the field classes in those can be given by their full path, so
+    nothing needs importing.
+    """
+    assert isinstance(patterns, (list, tuple)), "patterns must be a list"
+    assert isinstance(rules, (list, tuple)), "rules must be a list"
+    allowed_fields.extend(patterns)
+    introspection_details.extend(rules)
+    # Plans made before now might be missing the new rules
+    introspection_plans.clear()
+    introspectable_classes.clear()
+
+
+def load_introspection_rules(filename):
+    """
+    Adds the introspection rules in a JSON file; it holds a list of
+    objects like {"patterns": [...], "rules": [...]}, which are passed
+    to add_introspection_rules.
+    """
+    fp = open(filename)
+    try:
+        rule_sets = simplejson.load(fp)
+    finally:
+        fp.close()
+    for rule_set in rule_sets:
+        add_introspection_rules(
+            patterns = rule_set.get("patterns", []),
+            rules = [tuple(rule) for rule in rule_set.get("rules", [])],
+        )
+
+
+def load_rules_files():
+    "Loads the files in the SOUTH_INTROSPECTION_RULES setting, the first time."
+    if not load_rules_files.done:
+        load_rules_files.done = True
+        for filename in getattr(settings, "SOUTH_INTROSPECTION_RULES", []):
+            load_introspection_rules(filename)
+load_rules_files.done = False
+
+
+def class_path(cls):
+    "Returns the full 'module.ClassName' path of the class."
+    return cls.__module__ + "." + cls.__name__
+
+
+def class_matches(cls, classes):
+    """
+    Returns True if cls is a subclass of any of the classes, which can be
+    classes or full class paths.
+    """
+    for other in classes:
+        if isinstance(other, basestring):
+            if other in [class_path(base) for base in cls.__mro__]:
+                return True
+        elif issubclass(cls, other):
+            return True
+    return False
+
+
+# Whether fields of each class are allowed to be introspected.
+introspectable_classes = {}
+
 def can_introspect(field):
     """
     Returns True if we are allowed to introspect this field, False otherwise.
-    ('allowed' means 'in core'. Custom fields can declare they are introspectable
+    ('allowed' means 'in core', or matching a pattern added with
+    add_introspection_rules. Custom fields can also declare they are introspectable
     by the default South rules by adding the attribute _south_introspects = True.)
     """
+    # The rules files may cover this field's class, whichever way it's allowed
+    load_rules_files()
     # Check for special attribute
     if hasattr(field, "_south_introspects") and field._south_introspects:
         return True
-    # Check it's a core field (one I've written for)
-    module = field.__class__.__module__
-    return module.startswith("django.db") or module.startswith("django.contrib.gis") or module.startswith("django.contrib.localflavor") or module.startswith("django.contrib.contenttypes.generic")
+    # Check it's a core field (one I've written for), or one we've been told about
+    cls = field.__class__
+    if cls not in introspectable_classes:
+        path = class_path(cls)
+        introspectable_classes[cls] = bool([
+            pattern for pattern in allowed_fields
+            if re.match(pattern, path)
+        ])
+    return introspectable_classes[cls]
 
 
 def matching_details(field):
@@ -134,7 +220,7 @@ def matching_details(field):
     our_args = []
     our_kwargs = {}
     for classes, args, kwargs in introspection_details:
-        if any([isinstance(field, x) for x in classes]):
+        if class_matches(field.__class__, classes):
             our_args.extend(args)
             our_kwargs.update(kwargs)
     return our_args, our_kwargs
@@ -146,34 +232,63 @@ class IsDefault(Exception):
     """
 
 
-def get_value(field, descriptor):
+def attribute_getter(path):
     """
-    Gets an attribute value from a Field instance and formats it.
+    Returns a function that gets the (possibly dotted) attribute path from
+    an object, like get_attribute but with the splitting done up front.
+    """
+    parts = path.split(".")
+    if len(parts) == 1:
+        return lambda item: getattr(item, path)
+    def getter(item):
+        for part in parts:
+            item = getattr(item, part)
+        return item
+    return getter
+
+
+def compile_descriptor(descriptor):
+    """
+    Turns an [attrname, options] descriptor into a function that gets the
+    value from a field (or Meta), returning IsDefault if it's the default.
     """
     attrname, options = descriptor
-    value = get_attribute(field, attrname)
-    # Lazy-eval functions get eval'd.
-    # Annoyingly, we can't do an isinstance() test
-    if isinstance(value, Promise):
-        value = unicode(value)
+    getter = attribute_getter(attrname)
+    checks = []
     # If the value is the same as the default, omit it for clarity
-    if "default" in options and value == options['default']:
-        raise IsDefault
+    if "default" in options:
+        default = options['default']
+        checks.append(lambda item, value: value == default)
     # If there's an ignore_if, use it
     if "ignore_if" in options:
-        if get_attribute(field, options['ignore_if']):
-            raise IsDefault
+        ignore_if = attribute_getter(options['ignore_if'])
+        checks.append(lambda item, value: ignore_if(item))
     # Some default values need to be gotten from an attribute too.
     if "default_attr" in options:
-        default_value = get_attribute(field, options['default_attr'])
-        if value == default_value:
-            raise IsDefault
+        default_attr = attribute_getter(options['default_attr'])
+        checks.append(lambda item, value: value == default_attr(item))
     # Some are made from a formatting string and several attrs (e.g. db_table)
     if "default_attr_concat" in options:
-        format, attrs = options['default_attr_concat'][0], options['default_attr_concat'][1:]
-        default_value = format % tuple(map(lambda x: get_attribute(field, x), attrs))
-        if value == default_value:
-            raise IsDefault
+        format = options['default_attr_concat'][0]
+        attrs = map(attribute_getter, options['default_attr_concat'][1:])
+        checks.append(lambda item, value: value == format % tuple([attr(item) for attr in attrs]))
+    def get(item):
+        value = getter(item)
+        # Lazy-eval functions get eval'd.
+        # Annoyingly, we can't do an isinstance() test
+        if isinstance(value, Promise):
+            value = unicode(value)
+        for check in checks:
+            if check(item, value):
+                return IsDefault
+        return value
+    return get
+
+
+def format_value(value):
+    """
+    Turns an introspected value into the string that's frozen.
+    """
     # Models get their own special repr()
     if isinstance(value, ModelBase):
         return "orm['%s.%s']" % (value._meta.app_label, value._meta.object_name)
@@ -191,27 +306,76 @@ def get_value(field, descriptor):
         return repr(value)
 
 
+def get_value(field, descriptor):
+    """
+    Gets an attribute value from a Field instance and formats it.
+    """
+    value = compile_descriptor(descriptor)(field)
+    if value is IsDefault:
+        raise IsDefault
+    return format_value(value)
+
+
+# Compiled (args, kwargs) descriptors for each field class, made from all
+# the matching introspection_details entries.
+introspection_plans = {}
+
+def introspection_plan(field_class):
+    """
+    Returns the compiled descriptors to introspect fields of the given
+    class with; a list for args, and a list of (name, descriptor) for kwargs.
+    """
+    load_rules_files()
+    if field_class not in introspection_plans:
+        our_args = []
+        our_kwargs = {}
+        for classes, args, kwargs in introspection_details:
+            if class_matches(field_class, classes):
+                our_args.extend(args)
+                our_kwargs.update(kwargs)
+        introspection_plans[field_class] = (
+            map(compile_descriptor, our_args),
+            [(kwd, compile_descriptor(defn)) for kwd, defn in our_kwargs.items()],
+        )
+    return introspection_plans[field_class]
+
+
 def introspector(field):
     """
     Given a field, introspects its definition triple.
     """
-    arg_defs, kwarg_defs = matching_details(field)
+    arg_plan, kwarg_plan = introspection_plan(field.__class__)
     args = []
     kwargs = {}
     # For each argument, use the descriptor to get the real value.
-    for defn in arg_defs:
-        try:
-            args.append(get_value(field, defn))
-        except IsDefault:
-            pass
-    for kwd, defn in kwarg_defs.items():
-        try:
-            kwargs[kwd] = get_value(field, defn)
-        except IsDefault:
-            pass
+    for get in arg_plan:
+        value = get(field)
+        if value is not IsDefault:
+            args.append(format_value(value))
+    for kwd, get in kwarg_plan:
+        value = get(field)
+        if value is not IsDefault:
+            kwargs[kwd] = format_value(value)
     return args, kwargs
 
 
+def get_field_triple(field):
+    """
+    Given a field on its own, returns its definition triple, or None if
+    it can't be introspected.
+    """
+    if hasattr(field, "south_field_triple"):
+        return field.south_field_triple()
+    if not can_introspect(field):
+        return None
+    # Get the full field class path.
+    field_class = class_path(field.__class__)
+    # Run this field through the introspector
+    args, kwargs = introspector(field)
+    # That's our definition!
+    return (field_class, args, kwargs)
+
+
 def get_model_fields(model, m2m=False):
     """
     Given a model class, returns a dict of {field_name: field_triple} defs.
@@ -226,8 +390,8 @@ def get_model_fields(model, m2m=False):
             # Looks like we need their fields, Ma.
             inherited_fields.update(get_model_fields(base))
     
-    # Now, ask the parser to have a look at this model too.
-    parser_fields = modelsparser.get_model_fields(model, m2m) or {}
+    # The parser only gets a look at the model if we can't introspect a field.
+    parser_fields = None
     
     # Now, go through all the fields and try to get their definition
     source = model._meta.local_fields[:]
@@ -244,26 +408,33 @@ def get_model_fields(model, m2m=False):
         elif can_introspect(field):
             #if NOISY:
             #    print "Introspecting field: %s" % field.name
-            # Get the full field class path.
-            field_class = field.__class__.__module__ + "." + field.__class__.__name__
-            # Run this field through the introspector
             args, kwargs = introspector(field)
-            # That's our definition!
-            field_defs[field.name] = (field_class, args, kwargs)
-        # Hmph. Is it parseable?
-        elif parser_fields.get(field.name, None):
-            if NOISY:
-                print " ( Parsing field: %s" % field.name
-            field_defs[field.name] = parser_fields[field.name]
-        # Shucks, no definition!
+            field_defs[field.name] = (class_path(field.__class__), args, kwargs)
         else:
-            if NOISY:
-                print " ( Nodefing field: %s" % field.name
-            field_defs[field.name] = None
+            # Hmph. Is it parseable?
+            if parser_fields is None:
+                parser_fields = modelsparser.get_model_fields(model, m2m) or {}
+            if parser_fields.get(field.name, None):
+                if NOISY:
+                    print " ( Parsing field: %s" % field.name
+                field_defs[field.name] = parser_fields[field.name]
+            # Shucks, no definition!
+            else:
+                if NOISY:
+                    print " ( Nodefing field: %s" % field.name
+                field_defs[field.name] = None
     
     return field_defs
 
 
+def meta_plan():
+    "Returns the compiled (name, descriptor) pairs for meta_details."
+    if meta_plan.plan is None:
+        meta_plan.plan = [(kwd, compile_descriptor(defn)) for kwd, defn in meta_details.items()]
+    return meta_plan.plan
+meta_plan.plan = None
+
+
 def get_model_meta(model):
     """
     Given a model class, will return the dict representing the Meta class.
@@ -271,10 +442,9 @@ def get_model_meta(model):
     
     # Get the introspected attributes
     meta_def = {}
-    for kwd, defn in meta_details.items():
-        try:
-            meta_def[kwd] = get_value(model._meta, defn)
-        except IsDefault:
-            pass
+    for kwd, get in meta_plan():
+        value = get(model._meta)
+        if value is not IsDefault:
+            meta_def[kwd] = format_value(value)
     
     return meta_def
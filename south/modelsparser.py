@@ -4,11 +4,11 @@ way than inspect + regexes.
 Now only used as a fallback when introspection and the South custom hook both fail.
 """
 
-import re
+import ast
+import os
 import inspect
-import parser
-import symbol
 import token
+import tokenize
 import keyword
 import datetime
 
@@ -18,39 +18,6 @@ from django.utils.datastructures import SortedDict
 from django.core.exceptions import ImproperlyConfigured
 
 
-def name_that_thing(thing):
-    "Turns a symbol/token int into its name."
-    for name in dir(symbol):
-        if getattr(symbol, name) == thing:
-            return "symbol.%s" % name
-    for name in dir(token):
-        if getattr(token, name) == thing:
-            return "token.%s" % name
-    return str(thing)
-
-
-def thing_that_name(name):
-    "Turns a name of a symbol/token into its integer value."
-    if name in dir(symbol):
-        return getattr(symbol, name)
-    if name in dir(token):
-        return getattr(token, name)
-    raise ValueError("Cannot convert '%s'" % name)
-
-
-def prettyprint(tree, indent=0, omit_singles=False):
-    "Prettyprints the tree, with symbol/token names. For debugging."
-    if omit_singles and isinstance(tree, tuple) and len(tree) == 2:
-        return prettyprint(tree[1], indent, omit_singles)
-    if isinstance(tree, tuple):
-        return " (\n%s\n" % "".join([prettyprint(x, indent+1) for x in tree]) + \
-            (" " * indent) + ")"
-    elif isinstance(tree, int):
-        return (" " * indent) + name_that_thing(tree)
-    else:
-        return " " + repr(tree)
-
-
 def isclass(obj):
     "Simple test to see if something is a class."
     return issubclass(type(obj), type)
@@ -71,259 +38,123 @@ def aliased_models(module):
     
 
 
-class STTree(object):
-    
-    "A syntax tree wrapper class."
-    
-    def __init__(self, tree):
-        self.tree = tree
-    
-    
-    def __eq__(self, other):
-        return other.tree == self.tree
-    
-    
-    def __hash__(self):
-        return hash(self.tree)
-    
-    
-    @property
-    def root(self):
-        return self.tree[0]
+class ParsedFile(object):
     
+    """
+    A parsed source file; its lines, and its class definitions by
+    (lowercased) name, so each file only needs parsing once.
+    """
     
-    @property
-    def value(self):
-        return self.tree
+    def __init__(self, filename):
+        source = open(filename).read().replace("\r\n", "\n").replace("\r","\n") + "\n"
+        self.lines = source.split("\n")
+        self.classes = {}
+        self.field_defs = {}
+        # Index classes in the order the old parser found them: outer first
+        stack = [ast.parse(source, filename)]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, ast.ClassDef):
+                self.classes.setdefault(node.name.lower(), node)
+            stack.extend(reversed(list(ast.iter_child_nodes(node))))
     
     
-    def walk(self, recursive=True):
+    def get_field_defs(self, name):
         """
-        Yields (symbol, subtree) for the entire subtree.
-        Comes out with node 1, node 1's children, node 2, etc.
+        Returns a dict of {name: (class name, args, kwargs)} for the
+        assignments of calls in the named class's body, or None if the
+        class isn't in this file.
         """
-        stack = [self.tree]
-        done_outer = False
-        while stack:
-            atree = stack.pop()
-            if isinstance(atree, tuple):
-                if done_outer:
-                    yield atree[0], STTree(atree)
-                if recursive or not done_outer:
-                    for bit in reversed(atree[1:]):
-                        stack.append(bit)
-                    done_outer = True
-    
-    
-    def flatten(self):
-        "Yields the tokens/symbols in the tree only, in order."
-        bits = []
-        for sym, subtree in self.walk():
-            if sym in token_map:
-                bits.append(sym)
-            elif sym == token.NAME:
-                bits.append(subtree.value)
-            elif sym == token.STRING:
-                bits.append(subtree.value)
-            elif sym == token.NUMBER:
-                bits.append(subtree.value)
-        return bits
-
-    
-    def reform(self):
-        "Prints how the tree's input probably looked."
-        return reform(self.flatten())
-    
-    
-    def findAllType(self, ntype, recursive=True):
-        "Returns all nodes with the given type in the tree."
-        for symbol, subtree in self.walk(recursive=recursive):
-            if symbol == ntype:
-                yield subtree
-    
-    
-    def find(self, selector):
+        name = name.lower()
+        if name not in self.field_defs:
+            classdef = self.classes.get(name)
+            if classdef is None:
+                return None
+            field_defs = {}
+            for stmt in classdef.body:
+                if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and \
+                   isinstance(stmt.targets[0], ast.Name) and isinstance(stmt.value, ast.Call):
+                    field = self.extract_call(stmt.value)
+                    if field:
+                        field_defs[stmt.targets[0].id] = field
+            self.field_defs[name] = field_defs
+        return self.field_defs[name]
+    
+    
+    def extract_call(self, call):
         """
-        Searches the syntax tree with a CSS-like selector syntax.
-        You can use things like 'suite simple_stmt', 'suite, simple_stmt'
-        or 'suite > simple_stmt'. Not guaranteed to return in order.
+        Returns (class name, args, kwargs) for the call, with the arguments
+        as the source that makes them.
         """
-        # Split up the overall parts
-        patterns = [x.strip() for x in selector.split(",")]
-        results = []
-        for pattern in patterns:
-            # Split up the parts
-            parts = re.split(r'(?:[\s]|(>))+', pattern)
-            # Take the first part, use it for results
-            if parts[0] == "^":
-                subresults = [self]
-            else:
-                subresults = list(self.findAllType(thing_that_name(parts[0])))
-            recursive = True
-            # For each remaining part, do something
-            for part in parts[1:]:
-                if not subresults:
-                    break
-                if part == ">":
-                    recursive = False
-                elif not part:
-                    pass
+        # Tokenize from where the call starts, until its closing bracket.
+        position = [call.lineno - 1]
+        def readline():
+            if position[0] >= len(self.lines):
+                return ""
+            position[0] += 1
+            return self.lines[position[0] - 1] + "\n"
+        clsname = []
+        arguments = [[]]
+        in_call = False
+        depth = 0
+        try:
+            for tok_type, tok_string, start, end, line in tokenize.generate_tokens(readline):
+                if start[0] == 1 and start[1] < call.col_offset:
+                    continue
+                if tok_type in IGNORED_TOKENS:
+                    continue
+                if tok_type == token.OP and tok_string in "([{":
+                    if not in_call and depth == 0 and tok_string == "(":
+                        # The first top-level bracket starts the arguments
+                        in_call = True
+                        depth = 1
+                        continue
+                    depth += 1
+                elif tok_type == token.OP and tok_string in ")]}":
+                    depth -= 1
+                    if in_call and depth == 0:
+                        break
+                if not in_call:
+                    clsname.append((tok_type, tok_string))
+                elif depth == 1 and tok_string == ",":
+                    arguments.append([])
                 else:
-                    thing = thing_that_name(part)
-                    newresults = [
-                        list(tree.findAllType(thing, recursive))
-                        for tree in subresults
-                    ]
-                    subresults = []
-                    for stuff in newresults:
-                        subresults.extend(stuff)
-                    recursive = True
-            results.extend(subresults)
-        return results
-    
-    
-    def __str__(self):
-        return prettyprint(self.tree)
-    __repr__ = __str__
-    
-
-def get_model_tree(model):
-    # Get the source of the model's file
-    source = open(inspect.getsourcefile(model)).read().replace("\r\n", "\n").replace("\r","\n") + "\n"
-    tree = STTree(parser.suite(source).totuple())
-    # Now, we have to find it
-    for poss in tree.find("compound_stmt"):
-        if poss.value[1][0] == symbol.classdef and \
-           poss.value[1][2][1].lower() == model.__name__.lower():
-            # This is the tree
-            return poss
-
-
-token_map = {
-    token.DOT: ".",
-    token.LPAR: "(",
-    token.RPAR: ")",
-    token.EQUAL: "=",
-    token.EQEQUAL: "==",
-    token.COMMA: ",",
-    token.LSQB: "[",
-    token.RSQB: "]",
-    token.AMPER: "&",
-    token.BACKQUOTE: "`",
-    token.CIRCUMFLEX: "^",
-    token.CIRCUMFLEXEQUAL: "^=",
-    token.COLON: ":",
-    token.DOUBLESLASH: "//",
-    token.DOUBLESLASHEQUAL: "//=",
-    token.DOUBLESTAR: "**",
-    token.DOUBLESLASHEQUAL: "**=",
-    token.GREATER: ">",
-    token.LESS: "<",
-    token.GREATEREQUAL: ">=",
-    token.LESSEQUAL: "<=",
-    token.LBRACE: "{",
-    token.RBRACE: "}",
-    token.SEMI: ";",
-    token.PLUS: "+",
-    token.MINUS: "-",
-    token.STAR: "*",
-    token.SLASH: "/",
-    token.VBAR: "|",
-    token.PERCENT: "%",
-    token.TILDE: "~",
-    token.AT: "@",
-    token.NOTEQUAL: "!=",
-    token.LEFTSHIFT: "<<",
-    token.RIGHTSHIFT: ">>",
-    token.LEFTSHIFTEQUAL: "<<=",
-    token.RIGHTSHIFTEQUAL: ">>=",
-    token.PLUSEQUAL: "+=",
-    token.MINEQUAL: "-=",
-    token.STAREQUAL: "*=",
-    token.SLASHEQUAL: "/=",
-    token.VBAREQUAL: "|=",
-    token.PERCENTEQUAL: "%=",
-    token.AMPEREQUAL: "&=",
-}
-
-
-def reform(bits):
-    "Returns the string that the list of tokens/symbols 'bits' represents"
+                    arguments[-1].append((tok_type, tok_string))
+        except (tokenize.TokenError, IndentationError):
+            return None
+        args = []
+        kwargs = {}
+        for argument in arguments:
+            if len(argument) > 2 and argument[0][0] == token.NAME and argument[1][1] == "=":
+                kwargs[argument[0][1]] = reform(argument[2:])
+            elif argument:
+                args.append(reform(argument))
+        return reform(clsname), args, kwargs
+
+
+# Tokens that don't matter to how an expression reads.
+IGNORED_TOKENS = (tokenize.COMMENT, tokenize.NL, token.NEWLINE, token.INDENT, token.DEDENT)
+
+def reform(tokens):
+    "Returns the source the list of (type, string) tokens represents, tidied up."
     output = ""
-    for bit in bits:
-        if bit in token_map:
-            output += token_map[bit]
-        elif bit[0] in [token.NAME, token.STRING, token.NUMBER]:
-            if keyword.iskeyword(bit[1]):
-                output += " %s " % bit[1]
-            else:
-                if bit[1] not in symbol.sym_name:
-                    output += bit[1]
+    for tok_type, tok_string in tokens:
+        if tok_type == token.NAME and keyword.iskeyword(tok_string):
+            output += " %s " % tok_string
+        else:
+            output += tok_string
     return output
 
 
-def parse_arguments(argstr):
-    """
-    Takes a string representing arguments and returns the positional and 
-    keyword argument list and dict respectively.
-    All the entries in these are python source, except the dict keys.
-    """
-    # Get the tree
-    tree = STTree(parser.suite(argstr).totuple())
+# Parsed files, by filename, along with their mtimes.
+parsed_files = {}
 
-    # Initialise the lists
-    curr_kwd = None
-    args = []
-    kwds = {}
-    
-    # Walk through, assigning things
-    testlists = tree.find("testlist")
-    for i, testlist in enumerate(testlists):
-        # BTW: A testlist is to the left or right of an =.
-        items = list(testlist.walk(recursive=False))
-        for j, item in enumerate(items):
-            if item[0] == symbol.test:
-                if curr_kwd:
-                    kwds[curr_kwd] = item[1].reform()
-                    curr_kwd = None
-                elif j == len(items)-1 and i != len(testlists)-1:
-                    # Last item in a group must be a keyword, unless it's last overall
-                    curr_kwd = item[1].reform()
-                else:
-                    args.append(item[1].reform())
-    return args, kwds
-
-
-def extract_field(tree):
-    # Collapses the tree and tries to parse it as a field def
-    bits = tree.flatten()
-    ## Check it looks right:
-    # Second token should be equals
-    if len(bits) < 2 or bits[1] != token.EQUAL:
-        return
-    ## Split into meaningful sections
-    name = bits[0][1]
-    declaration = bits[2:]
-    # Find the first LPAR; stuff before that is the class.
-    try:
-        lpar_at = declaration.index(token.LPAR)
-    except ValueError:
-        return
-    clsname = reform(declaration[:lpar_at])
-    # Now, inside that, find the last RPAR, and we'll take the stuff between
-    # them as the arguments
-    declaration.reverse()
-    rpar_at = (len(declaration) - 1) - declaration.index(token.RPAR)
-    declaration.reverse()
-    args = declaration[lpar_at+1:rpar_at]
-    # Now, extract the arguments as a list and dict
-    try:
-        args, kwargs = parse_arguments(reform(args))
-    except SyntaxError:
-        return
-    # OK, extract and reform it
-    return name, clsname, args, kwargs
-    
+def get_parsed_file(filename):
+    "Returns the ParsedFile for the filename, parsing it if it's changed."
+    mtime = os.path.getmtime(filename)
+    if filename not in parsed_files or parsed_files[filename][0] != mtime:
+        parsed_files[filename] = (mtime, ParsedFile(filename))
+    return parsed_files[filename][1]
 
 
 def get_model_fields(model, m2m=False):
@@ -331,23 +162,21 @@ def get_model_fields(model, m2m=False):
     Given a model class, will return the dict of name: field_constructor
     mappings.
     """
-    tree = get_model_tree(model)
-    if tree is None:
+    parsed_file = get_parsed_file(inspect.getsourcefile(model))
+    field_defs = parsed_file.get_field_defs(model.__name__)
+    if field_defs is None:
         return None
-    possible_field_defs = tree.find("^ > classdef > suite > stmt > simple_stmt > small_stmt > expr_stmt")
-    field_defs = {}
+    # The definitions get fixed up below, so don't change the cached ones.
+    field_defs = dict([
+        (name, (clsname, list(args), dict(kwargs)))
+        for name, (clsname, args, kwargs) in field_defs.items()
+    ])
     
     # Get aliases, ready for alias fixing (#134)
     try:
         aliases = aliased_models(models.get_app(model._meta.app_label))
     except ImproperlyConfigured:
         aliases = {}
-    
-    # Go through all the found defns, and try to parse them
-    for pfd in possible_field_defs:
-        field = extract_field(pfd)
-        if field:
-            field_defs[field[0]] = field[1:]
 
     inherited_fields = {}
     # Go through all bases (that are themselves models, but not Model)
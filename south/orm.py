@@ -5,13 +5,29 @@ Roughly emulates the real Django ORM, to a point.
 
 import inspect
 import datetime
+import decimal
+import os
+import re
+import sys
+import types
+import weakref
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
 
+import django
+
+from django.conf import settings
 from django.db import models
+from django.db.models.fields.related import pending_lookups
 from django.db.models.loading import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.utils import simplejson
 
+import south
 from south.db import db
-from south.utils import ask_for_it_by_name
+from south.utils import ask_for_it_by_name, is_private, open_private, private_directory
 from south.hacks import hacks
 
 
@@ -23,27 +39,244 @@ class ModelsLocals(object):
     (because we store model names as lowercase).
     """
     
-    def __init__(self, data):
+    def __init__(self, data, extra={}):
         self.data = data
+        self.extra = extra
     
     def __getitem__(self, key):
+        try:
+            return self.extra[key]
+        except KeyError:
+            pass
         try:
             return self.data[key]
         except KeyError:
             return self.data[key.lower()]
 
 
-# Stores already-created ORMs.
+# Compiled frozen definitions, by their source.
+_code_cache = {}
+
+def compile_frozen(code):
+    "Compiles (and memoises) a frozen definition string for eval."
+    if code not in _code_cache:
+        _code_cache[code] = compile(code, "<frozen definition>", "eval")
+    return _code_cache[code]
+
+
+class ModelReference(object):
+    """
+    Stands in for one of an ORM's models in a resolved (evaluated) frozen
+    definition, so the definition can be saved and used again later.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+
+
+class ReferencingORM(object):
+    "Stands in for the ORM while resolving; gives ModelReferences for models."
+    
+    def __init__(self, orm):
+        self.orm = orm
+    
+    def __getattr__(self, key):
+        fullname = (self.orm.default_app+"."+key).lower()
+        if fullname not in self.orm.model_sources:
+            raise AttributeError(key)
+        return ModelReference(fullname)
+    
+    def __getitem__(self, key):
+        # Fields can't be referred to, only models
+        key = key.lower()
+        if key not in self.orm.model_sources:
+            raise KeyError(key)
+        return ModelReference(key)
+
+
+def encode_resolved(value):
+    """
+    Turns a resolved definition into plain data that can be saved as JSON
+    (classes and functions become their import paths), so loading it back
+    never runs anything. Raises ValueError for anything else.
+    """
+    if type(value) in (bool, int, float) or value is None:
+        return value
+    if type(value) is long:
+        return {"long": str(value)}
+    if type(value) is unicode:
+        return {"unicode": value}
+    if type(value) is str:
+        return {"str": value.decode("latin-1")}
+    if type(value) in (list, tuple):
+        return {type(value).__name__: [encode_resolved(item) for item in value]}
+    if type(value) is dict:
+        return {"dict": [[encode_resolved(key), encode_resolved(item)] for key, item in value.items()]}
+    if isinstance(value, ModelReference):
+        return {"model": value.name}
+    if type(value) is decimal.Decimal:
+        return {"decimal": str(value)}
+    if type(value) is datetime.datetime and value.tzinfo is None:
+        return {"datetime": list(value.timetuple()[:6]) + [value.microsecond]}
+    if type(value) is datetime.date:
+        return {"date": [value.year, value.month, value.day]}
+    if type(value) is datetime.time and value.tzinfo is None:
+        return {"time": [value.hour, value.minute, value.second, value.microsecond]}
+    if isinstance(value, (type, types.ClassType, types.FunctionType)):
+        path = "%s.%s" % (value.__module__, value.__name__)
+        try:
+            found = ask_for_it_by_name(path)
+        except (ImportError, AttributeError, ValueError):
+            found = None
+        if found is value:
+            return {"path": path}
+    raise ValueError("%r can't be saved in a snapshot." % (value,))
+
+def decode_resolved(data):
+    "Turns data made by encode_resolved back into the resolved definition."
+    if not isinstance(data, dict):
+        return data
+    [(kind, value)] = data.items()
+    if kind == "long":
+        return long(value)
+    if kind == "unicode":
+        return value
+    if kind == "str":
+        return value.encode("latin-1")
+    if kind == "list":
+        return [decode_resolved(item) for item in value]
+    if kind == "tuple":
+        return tuple([decode_resolved(item) for item in value])
+    if kind == "dict":
+        return dict([(decode_resolved(key), decode_resolved(item)) for key, item in value])
+    if kind == "model":
+        return ModelReference(value)
+    if kind == "decimal":
+        return decimal.Decimal(value)
+    if kind == "datetime":
+        return datetime.datetime(*value)
+    if kind == "date":
+        return datetime.date(*value)
+    if kind == "time":
+        return datetime.time(*value)
+    if kind == "path":
+        return ask_for_it_by_name(value)
+    raise ValueError("Unknown snapshot value %r." % (data,))
+
+def read_snapshot(path):
+    "Loads the resolved definitions saved in a snapshot file."
+    fp = open(path, "rb")
+    try:
+        entries = simplejson.load(fp)
+    finally:
+        fp.close()
+    return dict([
+        (tuple([str(part) for part in key]), decode_resolved(value))
+        for key, value in entries
+    ])
+
+def write_snapshot(fp, snapshot):
+    "Writes the resolved definitions out to the (open) snapshot file."
+    simplejson.dump([
+        [list(key), encode_resolved(value)]
+        for key, value in sorted(snapshot.items())
+    ], fp)
+
+
+# Digests of source files, as (mtime, digest), by filename.
+_source_digests = {}
+
+def source_digest(module):
+    "Returns a hash of the module's source file, or '' if it hasn't one."
+    filename = getattr(module, "__file__", None)
+    if not filename:
+        return ""
+    filename = os.path.splitext(filename)[0] + ".py"
+    try:
+        mtime = os.path.getmtime(filename)
+        if _source_digests.get(filename, (None,))[0] != mtime:
+            _source_digests[filename] = (mtime, md5(open(filename, "rb").read()).hexdigest())
+    except (IOError, OSError):
+        return ""
+    return _source_digests[filename][1]
+
+
+# Stores already-created ORMs, by (app, models fingerprint).
 _orm_cache = {}
 
-def FakeORM(*args):
+def normalise_frozen(value):
+    """
+    Turns (part of) a frozen models dict into a form whose repr doesn't
+    depend on dict ordering.
+    """
+    if isinstance(value, dict):
+        return sorted([(key, normalise_frozen(item)) for key, item in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [normalise_frozen(item) for item in value]
+    return value
+
+def flatten_strings(value):
+    "Returns all the strings in (part of) a normalised frozen models dict."
+    if isinstance(value, basestring):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return sum([flatten_strings(item) for item in value], [])
+    return []
+
+def models_fingerprint(frozen_models):
+    "Returns a hash of a frozen models dict; equal for equal dicts."
+    frozen_models = dict([
+        (name, dict(data.items() + [("Meta", data.get("Meta", {}))]))
+        for name, data in frozen_models.items()
+    ])
+    return md5(repr(normalise_frozen(frozen_models))).hexdigest()
+
+def orm_key(cls, app):
+    "Returns the key the ORM for the migration class is cached under."
+    return (app, models_fingerprint(getattr(cls, "models", {})))
+
+def FakeORM(cls, app, bases=()):
     """
     Creates a Fake Django ORM.
     This is actually a memoised constructor; the real class is _FakeORM.
+    Migrations that freeze exactly the same models share the one ORM, so
+    a run of migrations that don't change the models only builds it once.
+    If it does need building, the models it has in common with any of the
+    already-built ORMs in `bases` are taken from there.
+    """
+    return cached_orm(orm_key(cls, app), cls, app, bases)
+
+def cached_orm(key, cls, app, bases=()):
+    """
+    Returns the ORM cached under key, making it if it isn't there.
+    Only the SOUTH_ORM_CACHE_SIZE most recently used ORMs are kept; the
+    models of the rest are let go of, so they can be garbage collected.
+    """
+    if key in _orm_cache:
+        _orm_order.remove(key)
+    else:
+        _orm_cache[key] = _FakeORM(cls, app, bases)
+    _orm_order.append(key)
+    return _orm_cache[key]
+
+def trim_orm_cache():
     """
-    if not args in _orm_cache:
-        _orm_cache[args] = _FakeORM(*args)  
-    return _orm_cache[args]
+    Drops the least recently used ORMs until there are no more than
+    SOUTH_ORM_CACHE_SIZE; their models are let go of, unless another ORM
+    is still using them. This happens after models are made (rather than
+    when ORMs are), so a new ORM gets the chance to reuse its neighbour's.
+    """
+    size = getattr(settings, "SOUTH_ORM_CACHE_SIZE", 10)
+    while size is not None and len(_orm_order) > max(size, 1):
+        evicted = _orm_cache.pop(_orm_order.pop(0))
+        # Models can be shared between ORMs; keep the ones still in use.
+        in_use = set()
+        for orm in _orm_cache.values():
+            in_use.update(orm.built_models())
+        evicted.release(in_use)
+
+# Cache keys, least recently used first.
+_orm_order = []
 
 
 class LazyFakeORM(object):
@@ -53,14 +286,25 @@ class LazyFakeORM(object):
     .orm, and as soon as .orm is accessed the ORM will be created.
     """
     
-    def __init__(self, *args):
-        self._args = args
-        self.orm = None
+    def __init__(self, cls, app, bases=None):
+        self._args = (cls, app)
+        # A callable giving ORMs to build this one from, when it's needed
+        self._bases = bases
+        self._key = None
     
     def __get__(self, obj, type=None):
-        if not self.orm:
-            self.orm = FakeORM(*self._args)
-        return self.orm
+        if self._key is None:
+            self._key = orm_key(*self._args)
+        # The ORM itself isn't kept here, so it can drop out of the cache.
+        if self._key in _orm_cache:
+            return cached_orm(self._key, *self._args)
+        return cached_orm(self._key, *(self._args + (self._bases and self._bases() or (),)))
+    
+    def built(self):
+        "Returns the ORM if it's already been made and is still cached, else None."
+        if self._key is not None:
+            return _orm_cache.get(self._key)
+        return None
 
 
 class _FakeORM(object):
@@ -70,23 +314,35 @@ class _FakeORM(object):
     using a frozen definition on the Migration class.
     """
     
-    def __init__(self, cls, app):
+    def __init__(self, cls, app, bases=()):
         self.default_app = app
         self.cls = cls
         # Try loading the models off the migration class; default to no models.
-        self.models = {}
+        # Models are only made when first asked for; until then (and while
+        # they're being made) their entry in _models is just their name.
+        self._models = {}
+        self.unbuilt = set()
+        self.building = False
+        # The namespaces frozen definitions are evaluated in, by app
+        self.namespaces = {}
+        self.resolving_namespaces = {}
+        # Resolved definitions, as saved to disk; False until loaded
+        self.snapshot = False
+        self.snapshot_changed = False
+        # What each model was made from, so later ORMs can tell what changed.
+        self.model_sources = {}
+        self.components = {}
+        # Already-built ORMs whose models we might be able to reuse; they
+        # might well drop out of the ORM cache before we get to use them.
+        self.bases = [weakref.ref(base) for base in bases if base.default_app == app]
         try:
             self.models_source = cls.models
         except AttributeError:
             return
         
-        # Start a 'new' AppCache
-        hacks.clear_app_cache()
-        
-        # Now, make each model's data into a FakeModel
-        # We first make entries for each model that are just its name
+        # Now, make an entry for each model that's just its name
         # This allows us to have circular model dependency loops
-        model_names = []
+        self.model_data = {}
         for name, data in self.models_source.items():
             # Make sure there's some kind of Meta
             if "Meta" not in data:
@@ -99,27 +355,197 @@ class _FakeORM(object):
                 name = "%s.%s" % (app_name, model_name)
             
             name = name.lower()
-            self.models[name] = name
-            model_names.append((name, app_name, model_name, data))
-        
-        for name, app_name, model_name, data in model_names:
-            self.models[name] = self.make_model(app_name, model_name, data)
-        
-        # And perform the second run to iron out any circular/backwards depends.
-        self.retry_failed_fields()
+            self.set_model(name, name)
+            self.model_sources[name] = (app_name, model_name, normalise_frozen(data))
+            self.model_data[name] = data
+        self.unbuilt = set(self._models)
+        self.find_components()
+    
+    
+    def models(self):
+        "All the models, as a dict of 'app.model': class."
+        for name in list(self.unbuilt):
+            self.build(name)
+        return self._models
+    models = property(models)
+    
+    
+    def find_components(self):
+        """
+        Splits the models into groups that could be linked to each other, by
+        what their frozen definitions might refer to (erring on the side of
+        finding too many), and stores each model's group in self.components.
+        A model's class also holds the relations other models have to it,
+        so each group has to be made (or reused) all at once.
+        """
+        short_names = {}
+        for name in self.model_sources:
+            short_names.setdefault(name.split(".", 1)[1], set()).add(name)
+        components = dict([(name, set([name])) for name in self.model_sources])
+        for name, (app_name, model_name, data) in self.model_sources.items():
+            for code in flatten_strings(data):
+                for token in re.findall(r"[\w.]+", code.lower()):
+                    others = set(short_names.get(token.split(".")[-1], ()))
+                    if token in self.model_sources:
+                        others.add(token)
+                    for other in others:
+                        if components[other] is not components[name]:
+                            merged = components[name] | components[other]
+                            for member in merged:
+                                components[member] = merged
+        self.components = dict([
+            (name, frozenset(component))
+            for name, component in components.items()
+        ])
+    
+    
+    def build(self, name):
+        "Makes the named model, along with the rest of its group."
+        component = self.components[name]
         
-        # Force evaluation of relations on the models now
-        for model in self.models.values():
-            model._meta.get_all_field_names()
+        # If an ORM we already have made the same group from the same
+        # definitions, just use that.
+        for base in self.bases:
+            base = base()
+            if base is not None and base.components.get(name) == component and not (component & base.unbuilt) and \
+               [base.model_sources.get(member) for member in component] == \
+               [self.model_sources[member] for member in component]:
+                for member in component:
+                    self.set_model(member, base._models[member])
+                self.unbuilt -= component
+                trim_orm_cache()
+                return
         
-        # Reset AppCache
-        hacks.unclear_app_cache()
-
+        # Start a 'new' AppCache
+        hacks.clear_app_cache()
+        self.building = True
+        try:
+            for member in sorted(component):
+                app_name, model_name, normalised = self.model_sources[member]
+                self.set_model(member, self.make_model(app_name, model_name, self.model_data[member]))
+            
+            # And perform the second run to iron out any circular/backwards depends.
+            self.retry_failed_fields(component)
+            
+            # Force evaluation of relations on the models now
+            for member in component:
+                self._models[member]._meta.get_all_field_names()
+        except:
+            for member in component:
+                self.set_model(member, member)
+            raise
+        else:
+            self.unbuilt -= component
+        finally:
+            # Reset AppCache
+            hacks.unclear_app_cache()
+            self.building = False
+        if self.snapshot_changed:
+            self.save_snapshot()
+        trim_orm_cache()
+    
+    
+    def set_model(self, name, model):
+        "Sets the model (or its placeholder name) for the lowercased 'app.model' name."
+        self._models[name] = model
+        app, short_name = name.split(".", 1)
+        for namespace_app, namespace in self.namespaces.items():
+            # Models from the namespace's own app win over others
+            if app == namespace_app or "%s.%s" % (namespace_app, short_name) not in self._models:
+                namespace[short_name] = model
+    
+    
+    def namespace(self, app):
+        """
+        Returns the namespace to evaluate frozen definitions for the app in;
+        it's made once per app, and kept up to date by set_model.
+        """
+        if app not in self.namespaces:
+            # Drag in the migration module's locals (hopefully including models.py)
+            namespace = dict(inspect.getmodule(self.cls).__dict__)
+            
+            # Remove all models from that (i.e. from modern models.py), to stop pollution
+            for key, value in namespace.items():
+                if isinstance(value, type) and issubclass(value, models.Model) and hasattr(value, "_meta"):
+                    del namespace[key]
+            
+            # We add our models into the locals for the eval
+            namespace.update(dict([
+                (name.split(".")[-1], model)
+                for name, model in self._models.items()
+            ]))
+            
+            # Make sure the ones for this app override.
+            namespace.update(dict([
+                (name.split(".")[-1], model)
+                for name, model in self._models.items()
+                if name.split(".")[0] == app
+            ]))
+            
+            # Ourselves as orm, to allow non-fail cross-app referencing
+            namespace['orm'] = self
+            
+            # And a fake _ function
+            namespace['_'] = lambda x: x
+            
+            # Datetime; there should be no datetime direct accesses
+            namespace['datetime'] = datetime
+            
+            self.namespaces[app] = namespace
+        return self.namespaces[app]
+    
+    
+    def built_models(self):
+        "Returns the model classes this ORM has made (or reused) so far."
+        return [model for model in self._models.values() if isinstance(model, type)]
+    
+    
+    def release(self, keep=()):
+        """
+        Lets go of the models this ORM has made, apart from those in 'keep';
+        they're taken out of the app cache and anything else that refers to
+        them, so they can be garbage collected. The ORM goes back to how it
+        was before any models were asked for.
+        """
+        released = set(self.built_models()) - set(keep)
+        for model in released:
+            # Take it out of the app cache, should it have got in there
+            app_models = cache.app_models.get(model._meta.app_label, {})
+            if app_models.get(model._meta.object_name.lower()) is model:
+                del app_models[model._meta.object_name.lower()]
+            # And out of any relations waiting on other models to turn up
+            for key, lookups in pending_lookups.items():
+                lookups = [lookup for lookup in lookups if lookup[0] is not model]
+                if lookups:
+                    pending_lookups[key] = lookups
+                else:
+                    del pending_lookups[key]
+            # Remove its relations from models that are staying
+            for field in model._meta.local_fields + model._meta.local_many_to_many:
+                target = field.rel and field.rel.to
+                if isinstance(target, type) and target not in released:
+                    forget_relation(target, model, getattr(field, "related", None))
+        for name in self._models:
+            self._models[name] = name
+        self.unbuilt = set(self._models)
+        self.namespaces = {}
+    
+    
+    def get_model(self, name):
+        """
+        Returns the model with the given lowercased 'app.model' name, making
+        it first if need be. While a group is being made, this just gives
+        the names of models that aren't done yet, as the first pass always has.
+        """
+        if name in self.unbuilt and not self.building:
+            self.build(name)
+        return self._models[name]
+    
     
     def __getattr__(self, key):
         fullname = (self.default_app+"."+key).lower()
         try:
-            return self.models[fullname]
+            return self.get_model(fullname)
         except KeyError:
             raise AttributeError("The model '%s' from the app '%s' is not available in this migration." % (key, self.default_app))
     
@@ -133,7 +559,7 @@ class _FakeORM(object):
         # Now, try getting the model
         key = key.lower()
         try:
-            model = self.models[key]
+            model = self.get_model(key)
         except KeyError:
             try:
                 app, model = key.split(".", 1)
@@ -148,55 +574,34 @@ class _FakeORM(object):
             return model
     
     
+    def resolve_import(self, app, value):
+        """
+        Returns the object at the dotted path 'value', looking for it in the
+        migration's namespace before trying to import it.
+        """
+        # First, try getting it out of locals.
+        parts = value.split(".")
+        try:
+            obj = self.namespace(app)[parts[0]]
+            for part in parts[1:]:
+                obj = getattr(obj, part)
+        except (KeyError, AttributeError):
+            pass
+        else:
+            return obj
+        # OK, try to import it directly
+        return ask_for_it_by_name(value)
+    
+    
     def eval_in_context(self, code, app, extra_imports={}):
         "Evaluates the given code in the context of the migration file."
         
-        # Drag in the migration module's locals (hopefully including models.py)
-        fake_locals = dict(inspect.getmodule(self.cls).__dict__)
-        
-        # Remove all models from that (i.e. from modern models.py), to stop pollution
-        for key, value in fake_locals.items():
-            if isinstance(value, type) and issubclass(value, models.Model) and hasattr(value, "_meta"):
-                del fake_locals[key]
-        
-        # We add our models into the locals for the eval
-        fake_locals.update(dict([
-            (name.split(".")[-1], model)
-            for name, model in self.models.items()
-        ]))
-        
-        # Make sure the ones for this app override.
-        fake_locals.update(dict([
-            (name.split(".")[-1], model)
-            for name, model in self.models.items()
-            if name.split(".")[0] == app
-        ]))
-        
-        # Ourselves as orm, to allow non-fail cross-app referencing
-        fake_locals['orm'] = self
-        
-        # And a fake _ function
-        fake_locals['_'] = lambda x: x
-        
-        # Datetime; there should be no datetime direct accesses
-        fake_locals['datetime'] = datetime
+        imports = {}
         
         # Now, go through the requested imports and import them.
         for name, value in extra_imports.items():
-            # First, try getting it out of locals.
-            parts = value.split(".")
-            try:
-                obj = fake_locals[parts[0]]
-                for part in parts[1:]:
-                    obj = getattr(obj, part)
-            except (KeyError, AttributeError):
-                pass
-            else:
-                fake_locals[name] = obj
-                continue
-            # OK, try to import it directly
             try:
-                fake_locals[name] = ask_for_it_by_name(value)
+                imports[name] = self.resolve_import(app, value)
             except ImportError:
                 if name == "SouthFieldClass":
                     raise ValueError("Cannot import the required field '%s'" % value)
@@ -204,9 +609,191 @@ class _FakeORM(object):
                     print "WARNING: Cannot import '%s'" % value
         
         # Use ModelsLocals to make lookups work right for CapitalisedModels
-        fake_locals = ModelsLocals(fake_locals)
+        fake_locals = ModelsLocals(self.namespace(app), imports)
         
-        return eval(code, globals(), fake_locals)
+        return eval(compile_frozen(code), globals(), fake_locals)
+    
+    
+    ### Snapshots
+    
+    def snapshot_modules(self):
+        """
+        Returns the modules the resolved definitions can depend on: the
+        migration's own, the ones its namespace imports things from, and
+        the ones the frozen field classes live in.
+        """
+        module = inspect.getmodule(self.cls)
+        names = set([module.__name__])
+        for value in module.__dict__.values():
+            if isinstance(value, types.ModuleType):
+                names.add(value.__name__)
+            elif isinstance(value, (type, types.ClassType, types.FunctionType)):
+                names.add(value.__module__)
+        for data in self.models_source.values():
+            for params in data.values():
+                if isinstance(params, (list, tuple)) and params and isinstance(params[0], basestring):
+                    names.add(params[0].rsplit(".", 1)[0])
+        modules = []
+        for name in sorted(names):
+            try:
+                modules.append(__import__(str(name), {}, {}, [""]))
+            except Exception:
+                # Not a module (e.g. "models.CharField"); the namespace
+                # it's looked up in is covered already.
+                pass
+        return modules
+    
+    
+    def snapshot_path(self):
+        """
+        Returns the file this ORM's resolved definitions are saved in, or
+        None if they aren't. It's keyed on the frozen models, the Django
+        and South versions, and the source of the migration and of every
+        module its definitions could come from.
+        """
+        if not getattr(settings, "SOUTH_ORM_SNAPSHOT_CACHE", False):
+            return None
+        # Only we should be able to write to the snapshots
+        dirname = private_directory("south-orm", getattr(settings, "SOUTH_ORM_SNAPSHOT_DIR", None))
+        if dirname is None:
+            return None
+        if not source_digest(inspect.getmodule(self.cls)):
+            return None
+        digest = md5(django.get_version())
+        digest.update(south.__version__)
+        digest.update(self.default_app)
+        digest.update(models_fingerprint(self.models_source))
+        for module in self.snapshot_modules():
+            digest.update("%s:%s;" % (module.__name__, source_digest(module)))
+        return os.path.join(dirname, "south_orm_%s.json" % digest.hexdigest())
+    
+    
+    def snapshot_data(self):
+        """
+        Returns the dict of resolved definitions, loading it from disk the
+        first time; or None if snapshots are turned off.
+        """
+        if self.snapshot is False:
+            path = self.snapshot_path()
+            self.snapshot = None
+            if path is not None:
+                self.snapshot = {}
+                if is_private(path):
+                    try:
+                        self.snapshot = read_snapshot(path)
+                    except Exception:
+                        # Anything odd (say, a field class that's moved) and
+                        # we just evaluate everything again.
+                        pass
+        return self.snapshot
+    
+    
+    def save_snapshot(self):
+        "Writes out the resolved definitions, should anything new be resolved."
+        path = self.snapshot_path()
+        self.snapshot_changed = False
+        if path is None:
+            return
+        temp_path = "%s.%s" % (path, os.getpid())
+        try:
+            fp = open_private(temp_path)
+            write_snapshot(fp, self.snapshot)
+            fp.close()
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            # It's only a cache.
+            pass
+    
+    
+    def remember(self, key, value):
+        "Adds the resolved definition to the snapshot, if it can be saved."
+        try:
+            encode_resolved(value)
+        except ValueError:
+            return
+        self.snapshot[key] = value
+        self.snapshot_changed = True
+    
+    
+    def resolving_namespace(self, app):
+        """
+        Returns the app's namespace, but with models (and orm) giving
+        ModelReferences instead, for resolving definitions to save.
+        """
+        if app not in self.resolving_namespaces:
+            namespace = dict(self.namespace(app))
+            namespace.update(dict([
+                (name.split(".")[-1], ModelReference(name))
+                for name in self._models
+            ]))
+            namespace.update(dict([
+                (name.split(".")[-1], ModelReference(name))
+                for name in self._models
+                if name.split(".")[0] == app
+            ]))
+            namespace['orm'] = ReferencingORM(self)
+            self.resolving_namespaces[app] = namespace
+        return self.resolving_namespaces[app]
+    
+    
+    def resolve(self, code, app):
+        "Evaluates the code, with models as ModelReferences."
+        return eval(compile_frozen(code), globals(), ModelsLocals(self.resolving_namespace(app)))
+    
+    
+    def dereference(self, value):
+        "Replaces ModelReferences in a resolved value with the models."
+        if isinstance(value, ModelReference):
+            return self.get_model(value.name)
+        if isinstance(value, list):
+            return [self.dereference(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple([self.dereference(item) for item in value])
+        if isinstance(value, dict):
+            return dict([(key, self.dereference(item)) for key, item in value.items()])
+        return value
+    
+    
+    def make_meta_value(self, app, model_key, key, code):
+        "Returns the value for the Meta option, from the snapshot if possible."
+        snapshot = self.snapshot_data()
+        if snapshot is None:
+            return self.eval_in_context(code, app)
+        snapshot_key = ("meta", model_key, key)
+        if snapshot_key not in snapshot:
+            try:
+                value = self.resolve(code, app)
+            except Exception:
+                return self.eval_in_context(code, app)
+            self.remember(snapshot_key, value)
+            return self.dereference(value)
+        return self.dereference(snapshot[snapshot_key])
+    
+    
+    def make_field(self, app, model_key, fname, code, extra_imports, params=None):
+        """
+        Makes the field, from the snapshot if possible. 'params' is the
+        field's (class, args, kwargs) triple, if it has one; premade
+        definition strings are always just evaluated.
+        """
+        snapshot = self.snapshot_data()
+        if snapshot is None or params is None:
+            return self.eval_in_context(code, app, extra_imports)
+        snapshot_key = ("field", model_key, fname)
+        definition = snapshot.get(snapshot_key)
+        if definition is None:
+            try:
+                field_class = self.resolve_import(app, params[0])
+                definition = (
+                    field_class,
+                    [self.resolve(arg, app) for arg in params[1]],
+                    dict([(str(name), self.resolve(value, app)) for name, value in params[2].items()]),
+                )
+            except Exception:
+                return self.eval_in_context(code, app, extra_imports)
+            self.remember(snapshot_key, definition)
+        field_class, args, kwargs = definition
+        return field_class(*self.dereference(args), **self.dereference(kwargs))
     
     
     def make_meta(self, app, model, data, stub=False):
@@ -221,7 +808,7 @@ class _FakeORM(object):
                 continue
             # OK, add it.
             try:
-                results[key] = self.eval_in_context(code, app)
+                results[key] = self.make_meta_value(app, ("%s.%s" % (app, model)).lower(), key, code)
             except (NameError, AttributeError), e:
                 raise ValueError("Cannot successfully create meta field '%s' for model '%s.%s': %s." % (
                     key, app, model, e
@@ -240,6 +827,7 @@ class _FakeORM(object):
         
         # Turn the Meta dict into a basic class
         meta = self.make_meta(app, name, data['Meta'], data.get("_stub", False))
+        model_key = ("%s.%s" % (app, name)).lower()
         
         failed_fields = {}
         fields = {}
@@ -259,6 +847,7 @@ class _FakeORM(object):
                 # It's a premade definition string! Let's hope it works...
                 code = params
                 extra_imports = {}
+                params = None
             else:
                 # If there's only one parameter (backwards compat), make it 3.
                 if len(params) == 1:
@@ -275,11 +864,11 @@ class _FakeORM(object):
             
             try:
                 # Execute it in a probably-correct context.
-                field = self.eval_in_context(code, app, extra_imports)
+                field = self.make_field(app, model_key, fname, code, extra_imports, params)
             except (NameError, AttributeError, AssertionError, KeyError):
                 # It might rely on other models being around. Add it to the
                 # model for the second pass.
-                failed_fields[fname] = (code, extra_imports)
+                failed_fields[fname] = (code, extra_imports, params)
             else:
                 fields[fname] = field
         
@@ -317,14 +906,18 @@ class _FakeORM(object):
         
         return model
     
-    def retry_failed_fields(self):
-        "Tries to re-evaluate the _failed_fields for each model."
-        for modelkey, model in self.models.items():
+    def retry_failed_fields(self, names):
+        "Tries to re-evaluate the _failed_fields for each of the named models."
+        for modelkey in names:
+            model = self._models[modelkey]
             app, modelname = modelkey.split(".", 1)
-            if hasattr(model, "_failed_fields"):
-                for fname, (code, extra_imports) in model._failed_fields.items():
+            if "_failed_fields" in model.__dict__:
+                failed_fields = model._failed_fields
+                # Later ORMs might reuse this model; don't add these twice.
+                del model._failed_fields
+                for fname, (code, extra_imports, params) in failed_fields.items():
                     try:
-                        field = self.eval_in_context(code, app, extra_imports)
+                        field = self.make_field(app, modelkey, fname, code, extra_imports, params)
                     except (NameError, AttributeError, AssertionError, KeyError), e:
                         # It's failed again. Complain.
                         raise ValueError("Cannot successfully create field '%s' for model '%s': %s." % (
@@ -335,6 +928,30 @@ class _FakeORM(object):
                         model.add_to_class(fname, field)
 
 
+def forget_relation(target, model, related):
+    """
+    Removes what a relation from 'model' added to the 'target' model: the
+    accessor descriptor, and its entries in target's cached related objects.
+    """
+    if related is not None:
+        accessor = related.get_accessor_name()
+        descriptor = target.__dict__.get(accessor)
+        if getattr(getattr(descriptor, "related", None), "model", None) is model:
+            delattr(target, accessor)
+    opts = target._meta
+    for attr in ("_related_objects_cache", "_related_many_to_many_cache"):
+        related_cache = opts.__dict__.get(attr)
+        if related_cache:
+            for related_object in list(related_cache.keys()):
+                if related_object.model is model:
+                    del related_cache[related_object]
+    name_map = opts.__dict__.get("_name_map")
+    if name_map:
+        for name, value in name_map.items():
+            if getattr(value[0], "model", None) is model and not value[2]:
+                del name_map[name]
+
+
 class WhinyManager(object):
     "A fake manager that whines whenever you try to touch it. For stub models."
     
@@ -354,6 +971,8 @@ class NoDryRunManager(object):
     def __getattr__(self, name):
         if db.dry_run:
             raise AttributeError("You are in a dry run, and cannot access the ORM.\nWrap ORM sections in 'if not db.dry_run:', or if the whole migration is only a data migration, set no_dry_run = True on the Migration class.")
+        # Make sure the tables look like the models do
+        db.apply_pending_alterations()
         return getattr(self.real, name)
 
 
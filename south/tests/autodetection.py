@@ -1,6 +1,14 @@
+import os
+import tempfile
 import unittest
 
+from django.conf import settings
+from django.db import models
+
+from south import modelsinspector, modelsparser
 from south.management.commands import startmigration
+from south.migration.base import Migrations
+from south.tests import Monkeypatcher
 
 class TestComparison(unittest.TestCase):
     
@@ -230,4 +238,339 @@ class TestComparison(unittest.TestCase):
                 ('django.db.models.fields.IntField', [], {'to':'hah'}),
             ),
             True,
-        )
\ No newline at end of file
+        )
+
+    
+    
+    def test_signatures(self):
+        "Definitions that only differ in how they're written have equal signatures."
+        self.assertEqual(
+            startmigration.field_signature(
+                ('models.ForeignKey', [], {'to': "orm['southdemo.Lizard']", 'default': '"x"', 'related_name': "'a'"}),
+            ),
+            startmigration.field_signature(
+                ('django.db.models.fields.related.ForeignKey', [], {'default': "'x'", 'to': 'orm["southdemo.lizard"]'}),
+            ),
+        )
+        self.assertNotEqual(
+            startmigration.field_signature(('models.IntegerField', [], {'default': '1'})),
+            startmigration.field_signature(('models.IntegerField', [], {'default': 'True'})),
+        )
+        self.assertNotEqual(
+            startmigration.field_signature(('models.IntegerField', [], {'unique': 'True'})),
+            startmigration.field_signature(('models.IntegerField', [], {})),
+        )
+        self.assertNotEqual(
+            startmigration.field_signature(('myapp.fields.IntegerField', [], {})),
+            startmigration.field_signature(('models.IntegerField', [], {})),
+        )
+    
+    
+    def test_models_diff(self):
+        "Only models and fields whose signatures differ come out as changed."
+        old = {
+            'southdemo.lizard': {
+                'Meta': {'unique_together': "(('age', 'name'),)"},
+                'age': ('models.IntegerField', [], {'default': "'1'"}),
+                'name': ('models.CharField', [], {'max_length': '10', 'unique': 'True'}),
+            },
+        }
+        new = {
+            'southdemo.lizard': {
+                'Meta': {'unique_together': "[['name', 'age'], ['age', 'name']]"},
+                'age': ('django.db.models.fields.IntegerField', [], {'default': '"1"'}),
+                'name': ('models.CharField', [], {'max_length': '11'}),
+            },
+        }
+        am, dm, cm, af, df, cf, afu, dfu = startmigration.models_diff(old, new)
+        self.assertEqual(set(['southdemo.lizard']), cm)
+        self.assertEqual(['name'], [fieldname for key, fieldname, old_triple, new_triple in cf])
+        self.assertEqual(set([('southdemo.lizard', ('name',))]), dfu)
+        self.assertEqual(
+            (set([('name', 'age')]), set()),
+            startmigration.meta_diff(old['southdemo.lizard']['Meta'], new['southdemo.lizard']['Meta']),
+        )
+    
+    
+    def test_schema_fingerprint(self):
+        "Fingerprints only change when models_diff would find something."
+        old = {
+            'southdemo.lizard': {
+                'Meta': {'unique_together': "(('age', 'name'),)", 'verbose_name': "'lizard'"},
+                'age': ('models.IntegerField', [], {'default': "'1'"}),
+            },
+        }
+        same = {
+            'southdemo.lizard': {
+                'Meta': {'unique_together': "[['age', 'name']]"},
+                'age': ('django.db.models.fields.IntegerField', [], {'default': '"1"', 'related_name': "'x'"}),
+            },
+        }
+        self.assertEqual(startmigration.schema_fingerprint(old), startmigration.schema_fingerprint(same))
+        changed = {
+            'southdemo.lizard': {
+                'age': ('models.IntegerField', [], {'default': "'1'"}),
+            },
+        }
+        self.assertNotEqual(startmigration.schema_fingerprint(old), startmigration.schema_fingerprint(changed))
+        self.assertNotEqual(startmigration.schema_fingerprint(old), startmigration.schema_fingerprint({}))
+    
+    
+    def test_dependency_order(self):
+        "Apps come after the ones they need, and loops get broken."
+        order, dropped = startmigration.dependency_order({
+            'blog': ['shop', 'auth'],
+            'shop': ['stock'],
+            'stock': [],
+        })
+        self.assertEqual(['stock', 'shop', 'blog'], order)
+        self.assertEqual([], dropped)
+        order, dropped = startmigration.dependency_order({
+            'blog': ['shop'],
+            'shop': ['blog'],
+        })
+        self.assertEqual(['shop', 'blog'], order)
+        self.assertEqual([('shop', 'blog')], dropped)
+    
+    def test_plan_dependencies(self):
+        "Loops between apps fall back on the migrations already written."
+        latest = {'blog': '0002_second', 'shop': '0002_second', 'auth': '0001_initial'}
+        existing = {'blog': '0001_initial', 'shop': '0001_initial', 'auth': '0001_initial'}
+        # Each refers to a model the other already had
+        order, depends_on, unordered = startmigration.plan_dependencies(
+            {'blog': set(['shop.item', 'auth.user']), 'shop': set(['blog.post'])},
+            {'blog': set(), 'shop': set()},
+            latest,
+            existing,
+        )
+        self.assertEqual(['shop', 'blog'], order)
+        self.assertEqual([('auth', '0001_initial'), ('shop', '0002_second')], depends_on['blog'])
+        self.assertEqual([('blog', '0001_initial')], depends_on['shop'])
+        self.assertEqual([], unordered)
+        # Whereas if shop refers to a model blog's only now adding, it can't
+        order, depends_on, unordered = startmigration.plan_dependencies(
+            {'blog': set(['shop.item']), 'shop': set(['blog.post'])},
+            {'blog': set(['blog.post']), 'shop': set()},
+            latest,
+            existing,
+        )
+        self.assertEqual([], depends_on['shop'])
+        self.assertEqual([('shop', 'blog')], unordered)
+
+class TestFreezeContext(Monkeypatcher):
+    
+    """
+    Tests remembering frozen definitions and dependencies during a run.
+    """
+    
+    installed_apps = ["fakeapp"]
+    
+    def test_freezing(self):
+        "Definitions are worked out once, and handed out as copies."
+        HorribleModel = models.get_model("fakeapp", "horriblemodel")
+        freezer = startmigration.FreezeContext()
+        frozen = freezer.prep_for_freeze(HorribleModel)
+        self.assertEqual(frozen, startmigration.prep_for_freeze(HorribleModel))
+        self.assertEqual(('django.db.models.fields.CharField', [], {'max_length': '20'}), frozen['choiced'])
+        frozen['choiced'][2]['max_length'] = '1'
+        del frozen['Meta']
+        frozen = freezer.prep_for_freeze(HorribleModel)
+        self.assertEqual('20', frozen['choiced'][2]['max_length'])
+        self.assert_('Meta' in frozen)
+        self.assertEqual([HorribleModel], freezer.fields.keys())
+    
+    def test_dependencies(self):
+        "Dependencies are followed all the way through, and remembered."
+        HorribleModel = models.get_model("fakeapp", "horriblemodel")
+        freezer = startmigration.FreezeContext()
+        dependencies = freezer.model_dependencies(HorribleModel)
+        self.assertEqual(
+            set(["other1", "other2", "user", "group", "permission", "contenttype"]),
+            set([model._meta.object_name.lower() for model in dependencies]),
+        )
+        self.assertEqual(dependencies, startmigration.model_dependencies(HorribleModel))
+        self.assertEqual(freezer.dependency_closure(HorribleModel), set(dependencies))
+
+
+class TestAutoChanges(Monkeypatcher):
+    
+    """
+    Tests finding what's changed since an app's last migration.
+    """
+    
+    installed_apps = ["fakeapp"]
+    
+    def test_deleted(self):
+        "Models and fields that have gone come out of the last migration's ORM."
+        freezer = startmigration.FreezeContext()
+        frozen = {}
+        for model in models.get_models(models.get_app("fakeapp")):
+            for dependency in [model] + freezer.model_dependencies(model).keys():
+                frozen[startmigration.model_key(dependency)] = freezer.prep_for_freeze(dependency)
+        frozen['fakeapp.other1']['colour'] = ('django.db.models.fields.CharField', [], {'max_length': '10'})
+        frozen['fakeapp.ghost'] = {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'other': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['fakeapp.Other1']"}),
+        }
+        migration = Migrations("fakeapp")[-1]
+        migration_class = migration.migration_class()
+        old_models = migration_class.models
+        migration_class.models, migration_class.complete_apps = frozen, ["fakeapp"]
+        try:
+            changes = startmigration.auto_changes("fakeapp", freezer)
+        finally:
+            migration_class.models = old_models
+            del migration_class.complete_apps
+            del migration._lazy_orm
+        added_models, deleted_models, added_fields, deleted_fields, changed_fields = changes[:5]
+        self.assertEqual((set(), set(), []), (added_models, added_fields, changed_fields))
+        self.assertEqual(["ghost"], [model._meta.object_name.lower() for model, fields, last_models in deleted_models])
+        self.assertEqual(["id", "other"], sorted(deleted_models[0][1].keys()))
+        self.assertEqual(
+            [("fakeapp.other1", "colour")],
+            [(mkey, field_name) for mkey, field_name, field, triple, last_models in deleted_fields],
+        )
+        self.assertEqual(10, deleted_fields[0][2].max_length)
+    
+    def test_references(self):
+        "New models only depend on what their own fields refer to."
+        changes = (set(["fakeapp.horriblemodel"]), [], set(), [], [])
+        self.assertEqual(
+            set(["auth.user"]),
+            startmigration.changes_references("fakeapp", changes, startmigration.FreezeContext()),
+        )
+
+
+class TaggedField(models.CharField):
+    "A stand-in for a third-party field."
+    
+    def __init__(self, separator=",", *args, **kwargs):
+        self.separator = separator
+        super(TaggedField, self).__init__(*args, **kwargs)
+
+
+class ListField(models.TextField):
+    "Another one."
+
+
+class OwnTaggedField(TaggedField):
+    "One that says it can be introspected."
+    _south_introspects = True
+
+
+class TestIntrospectionRules(unittest.TestCase):
+    
+    """
+    Tests adding introspection rules for fields outside Django.
+    """
+    
+    def setUp(self):
+        self.allowed_fields = list(modelsinspector.allowed_fields)
+        self.introspection_details = list(modelsinspector.introspection_details)
+        self.rules_loaded = modelsinspector.load_rules_files.done
+    
+    def tearDown(self):
+        # Put the rules back how they were, and forget what was made from ours
+        modelsinspector.load_rules_files.done = self.rules_loaded
+        modelsinspector.allowed_fields[:] = self.allowed_fields
+        modelsinspector.introspection_details[:] = self.introspection_details
+        modelsinspector.introspection_plans.clear()
+        modelsinspector.introspectable_classes.clear()
+    
+    def test_add_rules(self):
+        "Fields matching added patterns are introspected, with their extra rules."
+        field = TaggedField(separator=";", max_length=100)
+        self.assertEqual(modelsinspector.can_introspect(field), False)
+        self.assertEqual(modelsinspector.get_field_triple(field), None)
+        modelsinspector.add_introspection_rules(
+            patterns = [r"^south\.tests\.autodetection\.TaggedField"],
+            rules = [(
+                ["south.tests.autodetection.TaggedField"],
+                [],
+                {"separator": ["separator", {"default": ","}]},
+            )],
+        )
+        self.assertEqual(
+            modelsinspector.get_field_triple(field),
+            ('south.tests.autodetection.TaggedField', [], {'max_length': '100', 'separator': "';'"}),
+        )
+        self.assertEqual(
+            modelsinspector.get_field_triple(TaggedField(max_length=100)),
+            ('south.tests.autodetection.TaggedField', [], {'max_length': '100'}),
+        )
+    
+    def test_rules_file(self):
+        "Rules can be loaded from a JSON file."
+        fd, filename = tempfile.mkstemp(".json")
+        os.write(fd, """[{
+            "patterns": ["^south\\\\.tests\\\\.autodetection\\\\.ListField$"],
+            "rules": [[["south.tests.autodetection.ListField"], [], {"db_index": ["db_index", {"default": true}]}]]
+        }]""")
+        os.close(fd)
+        try:
+            modelsinspector.load_introspection_rules(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(
+            modelsinspector.get_field_triple(ListField()),
+            ('south.tests.autodetection.ListField', [], {'db_index': 'False'}),
+        )
+    
+    def test_rules_setting(self):
+        "Rules files in the settings apply to fields that say they can be introspected, too."
+        fd, filename = tempfile.mkstemp(".json")
+        os.write(fd, """[{
+            "rules": [[["south.tests.autodetection.TaggedField"], [], {"separator": ["separator", {"default": ","}]}]]
+        }]""")
+        os.close(fd)
+        old_rules = getattr(settings, "SOUTH_INTROSPECTION_RULES", None)
+        settings.SOUTH_INTROSPECTION_RULES = [filename]
+        modelsinspector.load_rules_files.done = False
+        try:
+            triple = modelsinspector.get_field_triple(OwnTaggedField(separator=";", max_length=100))
+        finally:
+            if old_rules is None:
+                del settings.SOUTH_INTROSPECTION_RULES
+            else:
+                settings.SOUTH_INTROSPECTION_RULES = old_rules
+            os.remove(filename)
+        self.assertEqual(
+            ('south.tests.autodetection.OwnTaggedField', [], {'max_length': '100', 'separator': "';'"}),
+            triple,
+        )
+
+
+class TestModelsParser(unittest.TestCase):
+    
+    """
+    Tests the fallback models.py parser.
+    """
+    
+    def test_parsed_file_cache(self):
+        "Files are parsed once, and again only when their mtime changes."
+        source = open(os.path.join(os.path.dirname(__file__), "fakeapp", "models.py")).read()
+        fd, filename = tempfile.mkstemp(".py")
+        os.write(fd, source)
+        os.close(fd)
+        try:
+            parsed = modelsparser.get_parsed_file(filename)
+            self.assertEqual(
+                ('models.CharField', [], {'max_length': '255'}),
+                parsed.get_field_defs("HorribleModel")['name'],
+            )
+            self.assertEqual(None, parsed.get_field_defs("Lettuce"))
+            # Unchanged, it's not parsed again
+            self.assert_(parsed is modelsparser.get_parsed_file(filename))
+            # Changed, it is
+            open(filename, "a").write("\nclass Lettuce(models.Model):\n    leaves = models.IntegerField(default=8)\n")
+            mtime = os.path.getmtime(filename)
+            os.utime(filename, (mtime + 10, mtime + 10))
+            reparsed = modelsparser.get_parsed_file(filename)
+            self.assert_(reparsed is not parsed)
+            self.assertEqual(
+                {'leaves': ('models.IntegerField', [], {'default': '8'})},
+                reparsed.get_field_defs("Lettuce"),
+            )
+        finally:
+            modelsparser.parsed_files.pop(filename, None)
+            os.remove(filename)
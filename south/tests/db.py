@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 from south.db import db
+from django.conf import settings
 from django.db import connection, models
 
 # Create a list of error classes from the various database libraries
@@ -81,6 +85,39 @@ class TestOperations(unittest.TestCase):
         db.execute_deferred_sql()
         db.rollback_transaction()
     
+    def test_not_valid_foreign_keys(self):
+        """
+        Tests adding foreign keys as NOT VALID and validating them later.
+        """
+        if db.backend_name != "postgres":
+            return
+        Test = db.mock_model(model_name='Test', db_table='test_nv_a',
+                             db_tablespace='', pk_field_name='id',
+                             pk_field_type=models.AutoField, pk_field_args=[])
+        db.not_valid_foreign_keys = True
+        try:
+            db.start_transaction()
+            db.create_table("test_nv_a", [('id', models.AutoField(primary_key=True))])
+            db.create_table("test_nv_b", [
+                ('id', models.AutoField(primary_key=True)),
+                ('a', models.ForeignKey(Test)),
+            ])
+            db.execute_deferred_sql()
+            # Someone else's NOT VALID constraint is none of our business
+            db.execute('ALTER TABLE "test_nv_b" ADD CONSTRAINT "test_nv_other" FOREIGN KEY ("a_id") REFERENCES "test_nv_a" ("id") NOT VALID;')
+            constraint = db.foreign_key_name("test_nv_b", "a_id", "test_nv_a", "id")
+            # Renames since don't stop it being found
+            db.rename_table("test_nv_b", "test_nv_c")
+            db.rename_column("test_nv_c", "a_id", "b_id")
+            db.commit_transaction()
+            validated = db.validate_constraints()
+            self.assertEqual([("test_nv_c", constraint)], validated)
+            self.assertEqual([], db.validate_constraints())
+        finally:
+            db.not_valid_foreign_keys = False
+            db.delete_table("test_nv_c")
+            db.delete_table("test_nv_a")
+    
     def test_rename(self):
         """
         Test column renaming
@@ -166,6 +203,34 @@ class TestOperations(unittest.TestCase):
         db.rollback_transaction()
         db.delete_table("test3")
     
+    def test_defer_indexes(self):
+        """
+        Tests holding index creation back until the end of the plan.
+        """
+        db.defer_indexes = True
+        try:
+            db.create_table("test_defer", [
+                ('eggs', models.IntegerField(db_index=True)),
+                ('spam', models.IntegerField(db_index=True)),
+            ])
+            db.execute_deferred_sql()
+            self.assertEqual(2, len(db.plan_deferred_sql))
+            # The same statement is only held once
+            db.column_sql("test_defer", "eggs", models.IntegerField(db_index=True))
+            self.assertEqual(2, len(db.plan_deferred_sql))
+            # Deleting the column throws its index away rather than making it
+            db.delete_column("test_defer", "spam")
+            self.assertEqual([], [
+                sql for tables, columns, sql in db.plan_deferred_sql
+                if ("test_defer", "spam") in columns
+            ])
+            # As does deleting the table, so nothing is left dangling
+            db.delete_table("test_defer")
+            self.assertEqual([], db.plan_deferred_sql)
+        finally:
+            db.defer_indexes = False
+            db.plan_deferred_sql = []
+    
     def test_primary_key(self):
         """
         Test the primary key operations
@@ -204,6 +269,240 @@ class TestOperations(unittest.TestCase):
         db.rollback_transaction()
         db.delete_table("test4")
         
+    def test_add_column_staged(self):
+        """
+        Tests adding a NOT NULL column to a table with rows in stages
+        (or, where staging doesn't help, in one go).
+        """
+        db.create_table("test_staged", [
+            ('id', models.AutoField(primary_key=True)),
+            ('eggs', models.IntegerField()),
+        ])
+        db.execute("INSERT INTO test_staged (eggs) VALUES (1), (2), (3)")
+        db.start_transaction()
+        db.add_column("test_staged", "spam", models.IntegerField(default=7), staged=True)
+        db.commit_transaction()
+        self.assertEqual([(7,), (7,), (7,)], list(db.execute("SELECT spam FROM test_staged")))
+        # It must have ended up NOT NULL
+        db.start_transaction()
+        try:
+            db.execute("INSERT INTO test_staged (eggs, spam) VALUES (4, NULL)")
+        except:
+            db.rollback_transaction()
+        else:
+            self.fail("Could insert NULL into a staged NOT NULL column.")
+        db.delete_table("test_staged")
+    
+    def test_backfill_column(self):
+        """
+        Tests backfilling a column in primary key batches.
+        """
+        db.create_table("test_backfill", [
+            ('id', models.AutoField(primary_key=True)),
+            ('spam', models.IntegerField(null=True)),
+        ])
+        db.execute("INSERT INTO test_backfill (spam) VALUES (NULL), (3), (NULL), (NULL), (NULL)")
+        updates = []
+        execute = db.execute
+        def recording_execute(sql, params=[]):
+            if sql.startswith("UPDATE"):
+                updates.append(list(params))
+            return execute(sql, params)
+        db.execute = recording_execute
+        batch_size, db.backfill_batch_size = db.backfill_batch_size, 2
+        db.start_transaction()
+        try:
+            db._backfill_column("test_backfill", "spam", 7)
+        finally:
+            db.commit_transaction()
+            db.backfill_batch_size = batch_size
+            del db.execute
+        # One UPDATE per batch of primary keys, leaving set values alone
+        self.assertEqual([[7, 1, 3], [7, 3, 5], [7, 5, 7]], updates)
+        self.assertEqual(
+            [(7,), (3,), (7,), (7,), (7,)],
+            list(db.execute("SELECT spam FROM test_backfill ORDER BY id")),
+        )
+        db.delete_table("test_backfill")
+    
+    def test_sqlite_batched_rebuild(self):
+        """
+        Tests that SQLite column changes to one table are done with a single
+        rebuild, keeping the data and indexes.
+        """
+        if db.backend_name != "sqlite3":
+            return
+        db.create_table("test_rebuild", [
+            ('id', models.AutoField(primary_key=True)),
+            ('spam', models.IntegerField(db_index=True)),
+            ('eggs', models.IntegerField(unique=True)),
+            ('ham', models.IntegerField()),
+        ])
+        db.execute_deferred_sql()
+        db.execute("INSERT INTO test_rebuild (spam, eggs, ham) VALUES (1, 2, 3)")
+        creates = []
+        old_execute = db.execute
+        def recording_execute(sql, params=[]):
+            if sql.startswith("CREATE TABLE"):
+                creates.append(sql)
+            return old_execute(sql, params)
+        db.execute = recording_execute
+        try:
+            db.rename_column("test_rebuild", "spam", "bacon")
+            db.delete_column("test_rebuild", "ham")
+            db.alter_column("test_rebuild", "eggs", models.IntegerField(null=True, unique=True))
+            db.execute_deferred_sql()
+        finally:
+            db.execute = old_execute
+        self.assertEqual(1, len(creates))
+        self.assertEqual([(1, 1, 2)], list(db.execute("SELECT id, bacon, eggs FROM test_rebuild")))
+        indexed = [row[1] for row in db.execute("PRAGMA index_list(test_rebuild)")]
+        self.assertEqual(2, len(indexed))
+        db.delete_table("test_rebuild")
+    
+    def test_sqlite_native_alter(self):
+        """
+        Tests that newer SQLites rename and drop columns without a rebuild.
+        """
+        if db.backend_name != "sqlite3" or not (db.supports_rename_column and db.supports_drop_column):
+            return
+        db.create_table("test_native", [
+            ('id', models.AutoField(primary_key=True)),
+            ('spam', models.IntegerField()),
+            ('eggs', models.IntegerField(db_index=True)),
+        ])
+        db.execute_deferred_sql()
+        db.execute("INSERT INTO test_native (spam, eggs) VALUES (1, 2)")
+        executed = []
+        old_execute = db.execute
+        def recording_execute(sql, params=[]):
+            executed.append(sql)
+            return old_execute(sql, params)
+        db.execute = recording_execute
+        try:
+            db.rename_column("test_native", "spam", "bacon")
+            db.delete_column("test_native", "eggs")
+            db.execute_deferred_sql()
+        finally:
+            db.execute = old_execute
+        self.assertEqual([], [sql for sql in executed if sql.startswith("CREATE TABLE")])
+        self.assertEqual([(1, 1)], list(db.execute("SELECT id, bacon FROM test_native")))
+        db.delete_table("test_native")
+    
+    def test_sqlite_rollback_alterations(self):
+        """
+        Tests that queued SQLite alterations go when their transaction does.
+        """
+        if db.backend_name != "sqlite3":
+            return
+        def notnull():
+            return [row[3] for row in db.execute("PRAGMA table_info(test_rbq)") if row[1] == "a"]
+        db.create_table("test_rbq", [('id', models.AutoField(primary_key=True)), ('a', models.IntegerField(null=True))])
+        db.start_transaction()
+        db.alter_column("test_rbq", "a", models.IntegerField(default=1))
+        db.rollback_transaction()
+        self.assertEqual([0], notnull())
+        # And the same for a failed plan
+        db.start_plan_transaction()
+        db.alter_column("test_rbq", "a", models.IntegerField(default=1))
+        db.finish_plan_transaction(False)
+        self.assertEqual([0], notnull())
+        # Whereas committing applies them
+        db.start_transaction()
+        db.alter_column("test_rbq", "a", models.IntegerField(default=1))
+        db.commit_transaction()
+        self.assertEqual([1], notnull())
+        db.delete_table("test_rbq")
+    
+    def test_sqlite_deferred_index_alterations(self):
+        """
+        Tests that indexes held back by defer_indexes survive SQLite
+        renaming the column, natively or by rebuilding the table.
+        """
+        if db.backend_name != "sqlite3":
+            return
+        def indexed_columns():
+            return [
+                [row[2] for row in db.execute("PRAGMA index_info(%s)" % index[1])]
+                for index in db.execute("PRAGMA index_list(test_defer_rn)")
+            ]
+        for native in (True, False):
+            db.supports_rename_column = native
+            db.defer_indexes = True
+            try:
+                db.create_table("test_defer_rn", [
+                    ('id', models.AutoField(primary_key=True)),
+                    ('spam', models.IntegerField(db_index=True)),
+                ])
+                db.execute_deferred_sql()
+                db.rename_column("test_defer_rn", "spam", "eggs")
+                db.apply_pending_alterations()
+                self.assertEqual([], db.plan_deferred_sql)
+                self.assertEqual([["eggs"]], indexed_columns())
+            finally:
+                del db.supports_rename_column
+                db.defer_indexes = False
+                db.plan_deferred_sql = []
+                db.delete_table("test_defer_rn")
+    
+    def test_plan_transaction(self):
+        """
+        Tests running several transactions' worth of changes as one plan.
+        """
+        if db.backend_name != "sqlite3":
+            self.assertRaises(ValueError, db.start_plan_transaction)
+            return
+        synchronous = db.execute("PRAGMA synchronous")
+        journal_mode = db.execute("PRAGMA journal_mode")
+        # A failed plan leaves nothing behind, committed or not
+        db.start_plan_transaction()
+        self.assertEqual([(0,)], db.execute("PRAGMA synchronous"))
+        self.assertEqual([(u"memory",)], db.execute("PRAGMA journal_mode"))
+        db.start_transaction()
+        db.create_table("test_plan", [('id', models.AutoField(primary_key=True))])
+        db.commit_transaction()
+        db.start_transaction()
+        db.execute("INSERT INTO test_plan (id) VALUES (1)")
+        db.commit_transaction()
+        db.finish_plan_transaction(False)
+        self.assertEqual(synchronous, db.execute("PRAGMA synchronous"))
+        self.assertEqual(journal_mode, db.execute("PRAGMA journal_mode"))
+        self.assertRaises(Exception, db.execute, "SELECT * FROM test_plan")
+        # A successful one keeps everything
+        db.start_plan_transaction()
+        db.create_table("test_plan", [('id', models.AutoField(primary_key=True))])
+        db.execute("INSERT INTO test_plan (id) VALUES (1)")
+        db.finish_plan_transaction()
+        self.assertEqual([(1,)], db.execute("SELECT id FROM test_plan"))
+        db.delete_table("test_plan")
+    
+    def test_test_template(self):
+        """
+        Tests that test database templates are only kept, and run, somewhere
+        nobody else can write to.
+        """
+        if db.backend_name != "sqlite3":
+            return
+        old_dir = getattr(settings, "SOUTH_TESTS_TEMPLATE_DIR", None)
+        settings.SOUTH_TESTS_TEMPLATE_DIR = tempfile.mkdtemp()
+        try:
+            path = db._test_template_path("planted")
+            self.assertEqual(settings.SOUTH_TESTS_TEMPLATE_DIR, os.path.dirname(path))
+            # A template anyone could have written is never run
+            fp = open(path, "w")
+            fp.write("CREATE TABLE test_planted (id INTEGER);")
+            fp.close()
+            os.chmod(path, 0666)
+            self.assertEqual(False, db.load_test_template("planted"))
+            self.assertRaises(Exception, db.execute, "SELECT * FROM test_planted")
+            # Nor is anything kept in a directory anyone can write to
+            os.chmod(settings.SOUTH_TESTS_TEMPLATE_DIR, 0777)
+            self.assertEqual(None, db._test_template_path("planted"))
+            self.assertEqual(False, db.save_test_template("planted"))
+        finally:
+            shutil.rmtree(settings.SOUTH_TESTS_TEMPLATE_DIR)
+            settings.SOUTH_TESTS_TEMPLATE_DIR = old_dir
+    
     def test_alter_column_postgres_multiword(self):
         """
         Tests altering columns with multiple words in Postgres types (issue #125)
@@ -258,6 +557,35 @@ class TestOperations(unittest.TestCase):
         db.execute("INSERT INTO test_alterc (num) VALUES (-3)")
         db.delete_table("test_alterc")
     
+    def test_alter_unchanged(self):
+        """
+        Tests that altering a column to the definition it already has
+        doesn't run any ALTER statements.
+        """
+        if db.backend_name not in ("postgres", "mysql"):
+            return
+        db.create_table("test_alter_noop", [
+            ('name', models.CharField(max_length=100)),
+            ('num', models.IntegerField(null=True)),
+        ])
+        executed = []
+        old_execute = db.execute
+        def recording_execute(sql, params=[]):
+            if sql.startswith("ALTER"):
+                executed.append(sql)
+            return old_execute(sql, params)
+        db.execute = recording_execute
+        try:
+            db.alter_column("test_alter_noop", "name", models.CharField(max_length=100))
+            db.alter_column("test_alter_noop", "num", models.IntegerField(null=True))
+            self.assertEqual([], executed)
+            # But real changes still go through
+            db.alter_column("test_alter_noop", "num", models.IntegerField(null=False, default=3))
+            self.assertNotEqual([], executed)
+        finally:
+            db.execute = old_execute
+            db.delete_table("test_alter_noop")
+    
     def test_unique(self):
         """
         Tests creating/deleting unique constraints.
@@ -330,3 +658,46 @@ class TestOperations(unittest.TestCase):
         
         db.rollback_transaction()
         db.delete_table("test_add_unique_fk")
+
+
+class TestRecordingOperations(unittest.TestCase):
+
+    """
+    Tests the in-memory recording backend; these never touch the database.
+    """
+
+    def setUp(self):
+        from south.db import recording
+        self.db = recording.DatabaseOperations()
+
+    def test_schema(self):
+        rdb = self.db
+        rdb.create_table("rec_spam", [
+            ('id', models.AutoField(primary_key=True)),
+            ('eggs', models.IntegerField(db_index=True)),
+        ])
+        rdb.execute_deferred_sql()
+        rdb.add_column("rec_spam", "ham", models.CharField(max_length=10, unique=True, default="x"))
+        rdb.rename_column("rec_spam", "eggs", "bacon")
+        schema = rdb.get_schema()
+        self.assertEqual(["id", "bacon", "ham"], schema["rec_spam"]["columns"].keys())
+        self.assertEqual(["id"], schema["rec_spam"]["primary_key"])
+        self.assertEqual([["bacon"]], schema["rec_spam"]["indexes"].values())
+        self.assertEqual([["ham"]], schema["rec_spam"]["uniques"].values())
+        self.assertEqual(False, schema["rec_spam"]["columns"]["ham"]["null"])
+        # Broken operations fail like a database would
+        self.assertRaises(ValueError, rdb.delete_column, "rec_spam", "eggs")
+        self.assertRaises(ValueError, rdb.create_table, "rec_spam", [])
+        # And some SQL got recorded along the way
+        self.assert_(rdb.recorded_sql)
+        rdb.delete_column("rec_spam", "bacon")
+        self.assertEqual({}, rdb.get_schema()["rec_spam"]["indexes"])
+    
+    def test_rollback(self):
+        rdb = self.db
+        rdb.create_table("rec_eggs", [('id', models.AutoField(primary_key=True))])
+        rdb.start_transaction()
+        rdb.delete_table("rec_eggs")
+        self.assertEqual([], rdb.get_schema().keys())
+        rdb.rollback_transaction()
+        self.assertEqual(["rec_eggs"], rdb.get_schema().keys())
@@ -4,13 +4,22 @@ from collections import deque
 import datetime
 import sys
 import os
+import shutil
 import StringIO
+import tempfile
+
+from django.conf import settings
 
 from south import exceptions
-from south.migration import migrate_app
-from south.migration.base import all_migrations, Migration, Migrations
+from south.db import db
+from south.migration import bootstrap, bootstrap_create_tables, migrate_app
+from south.migration.base import all_migrations, fingerprint, Migration, Migrations
+from south.migration.migrators import Backwards, Forwards, LoadInitialDataMigrator
+from south.migration.squash import fold, squash, Operation
 from south.migration.utils import depends, dfs, flatten, get_app_name
+from south.utils import is_private
 from south.models import MigrationHistory
+from south.orm import FakeORM, _FakeORM, read_snapshot, write_snapshot
 from south.tests import Monkeypatcher
 
 # Add the tests directory so fakeapp is on sys.path
@@ -65,6 +74,15 @@ class TestMigration(Monkeypatcher):
         self.assertRaises(exceptions.UnknownMigration,
                           self.fakeapp['9999_unknown'].migration)
 
+    def test_orm(self):
+        "Migrations hand out built ORMs, which their neighbours can build from."
+        third = self.fakeapp['0003_alter_spam'].orm()
+        self.assert_(isinstance(third, _FakeORM))
+        self.assertEqual(['fakeapp.bug135'], third.models.keys())
+        self.assert_(Forwards.orm(self.fakeapp['0003_alter_spam']) is third)
+        self.assert_(Backwards.orm(self.fakeapp['0003_alter_spam']) is self.fakeapp['0002_eggs'].orm())
+        self.assertEqual([third], self.fakeapp['0002_eggs'].neighbour_orms()[-1:])
+
     def test_previous(self):
         self.assertEqual([None,
                           self.fakeapp['0001_spam'],
@@ -410,6 +428,13 @@ class TestMigrations(Monkeypatcher):
         self.assertEqual([n + '.migrations' for n in names],
                          [Migrations(n).full_name() for n in names])
 
+    def test_fingerprint(self):
+        fakeapp = __import__("fakeapp", {}, {}, [''])
+        otherfakeapp = __import__("otherfakeapp", {}, {}, [''])
+        self.assertEqual(fingerprint([fakeapp]), fingerprint([fakeapp]))
+        self.assertNotEqual(fingerprint([fakeapp]),
+                            fingerprint([fakeapp, otherfakeapp]))
+
 
 class TestMigrationLogic(Monkeypatcher):
 
@@ -455,6 +480,71 @@ class TestMigrationLogic(Monkeypatcher):
         self.assertEqual(list(MigrationHistory.objects.all()), [])
     
     
+    def test_plan_initial_data(self):
+        """
+        Tests that initial data waits for a single-transaction plan to be
+        committed, as loaddata would commit it early.
+        """
+        migrations = Migrations("fakeapp")
+        migrator = LoadInitialDataMigrator(migrator=Forwards(verbosity=0))
+        db.plan_transaction = True
+        try:
+            # Only once the app's fully migrated, and only once
+            migrator.load_initial_data(migrations[0])
+            self.assertEqual((), tuple(db.plan_initial_data))
+            migrator.load_initial_data(migrations[-1])
+            migrator.load_initial_data(migrations[-1])
+            self.assertEqual(("fakeapp",), tuple(db.plan_initial_data))
+        finally:
+            db.plan_transaction = False
+            db.plan_initial_data = []
+    
+    
+    def test_bootstrap(self):
+        MigrationHistory.objects.all().delete()
+        migrations = Migrations("fakeapp")
+        
+        # Build it straight from the frozen models
+        bootstrap([migrations])
+        self.assertEqual(0, len(db.execute("SELECT * FROM fakeapp_bug135")))
+        
+        # Everything should be marked as done
+        applied = list(MigrationHistory.objects.values_list("app_name", "migration"))
+        applied.sort()
+        self.assertEqual(
+            ((u"fakeapp", u"0001_spam"),
+             (u"fakeapp", u"0002_eggs"),
+             (u"fakeapp", u"0003_alter_spam")),
+            tuple(applied),
+        )
+        
+        # And it's not for databases that have anything there already
+        self.assertRaises(exceptions.DatabaseNotEmpty, bootstrap, [migrations])
+        
+        MigrationHistory.objects.all().delete()
+        db.delete_table("fakeapp_bug135")
+    
+    def test_bootstrap_unique(self):
+        "Bootstrapped tables keep their unique_together, whatever the database."
+        class Frozen:
+            models = {
+                'fakeapp.pair': {
+                    'Meta': {'unique_together': "(('a', 'b'),)"},
+                    'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+                    'a': ('django.db.models.fields.IntegerField', [], {}),
+                    'b': ('django.db.models.fields.IntegerField', [], {}),
+                },
+            }
+        bootstrap_create_tables(FakeORM(Frozen, "fakeapp")['fakeapp.pair'])
+        try:
+            db.execute("INSERT INTO fakeapp_pair (a, b) VALUES (1, 2)")
+            db.execute("INSERT INTO fakeapp_pair (a, b) VALUES (2, 1)")
+            db.start_transaction()
+            self.assertRaises(Exception, db.execute, "INSERT INTO fakeapp_pair (a, b) VALUES (1, 2)")
+            db.rollback_transaction()
+        finally:
+            db.delete_table("fakeapp_pair")
+    
     def test_migration_merge_forwards(self):
         MigrationHistory.objects.all().delete()
         migrations = Migrations("fakeapp")
@@ -602,6 +692,179 @@ class TestMigrationUtils(Monkeypatcher):
             get_app_name(self.create_fake_app("foo.bar.baz.models")),
         )
 
+def frozen_stable(horse_length=None, rider_length=None):
+    """
+    Returns frozen models for a horse, the cart it pulls and a rider; the
+    horse and rider get names of the given lengths, if there are any.
+    """
+    frozen = {
+        'fakeapp.horse': {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+        },
+        'fakeapp.cart': {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'horse': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['fakeapp.Horse']"}),
+        },
+        'fakeapp.rider': {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+        },
+    }
+    if horse_length:
+        frozen['fakeapp.horse']['name'] = ('django.db.models.fields.CharField', [], {'max_length': horse_length})
+    if rider_length:
+        frozen['fakeapp.rider']['name'] = ('django.db.models.fields.CharField', [], {'max_length': rider_length})
+    return frozen
+
+
+class TestFakeORM(Monkeypatcher):
+    installed_apps = ["fakeapp"]
+
+    def test_shared_orms(self):
+        "Migrations freezing the same models share one ORM."
+        class First:
+            models = frozen_stable('20')
+        class Second:
+            models = frozen_stable('20')
+        class Third:
+            models = frozen_stable('30')
+        orm = FakeORM(First, "fakeapp")
+        self.assert_(orm is FakeORM(Second, "fakeapp"))
+        self.assert_(orm is not FakeORM(Third, "fakeapp"))
+        self.assertEqual(20, orm['fakeapp.horse:name'].max_length)
+        self.assertEqual(30, FakeORM(Third, "fakeapp")['fakeapp.horse:name'].max_length)
+        # The same models in another app's migrations are another ORM
+        self.assert_(orm is not FakeORM(First, "otherfakeapp"))
+
+    def test_lazy_orms(self):
+        "Models are only made when asked for, along with what they're linked to."
+        class Frozen:
+            models = frozen_stable()
+        orm = FakeORM(Frozen, "fakeapp")
+        self.assertEqual(set(['fakeapp.horse', 'fakeapp.cart', 'fakeapp.rider']), orm.unbuilt)
+        horse = orm.Horse
+        self.assertEqual(set(['fakeapp.rider']), orm.unbuilt)
+        self.assert_(orm['fakeapp.cart:horse'].rel.to is horse)
+        self.assertEqual(3, len(orm.models))
+        self.assertEqual(set(), orm.unbuilt)
+
+    def test_incremental_orms(self):
+        "Unchanged models, and everything they're linked to, are reused."
+        class First:
+            models = frozen_stable('21', '21')
+        class Second:
+            models = frozen_stable('21', '22')
+        class Third:
+            models = frozen_stable('23', '22')
+        first = FakeORM(First, "fakeapp")
+        second = FakeORM(Second, "fakeapp", [first])
+        self.assert_(first['fakeapp.horse'] is second['fakeapp.horse'])
+        self.assert_(first['fakeapp.cart'] is second['fakeapp.cart'])
+        self.assert_(first['fakeapp.rider'] is not second['fakeapp.rider'])
+        self.assertEqual(22, second['fakeapp.rider:name'].max_length)
+        # Changing the horse means a new cart too, pointing at the new horse
+        third = FakeORM(Third, "fakeapp", [second])
+        self.assert_(second['fakeapp.rider'] is third['fakeapp.rider'])
+        self.assert_(second['fakeapp.cart'] is not third['fakeapp.cart'])
+        self.assert_(third['fakeapp.cart:horse'].rel.to is third['fakeapp.horse'])
+        self.assertEqual(21, second['fakeapp.horse:name'].max_length)
+        self.assertEqual(23, third['fakeapp.horse:name'].max_length)
+
+
+    def test_orm_cache_size(self):
+        "ORMs that fall out of the cache let go of the models only they use."
+        class First:
+            models = frozen_stable(rider_length='41')
+        class Second:
+            models = frozen_stable(rider_length='42')
+        old_size = getattr(settings, "SOUTH_ORM_CACHE_SIZE", 10)
+        settings.SOUTH_ORM_CACHE_SIZE = 1
+        try:
+            first = FakeORM(First, "fakeapp")
+            first_rider, horse = first.Rider, first.Horse
+            second = FakeORM(Second, "fakeapp", [first])
+            self.assert_(second.Horse is horse)
+            self.assert_(second.Rider is not first_rider)
+            # The first ORM has let go of everything...
+            self.assertEqual(set(['fakeapp.horse', 'fakeapp.cart', 'fakeapp.rider']), first.unbuilt)
+            # ...but the models the second shares are still whole
+            self.assertEqual(["cart"], [related.var_name for related in horse._meta.get_all_related_objects()])
+            self.assert_(hasattr(horse, "cart_set"))
+            # And it still works, if you ask it again
+            self.assertEqual(41, first['fakeapp.rider:name'].max_length)
+        finally:
+            settings.SOUTH_ORM_CACHE_SIZE = old_size
+
+
+    def test_snapshots(self):
+        "Resolved definitions are saved, and later ORMs don't need to eval."
+        class Frozen:
+            models = {
+                'fakeapp.horse': {
+                    'Meta': {'unique_together': "(('name', 'born'),)"},
+                    'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+                    'name': ('django.db.models.fields.CharField', [], {'max_length': '51', 'default': "'Dobbin'"}),
+                    'born': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2009, 5, 6, 15, 33)'}),
+                },
+                'fakeapp.cart': {
+                    'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+                    'horse': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['fakeapp.Horse']"}),
+                },
+            }
+        old_settings = (
+            getattr(settings, "SOUTH_ORM_SNAPSHOT_CACHE", False),
+            getattr(settings, "SOUTH_ORM_SNAPSHOT_DIR", None),
+        )
+        settings.SOUTH_ORM_SNAPSHOT_CACHE = True
+        settings.SOUTH_ORM_SNAPSHOT_DIR = tempfile.mkdtemp()
+        try:
+            first = _FakeORM(Frozen, "fakeapp")
+            first.Horse
+            self.assert_(os.path.exists(first.snapshot_path()))
+            # A fresh ORM (as a new process would make) evaluates nothing
+            second = _FakeORM(Frozen, "fakeapp")
+            def fail(*args, **kwargs):
+                self.fail("Definitions were evaluated again.")
+            second.eval_in_context = fail
+            self.assertEqual(51, second['fakeapp.horse:name'].max_length)
+            self.assertEqual("Dobbin", second['fakeapp.horse:name'].default)
+            self.assertEqual(datetime.datetime(2009, 5, 6, 15, 33), second['fakeapp.horse:born'].default)
+            self.assertEqual((('name', 'born'),), second.Horse._meta.unique_together)
+            self.assert_(second['fakeapp.cart:horse'].rel.to is second.Horse)
+            # They're plain data; classes are saved as import paths
+            path = first.snapshot_path()
+            self.assert_('"django.db.models.fields.CharField"' in open(path).read())
+            # Snapshots anyone else could have written are ignored...
+            snapshot = read_snapshot(path)
+            field_class, args, kwargs = snapshot[("field", "fakeapp.horse", "name")]
+            kwargs['max_length'] = 99
+            fp = open(path, "wb")
+            write_snapshot(fp, snapshot)
+            fp.close()
+            os.chmod(path, 0666)
+            self.assertEqual(51, _FakeORM(Frozen, "fakeapp")['fakeapp.horse:name'].max_length)
+            # (and replaced with one only we can write)
+            self.assert_(is_private(path))
+            self.assertEqual(51, read_snapshot(path)[("field", "fakeapp.horse", "name")][2]['max_length'])
+            # Changing the source of a module the fields come from changes the key
+            fields_path = os.path.join(settings.SOUTH_ORM_SNAPSHOT_DIR, "south_snapshot_fields.py")
+            open(fields_path, "w").write("from django.db.models import CharField as NameField\n")
+            sys.path.insert(0, settings.SOUTH_ORM_SNAPSHOT_DIR)
+            Frozen.models['fakeapp.horse']['name'] = ('south_snapshot_fields.NameField', [], {'max_length': '51'})
+            path = _FakeORM(Frozen, "fakeapp").snapshot_path()
+            open(fields_path, "w").write("from django.db.models import TextField as NameField\n")
+            os.utime(fields_path, (0, 0))
+            self.assertNotEqual(path, _FakeORM(Frozen, "fakeapp").snapshot_path())
+            # ...as are directories anyone could write to
+            os.chmod(settings.SOUTH_ORM_SNAPSHOT_DIR, 0777)
+            self.assertEqual(None, _FakeORM(Frozen, "fakeapp").snapshot_path())
+        finally:
+            if settings.SOUTH_ORM_SNAPSHOT_DIR in sys.path:
+                sys.path.remove(settings.SOUTH_ORM_SNAPSHOT_DIR)
+            sys.modules.pop("south_snapshot_fields", None)
+            shutil.rmtree(settings.SOUTH_ORM_SNAPSHOT_DIR)
+            settings.SOUTH_ORM_SNAPSHOT_CACHE, settings.SOUTH_ORM_SNAPSHOT_DIR = old_settings
+
+
 class TestUtils(unittest.TestCase):
 
     def test_flatten(self):
@@ -721,3 +984,73 @@ class TestUtils(unittest.TestCase):
         self.assertCircularDependency(['A3', 'B2', 'B1', 'A3'],
                                       'A4', graph)
 
+
+
+class TestSquash(Monkeypatcher):
+    installed_apps = ["fakeapp"]
+
+    def test_fold(self):
+        from django.db import models
+        def op(operation, **params):
+            return Operation(operation, params)
+        folded = fold([
+            op("create_table", table_name="spam", fields=[("id", models.AutoField(primary_key=True))]),
+            op("add_column", table_name="spam", name="weight", field=models.IntegerField()),
+            op("alter_column", table_name="spam", name="weight", field=models.FloatField()),
+            op("add_column", table_name="eggs", name="size", field=models.IntegerField()),
+            op("alter_column", table_name="eggs", name="size", field=models.IntegerField(null=True)),
+            op("alter_column", table_name="eggs", name="size", field=models.FloatField()),
+            op("delete_column", table_name="eggs", name="size"),
+            op("alter_column", table_name="eggs", name="colour", field=models.IntegerField(null=True)),
+            op("alter_column", table_name="eggs", name="colour", field=models.IntegerField()),
+            op("create_unique", table_name="eggs", columns=["colour"]),
+            op("delete_unique", table_name="eggs", columns=["colour"]),
+            op("create_table", table_name="beans", fields=[]),
+            op("delete_table", table_name="beans"),
+        ])
+        # The column adds go into the create, the size column never was,
+        # and only the last alter of colour is left
+        self.assertEqual(["create_table", "alter_column"], [o.name for o in folded])
+        self.assertEqual(["id", "weight"], [name for name, field in folded[0]["fields"]])
+        self.assert_(isinstance(folded[0]["fields"][1][1], models.FloatField))
+        self.assertEqual(False, folded[1]["field"].null)
+
+    def test_fold_alter_indexes(self):
+        from django.db import models
+        def op(operation, **params):
+            return Operation(operation, params)
+        # alter_column doesn't add or drop indexes, so folding one into the
+        # column's creation mustn't either
+        for old, new in [
+            (models.IntegerField(), models.IntegerField(db_index=True)),
+            (models.IntegerField(db_index=True), models.IntegerField()),
+            (models.IntegerField(), models.IntegerField(unique=True)),
+            (models.IntegerField(unique=True), models.IntegerField()),
+        ]:
+            folded = fold([
+                op("create_table", table_name="spam", fields=[("id", models.AutoField(primary_key=True))]),
+                op("add_column", table_name="spam", name="weight", field=old),
+                op("alter_column", table_name="spam", name="weight", field=new),
+            ])
+            self.assertEqual(["create_table", "alter_column"], [o.name for o in folded])
+            self.assert_(folded[0]["fields"][1][1] is old)
+    
+    def test_fold_barriers(self):
+        from django.db import models
+        def op(operation, **params):
+            return Operation(operation, params)
+        # Nothing gets folded across raw SQL
+        folded = fold([
+            op("add_column", table_name="eggs", name="size", field=models.IntegerField(null=True)),
+            op("execute", sql="UPDATE eggs SET size = 1", params=[]),
+            op("alter_column", table_name="eggs", name="size", field=models.IntegerField()),
+        ])
+        self.assertEqual(["add_column", "execute", "alter_column"], [o.name for o in folded])
+
+    def test_squash(self):
+        forwards, backwards = squash(list(Migrations("fakeapp")))
+        # The alter to spam's name is part of its creation now
+        self.assertEqual(["create_table", "create_table"], [o.name for o in forwards])
+        self.assertEqual(("southtest_spam", "southtest_eggs"), tuple([o["table_name"] for o in forwards]))
+        self.assertEqual(True, dict(forwards[0]["fields"])["name"].null)
+        self.assertEqual(["delete_table", "delete_table"], [o.name for o in backwards])
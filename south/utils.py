@@ -2,6 +2,11 @@
 Generally helpful utility functions.
 """
 
+import getpass
+import os
+import stat
+import tempfile
+
 
 def _ask_for_it_by_name(name):
     "Returns an object referenced by absolute path."
@@ -45,3 +50,46 @@ def memoize(function):
     method.__name__ = function.__name__
     method.__doc__ = function.__doc__
     return method
+
+
+def is_private(path):
+    """
+    Returns whether the file or directory at 'path' belongs to the current
+    user, and nobody else can write to it; caches South loads code from
+    must be, or anyone could plant something in them.
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    if stat.S_ISLNK(info.st_mode):
+        return False
+    if hasattr(os, "getuid"):
+        if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return False
+    return True
+
+def private_directory(name, path=None):
+    """
+    Returns a directory for caches only the current user can write to:
+    'path' if that's given, otherwise a per-user directory called 'name'
+    in the temp dir, made (mode 0700) if it isn't there. Returns None if
+    the directory isn't private, so can't be trusted.
+    """
+    if path is None:
+        if hasattr(os, "getuid"):
+            user = os.getuid()
+        else:
+            user = getpass.getuser()
+        path = os.path.join(tempfile.gettempdir(), "%s-%s" % (name, user))
+        try:
+            os.mkdir(path, 0700)
+        except OSError:
+            pass
+    if not is_private(path):
+        return None
+    return path
+
+def open_private(path):
+    "Opens a new file at 'path' for writing, that only the current user can read."
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), "wb")